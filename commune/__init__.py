@@ -1,18 +1,48 @@
 
-from .module import Module
-Block = Lego = Module
-
-# call it whatever you want, but it's the same thing
-from .module.config import Config
-config = Config
-from .modules.cli import cli
+# everything resolves on first access (module level __getattr__),
+# so `import commune` stays cheap for the short lived processes that only use a few functions
 # from .modules.subspace import subspace
 # from .model import Model
 
-# set the module functions as globals
-for k,v in Module.__dict__.items():
-    globals()[k] = v
+# subpackages whose names are also Module functions (c.module, c.modules, ...),
+# importing a subpackage binds its name in this namespace, so the functions are bound after them
+_shadowed_names = ['module', 'modules', 'utils', 'sandbox', 'contracts']
+
+def _load_module():
+    import importlib
+    from .module import Module
+    # the empty packages are imported now, so a later import of one of their modules does not rebind the name
+    for name in ['modules', 'utils']:
+        importlib.import_module(f'{__name__}.{name}')
+    for name in _shadowed_names:
+        if hasattr(Module, name):
+            globals()[name] = getattr(Module, name)
+    return Module
+
+def __getattr__(name:str):
+    if name in ['Module', 'Block', 'Lego']:
+        # call it whatever you want, but it's the same thing
+        value = _load_module()
+    elif name in ['config', 'Config']:
+        _load_module()
+        from .module.config import Config
+        value = Config
+    elif name == 'cli':
+        _load_module()
+        from .modules.cli import cli
+        value = cli
+    else:
+        # the module functions are globals
+        Module = _load_module()
+        if not hasattr(Module, name):
+            raise AttributeError(f"module 'commune' has no attribute '{name}'")
+        value = getattr(Module, name)
+        if not callable(value):
+            # attributes can change on the class, so they are not cached
+            return value
+    globals()[name] = value
+    return value
 
-for f in Module.get_class_methods() + Module.get_static_methods():
-    globals()[f] = getattr(Module, f)
-    
\ No newline at end of file
+def __dir__():
+    Module = _load_module()
+    return sorted(set(globals()) | set(dir(Module)) | {'Module', 'Block', 'Lego', 'Config', 'config', 'cli'})
@@ -4,14 +4,15 @@ import concurrent
 from copy import deepcopy
 from typing import Optional, Union, Dict, List, Any, Tuple, Callable
 from munch import Munch
-from rich.console import Console
 import json
 from glob import glob
 import sys
 import argparse
 import asyncio
-from typing import Union, Dict, Optional, Any, List, Tuple
+from typing import Union, Dict, Optional, Any, List, Tuple, TYPE_CHECKING
 import warnings
+if TYPE_CHECKING:
+    from rich.console import Console
 
 # AGI BEGINS 
 class c:
@@ -31,7 +32,6 @@ class c:
     repo_path  = os.path.dirname(root_path) # the path to the repo
     library_name = libname = lib = root_dir = root_path.split('/')[-1] # the name of the library
     pwd = os.getenv('PWD') # the current working directory from the process starts 
-    console = Console() # the consolve
     helper_functions = ['info',
                         'schema',
                         'server_name',
@@ -1675,7 +1675,11 @@ class c:
         if path.endswith('module/module.py'):
             return 'commune.Module'
         
-        python_classes = cls.find_python_classes(path, search=search)
+        module_index = cls.load_module_index()
+        if search == ['c.Module'] and cls.is_indexed(path, module_index.get(path)):
+            python_classes = module_index[path]['classes']
+        else:
+            python_classes = cls.find_python_classes(path, search=search)
         
             
         if len(python_classes) == 0:
@@ -1763,16 +1767,17 @@ class c:
                 cls.tree_cache = module_tree
         
         if len(module_tree) == 0:
+            # the index only reparses the files that changed since the last build
             for tree_path in cls.trees():
                 # get modules from each tree
                 python_paths = c.get_module_python_paths(path=tree_path)
                 # add the modules to the module tree
                 module_tree.update({c.path2simple(f): f for f in python_paths})
-                # to use functions like c. we need to replace it with module lol
-                if cls.root_module_class in module_tree:
-                    module_tree[cls.root_module_class] = module_tree.pop(cls.root_module_class)
-                
-                c.put(path, module_tree)
+            # to use functions like c. we need to replace it with module lol
+            if cls.root_module_class in module_tree:
+                module_tree[cls.root_module_class] = module_tree.pop(cls.root_module_class)
+            c.put(path, module_tree)
+            c.tree_cache = module_tree
 
         # cache the module tree
         if search != None:
@@ -1918,26 +1923,108 @@ class c:
         '''
         Search for all of the modules with yaml files. Format of the file
         '''
-        search_glob = c.libpath+'/**/*.py' 
-        path = path if path else c.root_path
-        modules = []
+        module_index = cls.update_module_index(end_line=end_line)
+        modules = [f for f, info in module_index.items() if info['is_module']]
+        if search != None:
+            modules = [f for f in modules if search in f]
+        return modules
 
-        # find all of the python files
-        for f in glob(search_glob, recursive=True):
+    # MODULE INDEX
+    # {python file: {mtime, size, is_module, classes}} of the files under the libpath,
+    # kept in memory after the first load and on disk between processes
+    module_index = {}
+    module_index_path = 'module_index'
 
-            initial_text = c.readlines(f, end_line=end_line)
+    @classmethod
+    def index_file(cls, f:str, end_line:int = 200) -> Optional[dict]:
+        """
+        reads the file once for the module check (first end_line lines) and its classes
+        """
+        try:
+            stat = os.stat(f)
+        except FileNotFoundError:
+            return None
+        text = cls.readlines(f, end_line=2000, resolve=False)
+        initial_text = '\n'.join(text.split('\n')[:end_line])
+        commune_in_file = 'import commune as c' in initial_text 
+        is_commune_root = 'class c:' in initial_text
+        classes = []
+        for line in text.split('\n'):
+            if all([k in line for k in ['class ', '(', '):']]) and 'c.Module' in line:
+                classes.append(line.split('class ')[-1].split('(')[0].strip())
+        return {'mtime': stat.st_mtime_ns, 
+                'size': stat.st_size, 
+                'is_module': commune_in_file or is_commune_root, 
+                'classes': classes}
 
-            commune_in_file = 'import commune as c' in initial_text 
-            is_commune_root = 'class c:' in initial_text
-            if not commune_in_file and not is_commune_root:
-                continue
-            if os.path.isdir(f):
-                continue
+    @classmethod
+    def load_module_index(cls) -> Dict[str, dict]:
+        """
+        the index in memory, loaded from disk on first use in the process
+        """
+        if len(c.module_index) == 0:
+            c.module_index = c.get(cls.module_index_path, {})
+        return c.module_index
 
-            modules.append(f)
-        # we ar caching t
-        return modules
+    @classmethod
+    def is_indexed(cls, f:str, info:dict = None) -> bool:
+        info = info or cls.module_index.get(f)
+        if info == None:
+            return False
+        try:
+            stat = os.stat(f)
+        except FileNotFoundError:
+            return False
+        return info['mtime'] == stat.st_mtime_ns and info['size'] == stat.st_size
+
+    @classmethod
+    def update_module_index(cls, end_line:int = 200) -> Dict[str, dict]:
+        """
+        refreshes the index, only the new and changed files are read
+        """
+        module_index = cls.load_module_index()
+        files = [f for f in glob(c.libpath+'/**/*.py', recursive=True) if not os.path.isdir(f)]
+        changed = len(files) != len(module_index)
+        new_index = {}
+        for f in files:
+            info = module_index.get(f)
+            if not cls.is_indexed(f, info):
+                info = cls.index_file(f, end_line=end_line)
+                changed = True
+                if info == None:
+                    continue
+            new_index[f] = info
+        c.module_index = new_index
+        if changed:
+            c.put(cls.module_index_path, new_index)
+        return new_index
 
+    @classmethod
+    def update_module_file(cls, f:str, tree_path:str = 'local_module_tree') -> dict:
+        """
+        applies a change of one file to the index and the tree (used by the watchdog)
+        """
+        if not f.endswith('.py') or not f.startswith(c.libpath):
+            return {'success': False, 'msg': f'{f} is not a python file in {c.libpath}'}
+        module_tree = cls.tree_cache or c.get(tree_path, {})
+        if len(module_tree) == 0:
+            # no tree to patch yet, build it (this also indexes the file)
+            module_tree = cls.build_tree(update=True, path=tree_path)
+            return {'success': True, 'path': f, 'is_module': f in module_tree.values()}
+        module_index = dict(cls.load_module_index())
+        old_info = module_index.pop(f, None)
+        info = cls.index_file(f)
+        if info != None:
+            module_index[f] = info
+        if old_info != None and old_info['is_module']:
+            module_tree = {k:v for k,v in module_tree.items() if v != f}
+        if info != None and info['is_module']:
+            module_tree[c.path2simple(f)] = f
+        c.module_index = module_index
+        c.tree_cache = module_tree
+        c.put(cls.module_index_path, module_index)
+        c.put(tree_path, module_tree)
+        return {'success': True, 'path': f, 'is_module': info != None and info['is_module']}
 
     available_modules  = module_tree = tree
     @classmethod
@@ -4004,19 +4091,54 @@ class c:
     
 
     
+    # process wide, so the ip is resolved once per process and not per client
+    ip_env = 'COMMUNE_IP'
+    ip_state = {'ip': None, 'timestamp': 0, 'checked': 0, 'resolving': False}
+
     @classmethod
-    def ip(cls, update:bool = False, **kwargs) -> str:
-        if not update:
-            ip = c.get('ip', None)
-            if ip != None:
-                return ip
-        
-        ip =  cls.external_ip(**kwargs)
-        if ip == None:
-            ip = '0.0.0.0'
+    def ip(cls, update:bool = False, block:bool = True, ttl:int = 86400, retry_interval:int = 60, timeout:float = 2, **kwargs) -> str:
+        """
+        The external ip
+        order: the COMMUNE_IP env var, the process cache, the stored ip (refreshed in a background thread when stale),
+        then a lookup that blocks, unless block=False where the default ip is returned until the background lookup finishes
+        use block=False only where the ip is not published (e.g. building a client)
+        """
+        ip = os.environ.get(cls.ip_env, None)
+        if ip:
+            return ip
         if update:
-            c.put('ip', ip)
-        return ip
+            return cls.resolve_external_ip(timeout=timeout, **kwargs)
+        state = c.ip_state
+        if state['ip'] == None:
+            stored = c.get('ip', None, full=True)
+            if isinstance(stored, dict) and stored.get('data', None):
+                state['ip'] = stored['data']
+                state['timestamp'] = stored.get('timestamp', 0)
+        if state['ip'] == None and block and c.time() - state['checked'] > retry_interval:
+            # addresses are published with this ip, so never hand out the default ip
+            return cls.resolve_external_ip(timeout=timeout, **kwargs)
+        is_stale = state['ip'] == None or c.time() - state['timestamp'] > ttl
+        if is_stale and not state['resolving'] and c.time() - state['checked'] > retry_interval:
+            state['resolving'] = True
+            state['checked'] = c.time()
+            c.thread(cls.resolve_external_ip, kwargs={'timeout': timeout, **kwargs})
+        return state['ip'] or c.default_ip
+
+    @classmethod
+    def resolve_external_ip(cls, timeout:float = 2, **kwargs) -> str:
+        state = c.ip_state
+        try:
+            ip = cls.external_ip(timeout=timeout, **kwargs)
+            if ip != None and ip != c.default_ip:
+                state['ip'] = ip
+                state['timestamp'] = c.time()
+                c.put('ip', ip)
+        except Exception as e:
+            c.print(f'Could not resolve the external ip {e}', color='red')
+        finally:
+            state['checked'] = c.time()
+            state['resolving'] = False
+        return state['ip'] or c.default_ip
     @classmethod
     def queue(cls, size:str=-1, *args,  mode='queue', **kwargs):
         if mode == 'queue':
@@ -4497,10 +4619,11 @@ class c:
         return cls.logger
 
     @classmethod
-    def resolve_console(cls, console = None, **kwargs):
+    def resolve_console(cls, console = None):
+        # the console is shared, per call options (style, end) go to console.print
         if not hasattr(cls,'console'):
             from rich.console import Console
-            cls.console = Console(**kwargs)
+            cls.console = Console()
         if console is not None:
             cls.console = console
         return cls.console
@@ -4527,7 +4650,7 @@ class c:
     def print(cls, *text:str, 
               color:str=None, 
               verbose:bool = True,
-              console: Console = None,
+              console: 'Console' = None,
               flush:bool = False,
               **kwargs):
               
@@ -4536,10 +4659,8 @@ class c:
                 color = cls.random_color()
             if color:
                 kwargs['style'] = color
-            console = cls.resolve_console(console, **kwargs)
-
-
             try:
+                console = cls.resolve_console(console)
                 if flush:
                     console.print(**kwargs, end='\r')
                 console.print(*text, **kwargs)
@@ -4576,6 +4697,43 @@ class c:
         console = cls.resolve_console()
         return cls.console.log(*args, **kwargs)
     
+    @classmethod
+    def import_time(cls, module:str = 'commune') -> float:
+        """
+        seconds to import the module in a fresh interpreter (python -X importtime)
+        """
+        import subprocess
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], 
+                                capture_output=True, text=True, cwd=cls.libpath).stderr
+        # import time: self [us] | cumulative | imported package
+        for line in output.split('\n'):
+            parts = line.split('|')
+            if len(parts) == 3 and parts[2].strip() == module:
+                return int(parts[1]) / 1e6
+        raise Exception(f'Could not import {module}: {output[-1000:]}')
+
+    @classmethod
+    def test_import_time(cls, budget:float = 0.05, module_budget:float = 1.0):
+        """
+        import commune should not import anything heavy, the Module class loads on first access
+        """
+        import_time = cls.import_time('commune')
+        assert import_time < budget, f'import commune took {import_time:.3f}s, the budget is {budget}s'
+        module_import_time = cls.import_time('commune.module')
+        assert module_import_time < module_budget, f'import commune.module took {module_import_time:.3f}s, the budget is {module_budget}s'
+        return {'success': True, 'import_time': import_time, 'module_import_time': module_import_time}
+
+    @classmethod
+    def test_lazy_import(cls):
+        """
+        the functions named like subpackages (c.module, c.modules) survive the first attribute access
+        """
+        import subprocess
+        code = "import commune as c; c.print('lazy import'); assert callable(c.module) and callable(c.modules); c.module('key')"
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=cls.libpath)
+        assert result.returncode == 0, result.stderr[-1000:]
+        return {'success': True}
+
     @classmethod
     def test_fns(cls):
         return [f for f in dir(cls) if f.startswith('test_')]
@@ -8186,28 +8344,46 @@ class c:
        
 
     @classmethod
-    def cachefn(cls, func, max_age=60, update=False, cache=True, cache_folder='cachefn'):
-        import functools
-        path_name = cache_folder+'/'+func.__name__
-        def wrapper(*args, **kwargs):
-            fn_name = func.__name__
-            cache_params = {'max_age': max_age, 'cache': cache}
-            for k, v in cache_params.items():
-                cache_params[k] = kwargs.pop(k, v)
-
-            
-            if not update:
-                result = cls.get(fn_name, default=None, **cache_params)
-                if result != None:
-                    return result
-
-            result = func(*args, **kwargs)
-            
-            if cache:
-                cls.put(fn_name, result, cache=cache)
-            return result
+    def cachefn(cls, func=None, max_age=60, update=False, cache=True, cache_folder='cachefn', max_size:int=1024, disk:bool=False):
+        """
+        memoizes func by its arguments (lru of max_size, entries expire after max_age seconds)
+        disk: also keep the results in {cache_folder}/{func} so they survive restarts
+        update: always call func and refresh the cache
+        the stats are in fn.memo.info()
+        """
+        from commune.utils.cache import memoize
+        if func == None:
+            return lambda func: cls.cachefn(func, max_age=max_age, update=update, cache=cache, cache_folder=cache_folder, max_size=max_size, disk=disk)
+        if not cache:
+            return func
+        path = cls.resolve_path(cache_folder+'/'+func.__qualname__) if disk else None
+        wrapper = memoize(func, max_size=max_size, max_age=0 if update else max_age, path=path)
         return wrapper
 
+    @classmethod
+    def test_cachefn(cls, n:int = 10):
+        calls = []
+        def fn(x, y=1):
+            calls.append(x)
+            c.sleep(0.1)
+            return x + y
+        fn = cls.cachefn(fn, max_age=60)
+        assert fn(1) == 2 and fn(1) == 2 and fn(2) == 3
+        assert fn(x=1) == 2 and fn(1, y=1) == 2, 'the same call by name or with the default shares the key'
+        assert fn(1, y=2) == 3, 'the arguments are part of the key'
+        assert calls == [1, 2, 1], calls
+        # concurrent misses call the function once
+        import threading
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(fn(3))) for _ in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+        assert results == [4] * n, results
+        assert calls.count(3) == 1, calls
+        return {'success': True, 'msg': 'cachefn passed', **fn.memo.info()}
+
     @classmethod
     def ss58_encode(cls, data:Union[str, bytes], ss58_format=42, **kwargs):
         from scalecodec.utils.ss58 import ss58_encode
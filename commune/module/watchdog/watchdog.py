@@ -12,9 +12,12 @@ class FileChangeHandler(FileSystemEventHandler):
     def on_any_event(self, event):
         if event.is_directory:
             return
-        if event.event_type in ['created', 'modified', 'deleted']:
+        if event.event_type in ['created', 'modified', 'deleted', 'moved']:
             c.print(f'File change detected: {event.src_path}')
-            c.module_tree(update=True, verbose=True)
+            # only the changed file is reindexed
+            c.update_module_file(event.src_path)
+            if event.event_type == 'moved':
+                c.update_module_file(event.dest_path)
 
 class WatchdogModule(c.Module, FileSystemEventHandler):
 
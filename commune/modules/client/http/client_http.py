@@ -2,6 +2,7 @@
 
 from typing import Tuple, List, Union
 import asyncio
+import atexit
 from functools import partial
 import commune as c
 import aiohttp
@@ -20,6 +21,9 @@ class CustomStreamReader(StreamReader):
 
 class Client(c.Module): 
 
+    # process wide session pool, {(loop id, address): {'session', 'loop', 'last_used'}}
+    sessions = {}
+
     def __init__( 
             self,
             ip: str ='0.0.0.0',
@@ -31,13 +35,24 @@ class Client(c.Module):
             loop: 'asyncio.EventLoop' = None, 
             debug: bool = False,
             serializer= 'serializer',
+            content_type: str = 'application/msgpack',
+            pool_size: int = 100,
+            pool_size_per_host: int = 32,
+            keepalive_timeout: int = 30,
+            max_idle: int = 300,
             **kwargs
         ):
         self.loop = c.get_event_loop() if loop == None else loop
         self.set_client(ip =ip,port = port)  
+        self.set_pool(pool_size=pool_size, 
+                      pool_size_per_host=pool_size_per_host, 
+                      keepalive_timeout=keepalive_timeout, 
+                      max_idle=max_idle)
         self.serializer = c.module(serializer)()
+        self.content_type = content_type
         self.key = c.get_key(key)
-        self.my_ip = c.ip()
+        # the client only compares it with the server ip, so it does not wait for the lookup
+        self.my_ip = c.ip(block=False)
         self.network = c.resolve_network(network)
         self.start_timestamp = c.timestamp()
         self.save_history = save_history
@@ -65,6 +80,114 @@ class Client(c.Module):
     def resolve_client(self, ip: str = None, port: int = None) -> None:
         if ip != None or port != None:
             self.set_client(ip =ip,port = port)  
+
+    # addresses of servers that only speak json (older versions of server.http)
+    json_addresses = set()
+    unsupported_media_status = [415, 422]
+
+    def resolve_content_type(self) -> str:
+        if self.address in self.json_addresses:
+            return self.serializer.json_content_type
+        return self.content_type
+
+    def get_request(self, input:dict, content_type:str = 'application/json', headers:dict = None) -> dict:
+        """
+        signs the input and returns the kwargs for session.post
+        for msgpack the signature covers the raw payload bytes
+        """
+        headers = headers or {}
+        if content_type == self.serializer.msgpack_content_type:
+            request = self.serializer.serialize(input, mode='msgpack')
+            request = self.key.sign(request, return_json=True)
+            request = self.serializer.serialize(request, mode='msgpack')
+            headers = {**headers, 'Content-Type': content_type, 'Accept': content_type}
+            return {'data': request, 'headers': headers}
+        request = self.serializer.serialize(input)
+        request = self.key.sign(request, return_json=True)
+        return {'json': request, 'headers': headers}
+
+    def set_pool(self, 
+                 pool_size:int = 100, 
+                 pool_size_per_host:int = 32, 
+                 keepalive_timeout:int = 30, 
+                 max_idle:int = 300):
+        """
+        pool_size: max number of open connections per session
+        pool_size_per_host: max number of open connections to the same host
+        keepalive_timeout: seconds an idle connection is kept alive by the connector
+        max_idle: seconds an unused session stays in the pool before it is closed
+        """
+        self.pool_size = pool_size
+        self.pool_size_per_host = pool_size_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.max_idle = max_idle
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """
+        returns the pooled session for this address, creating it if needed.
+        sessions are bound to the running event loop, so this must be called from a coroutine
+        """
+        loop = asyncio.get_running_loop()
+        self.evict_sessions(max_idle=self.max_idle)
+        session_key = (id(loop), self.address)
+        session_info = self.sessions.get(session_key, None)
+        if session_info == None or session_info['session'].closed or session_info['loop'] is not loop:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, 
+                                             limit_per_host=self.pool_size_per_host, 
+                                             keepalive_timeout=self.keepalive_timeout,
+                                             ttl_dns_cache=self.max_idle)
+            session_info = {'session': aiohttp.ClientSession(connector=connector), 'loop': loop}
+            self.sessions[session_key] = session_info
+        session_info['last_used'] = c.time()
+        return session_info['session']
+
+    @classmethod
+    def evict_sessions(cls, max_idle:int = 300) -> List[str]:
+        """
+        closes the sessions on the running loop that have not been used for max_idle seconds
+        """
+        loop = asyncio.get_running_loop()
+        evicted = []
+        for session_key, session_info in list(cls.sessions.items()):
+            if session_info['loop'] is not loop:
+                continue
+            if c.time() - session_info['last_used'] > max_idle or session_info['session'].closed:
+                cls.sessions.pop(session_key, None)
+                if not session_info['session'].closed:
+                    loop.create_task(session_info['session'].close())
+                evicted.append(session_key[1])
+        return evicted
+
+    @classmethod
+    def close_sessions(cls) -> dict:
+        """
+        closes every pooled session on loops that are not running, drops the rest
+        """
+        n = 0
+        for session_key, session_info in list(cls.sessions.items()):
+            cls.sessions.pop(session_key, None)
+            session, loop = session_info['session'], session_info['loop']
+            if session.closed:
+                continue
+            if loop.is_closed() or loop.is_running():
+                # the connector will be cleaned up with the loop
+                continue
+            loop.run_until_complete(session.close())
+            n += 1
+        return {'success': True, 'closed': n}
+
+    def close(self) -> dict:
+        """
+        closes the pooled session for this address
+        """
+        for session_key, session_info in list(self.sessions.items()):
+            if session_key[1] != self.address:
+                continue
+            self.sessions.pop(session_key, None)
+            loop = session_info['loop']
+            if not session_info['session'].closed and not loop.is_closed() and not loop.is_running():
+                loop.run_until_complete(session_info['session'].close())
+        return {'success': True, 'address': self.address}
     
 
 
@@ -88,63 +211,34 @@ class Client(c.Module):
                         "ip": self.my_ip,
                         "timestamp": c.timestamp(),
                         }
-        # serialize this into a json string
-        request = self.serializer.serialize(input)
-        request = self.key.sign(request, return_json=True)
+        # serialize this into the negotiated wire format (msgpack or json)
+        content_type = self.resolve_content_type()
+        request = self.get_request(input=input, content_type=content_type, headers=headers)
 
         
         
-        # start a client session and send the request
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=request, headers=headers) as response:
-                if response.content_type == 'text/event-stream':
-                    STREAM_PREFIX = 'data: '
-                    BYTES_PER_MB = 1e6
-                    if self.debug:
-                        progress_bar = c.tqdm(desc='MB per Second', position=0)
-
-                    result = {}
-                    
-                    async for line in response.content:
-                        event_data = line.decode('utf-8')
-                        
-                        event_bytes  = len(event_data)
-                        if self.debug :
-                            progress_bar.update(event_bytes/(BYTES_PER_MB))
-                        # remove the "data: " prefix
-                        if event_data.startswith(STREAM_PREFIX):
-                            event_data = event_data[len(STREAM_PREFIX):]
-
-                        event_data = event_data.strip()
-                        
-                        # skip empty lines
-                        if event_data == "":
-                            continue
-
-                        # if the data is formatted as a json string, load it {data: ...}
-                        if isinstance(event_data, bytes):
-                            event_data = event_data.decode('utf-8')
-
-                        # if the data is formatted as a json string, load it {data: ...}
-                        if isinstance(event_data, str):
-                            if event_data.startswith('{') and event_data.endswith('}') and 'data' in event_data:
-                                event_data = json.loads(event_data)['data']
-                            result += [event_data]
-                        
-                    # process the result if its a json string
-                    if result.startswith('{') and result.endswith('}') or \
-                        result.startswith('[') and result.endswith(']'):
-                        result = ''.join(result)
-                        result = json.loads(result)  
-
-                elif response.content_type == 'application/json':   
-                    # PROCESS JSON EVENTS
-                    result = await asyncio.wait_for(response.json(), timeout=timeout)
-                elif response.content_type == 'text/plain':
-                    # PROCESS TEXT EVENTS
-                    result = await asyncio.wait_for(response.text(), timeout=timeout)
-                else:
-                    raise ValueError(f"Invalid response content type: {response.content_type}")
+        # reuse the pooled session for this address and send the request
+        session = self.get_session()
+        async with session.post(url, **request) as response:
+            if response.status in self.unsupported_media_status and content_type != self.serializer.json_content_type:
+                # older servers only speak json, so fall back and remember it for this address
+                self.json_addresses.add(self.address)
+                return await self.async_forward(fn=fn, args=args, kwargs=kwargs, timeout=timeout, generator=generator, headers=headers)
+            if response.content_type == 'text/event-stream':
+                # PROCESS STREAMING EVENTS (use stream to get the items as they arrive)
+                result = [item async for item in self.iterate_stream(response, chunk_timeout=timeout)]
+            elif response.content_type == self.serializer.msgpack_content_type:
+                # PROCESS MSGPACK EVENTS
+                result = await asyncio.wait_for(response.read(), timeout=timeout)
+                result = self.serializer.msgpack2python(result)
+            elif response.content_type == 'application/json':
+                # PROCESS JSON EVENTS
+                result = await asyncio.wait_for(response.json(), timeout=timeout)
+            elif response.content_type == 'text/plain':
+                # PROCESS TEXT EVENTS
+                result = await asyncio.wait_for(response.text(), timeout=timeout)
+            else:
+                raise ValueError(f"Invalid response content type: {response.content_type}")
         if isinstance(result, dict):
             result = self.serializer.deserialize(result)
         elif isinstance(result, str):
@@ -154,12 +248,137 @@ class Client(c.Module):
         if self.save_history:
             input['fn'] = fn
             input['result'] = result
+            # the key of the caller, as in the server records
+            input['address'] = self.key.ss58_address
             input['module']  = self.address
             input['latency'] =  c.time() - input['timestamp']
-            path = self.history_path+'/' + self.server_name + '/' + str(input['timestamp'])
-            self.put(path, input)
+            # queued for the background writer, this never blocks the call
+            sink = c.module('history').get_sink(self.resolve_path(self.history_path+'/' + self.server_name))
+            sink.add(input)
         return result
     
+    async def iterate_stream(self, response: 'aiohttp.ClientResponse', chunk_timeout: int = 10):
+        """
+        parses the server sent events of a response and yields the reassembled items.
+        items bigger than the server chunk_size arrive as "chunk" events followed by an "item" event.
+        we only read the next line when the consumer asks for the next item, so a slow
+        consumer applies backpressure all the way to the server through the socket.
+        """
+        BYTES_PER_MB = 1e6
+        if self.debug:
+            progress_bar = c.tqdm(desc='MB per Second', position=0)
+        event, data_lines, buffer = None, [], ''
+        while True:
+            line = await asyncio.wait_for(response.content.readline(), timeout=chunk_timeout)
+            if line == b'':
+                break
+            if self.debug:
+                progress_bar.update(len(line)/BYTES_PER_MB)
+            line = line.decode('utf-8').rstrip('\r\n')
+            if line.startswith('event:'):
+                event = line[len('event:'):].strip()
+            elif line.startswith('data:'):
+                data = line[len('data:'):]
+                data_lines.append(data[1:] if data.startswith(' ') else data)
+            elif line == '' and len(data_lines) > 0:
+                # a blank line ends the event
+                buffer += '\n'.join(data_lines)
+                if event != 'chunk':
+                    yield self.process_stream_item(buffer)
+                    buffer = ''
+                event, data_lines = None, []
+        if len(data_lines) > 0:
+            buffer += '\n'.join(data_lines)
+        if buffer != '':
+            yield self.process_stream_item(buffer)
+
+    def process_stream_item(self, item:str):
+        if item.startswith('{') and item.endswith('}'):
+            item = self.unwrap(self.serializer.deserialize(item))
+        return item
+
+    @staticmethod
+    def unwrap(result):
+        """
+        the result in a server envelope, {'data'} for stream items or the signed {'data', 'signature', ...},
+        any other dict is a result of its own
+        """
+        if isinstance(result, dict) and 'data' in result and (len(result) == 1 or 'signature' in result):
+            return result['data']
+        return result
+
+    async def stream(self,
+        fn: str,
+        args: list = None,
+        kwargs: dict = None,
+        ip: str = None,
+        port : int= None,
+        chunk_timeout: int = 10,
+        headers : dict = None,
+        ):
+        """
+        async iterator over the items of a generator function on the server, 
+        yielded as soon as they arrive
+
+        async for item in client.stream('generate', kwargs={'text': 'hey'}):
+            print(item)
+        """
+        self.resolve_client(ip=ip, port=port)
+        url = f"http://{self.address}/{fn}/"
+        input =  { 
+                        "args": args if args else [],
+                        "kwargs": kwargs if kwargs else {},
+                        "ip": self.my_ip,
+                        "timestamp": c.timestamp(),
+                        }
+        content_type = self.resolve_content_type()
+        request = self.get_request(input=input, content_type=content_type, headers=headers)
+        session = self.get_session()
+        async with session.post(url, **request) as response:
+            if response.status in self.unsupported_media_status and content_type != self.serializer.json_content_type:
+                self.json_addresses.add(self.address)
+                async for item in self.stream(fn=fn, args=args, kwargs=kwargs, chunk_timeout=chunk_timeout, headers=headers):
+                    yield item
+                return
+            if response.content_type == 'text/event-stream':
+                async for item in self.iterate_stream(response, chunk_timeout=chunk_timeout):
+                    yield item
+            else:
+                # not a generator on the server, so the whole result is the only item
+                if response.content_type == self.serializer.msgpack_content_type:
+                    result = self.serializer.msgpack2python(await asyncio.wait_for(response.read(), timeout=chunk_timeout))
+                elif response.content_type == 'application/json':
+                    result = await asyncio.wait_for(response.json(), timeout=chunk_timeout)
+                else:
+                    result = await asyncio.wait_for(response.text(), timeout=chunk_timeout)
+                yield self.unwrap(self.serializer.deserialize(result))
+
+    @classmethod
+    def test_stream(cls, module:str = 'server.http.bench', fn:str = 'stream_sleep', n:int = 10, delay:float = 0.1):
+        """
+        reports the time to first item vs the total time of a streamed call
+        """
+        server_name = module + '::stream'
+        c.serve(module, tag='stream', wait_for_server=True)
+        client = c.connect(server_name, virtual=False)
+        async def consume():
+            t1 = c.time()
+            stats = {'time_to_first_item': None, 'num_items': 0}
+            async for item in client.stream(fn=fn, kwargs={'n': n, 'delay': delay}):
+                if stats['time_to_first_item'] == None:
+                    stats['time_to_first_item'] = c.time() - t1
+                stats['num_items'] += 1
+            stats['total_time'] = c.time() - t1
+            return stats
+        try:
+            stats = c.gather(consume(), timeout=n*delay + 10)
+        finally:
+            c.kill(server_name)
+        assert stats['num_items'] == n, stats
+        assert stats['time_to_first_item'] < stats['total_time'], stats
+        c.print(stats)
+        return stats
+
     @classmethod
     def history(cls, key=None, history_path='history'):
         key = c.get_key(key)
@@ -216,3 +435,6 @@ class Client(c.Module):
     
     def __repr__(self) -> str:
         return super().__repr__()
+
+
+atexit.register(Client.close_sessions)
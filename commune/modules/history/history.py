@@ -1,33 +1,270 @@
 import commune as c
+from typing import *
+import os
+import json
+import queue
+import random
+import atexit
+import threading
+from glob import glob
 
 class History(c.Module):
-    def __init__(self, key=None, history_path='history'):
+    """
+    Background history sink
+    records are queued without blocking the caller and a writer thread appends them in batches
+    to jsonl segments ({history_path}/{start_timestamp_ms}.jsonl) that rotate by size and age
+    """
+    # one sink per history path per process, so every client/server writing to a path shares one writer
+    sinks = {}
+    segment_extension = 'jsonl'
+
+    def __init__(self,
+                 key=None,
+                 history_path='history',
+                 max_queue:int = 10000, # max records waiting to be written, new records are dropped when full
+                 sample_rate:float = 0.1, # fraction of records kept when the queue is above the high watermark
+                 high_watermark:float = 0.8, # fraction of max_queue where sampling starts
+                 batch_size:int = 1000, # max records per write
+                 flush_interval:float = 1.0, # seconds to collect a batch before writing it
+                 max_segment_size:int = 64_000_000, # bytes per segment before rotating
+                 max_segment_age:int = 3600, # seconds per segment before rotating
+                 ):
         self.key = c.get_key(key)
-        self.history_path = history_path
+        self.history_path = self.resolve_path(history_path)
+        self.max_queue = max_queue
+        self.sample_rate = sample_rate
+        self.high_watermark = high_watermark
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_segment_size = max_segment_size
+        self.max_segment_age = max_segment_age
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.segment = None
+        self.segment_file = None
+        self.segment_start = 0
+        self.stats = {'written': 0, 'dropped': 0, 'sampled_out': 0, 'segments': 0}
+        # the counters have their own lock, so add never waits on a write
+        self.stats_lock = threading.Lock()
+        self.writer = None
         c.print(f"History path: {self.history_path}", color='green')
-        
+
+    @classmethod
+    def get_sink(cls, history_path:str, **kwargs) -> 'History':
+        history_path = cls.resolve_path(history_path)
+        if history_path not in cls.sinks:
+            cls.sinks[history_path] = cls(history_path=history_path, **kwargs)
+        return cls.sinks[history_path]
+
+    def add(self, item:dict) -> bool:
+        """
+        queues the item without blocking, returns False if it was dropped or sampled out
+        """
+        if self.writer == None:
+            self.start()
+        if self.queue.qsize() >= self.high_watermark * self.max_queue and random.random() > self.sample_rate:
+            self.count('sampled_out')
+            return False
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.count('dropped')
+            return False
+        return True
+
+    def count(self, stat:str, n:int = 1):
+        with self.stats_lock:
+            self.stats[stat] += n
+
     def add_history(self, item:dict,  key=None):
-        path = self.history_path+'/' + self.key.ss58_address + '/' + str(item['timestamp'])
-        return self.put(path, item)
-    
+        return self.add(item)
+
+    def start(self):
+        with self.lock:
+            if self.writer == None:
+                self.writer = c.thread(self.write_loop)
+        return {'success': True, 'history_path': self.history_path}
+
+    def write_loop(self):
+        while True:
+            items = [self.queue.get()]
+            deadline = c.time() + self.flush_interval
+            while len(items) < self.batch_size:
+                timeout = deadline - c.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.write(items)
+            except Exception as e:
+                self.count('dropped', len(items))
+                c.print(f'Error writing history to {self.history_path}: {e}', color='red')
+
+    def write(self, items:List[dict]):
+        with self.lock:
+            if self.should_rotate():
+                self.rotate()
+            lines = ''.join([json.dumps(item, default=str) + '\n' for item in items])
+            self.segment_file.write(lines)
+            self.segment_file.flush()
+        self.count('written', len(items))
+
+    def should_rotate(self) -> bool:
+        if self.segment_file == None:
+            return True
+        if c.time() - self.segment_start > self.max_segment_age:
+            return True
+        return self.segment_file.tell() > self.max_segment_size
+
+    def rotate(self):
+        if self.segment_file != None:
+            self.segment_file.close()
+        self.segment_start = c.time()
+        os.makedirs(self.history_path, exist_ok=True)
+        self.segment = os.path.join(self.history_path, f'{int(self.segment_start*1000)}.{self.segment_extension}')
+        self.segment_file = open(self.segment, 'a')
+        self.count('segments')
+
+    def flush(self):
+        """
+        writes whatever is still queued (used on shutdown)
+        """
+        items = []
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if len(items) > 0:
+            self.write(items)
+        return {'success': True, 'written': len(items)}
+
     @classmethod
-    def history(cls, key=None, history_path='history'):
-        key = c.get_key(key)
-        return cls.ls(history_path + '/' + key.ss58_address)
-    
-    
+    def flush_sinks(cls):
+        for sink in list(cls.sinks.values()):
+            try:
+                sink.flush()
+            except Exception as e:
+                c.print(f'Error flushing history {sink.history_path}: {e}', color='red')
+
     @classmethod
-    def all_history(cls, key=None, history_path='history'):
+    def segments(cls, history_path='history', since:float = None) -> List[str]:
+        """
+        segments under the path (recursive), newest first
+        """
+        history_path = cls.resolve_path(history_path)
+        paths = glob(os.path.join(history_path, f'**/*.{cls.segment_extension}'), recursive=True)
+        start = lambda p: int(os.path.basename(p).split('.')[0])/1000
+        paths = sorted(paths, key=start, reverse=True)
+        if since != None:
+            # a segment holds the records from its start until the next segment in its directory starts
+            next_start = {}
+            segments = []
+            for p in paths:
+                dirpath = os.path.dirname(p)
+                if next_start.get(dirpath, float('inf')) > since:
+                    segments.append(p)
+                next_start[dirpath] = start(p)
+            paths = segments
+        return paths
+
+    @classmethod
+    def query(cls,
+              history_path='history',
+              n:int = 100,
+              since:float = None,
+              address:str = None,
+              module:str = None,
+              fn:str = None) -> List[dict]:
+        """
+        returns the last n records (newest first) under the path
+        address: the key of the caller (both the server and the client records have it)
+        module: the server name in server records, the server ip:port in client records
+        """
+        records = []
+        for path in cls.segments(history_path, since=since):
+            with open(path) as f:
+                lines = f.readlines()
+            for line in reversed(lines):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # partially written line
+                    continue
+                if since != None and record.get('timestamp', 0) < since:
+                    continue
+                if address != None and record.get('address') != address:
+                    continue
+                if module != None and record.get('module') != module:
+                    continue
+                if fn != None and record.get('fn') != fn:
+                    continue
+                records.append(record)
+                if len(records) >= n:
+                    return records
+        return records
+
+    @classmethod
+    def history(cls, key=None, history_path='history', n:int = 100):
         key = c.get_key(key)
-        return cls.glob(history_path)
-        
+        return cls.query(history_path, n=n, address=key.ss58_address)
+
+
+    @classmethod
+    def all_history(cls, key=None, history_path='history', n:int = 100):
+        return cls.query(history_path, n=n)
+
     @classmethod
     def rm_key_history(cls, key=None, history_path='history'):
         key = c.get_key(key)
         return cls.rm(history_path + '/' + key.ss58_address)
-    
+
     @classmethod
     def rm_history(cls, key=None, history_path='history'):
         key = c.get_key(key)
         return cls.rm(history_path)
 
+    @classmethod
+    def test(cls, n:int = 100):
+        history_path = 'test_history'
+        cls.rm(history_path)
+        self = cls(history_path=history_path, flush_interval=0.1)
+        for i in range(n):
+            assert self.add({'i': i, 'timestamp': c.time()})
+        self.flush()
+        # give the writer thread time to write the batch it is holding
+        c.sleep(self.flush_interval * 2)
+        records = cls.query(history_path, n=n)
+        assert len(records) == n, len(records)
+        assert records[0]['i'] == n - 1
+        cls.rm(history_path)
+        return {'success': True, 'msg': f'wrote and read {n} records', **self.stats}
+
+    @classmethod
+    def test_client(cls, module:str = 'module', fn:str = 'info'):
+        """
+        the records a Client writes can be found by its key and the server address
+        """
+        history_path = cls.resolve_path('test_client_history')
+        cls.rm(history_path)
+        server_name = module + '::history'
+        c.serve(module, tag='history', wait_for_server=True)
+        try:
+            client = c.connect(server_name, virtual=False)
+            client.history_path = history_path
+            client.forward(fn=fn)
+        finally:
+            c.kill(server_name)
+        cls.flush_sinks()
+        # give the writer thread time to write the batch it is holding
+        c.sleep(2)
+        records = cls.query(history_path, address=client.key.ss58_address, module=client.address, fn=fn)
+        assert len(records) == 1, records
+        cls.rm(history_path)
+        return {'success': True, 'msg': 'the client record was found by address and module'}
+
+
+atexit.register(History.flush_sinks)
@@ -3,7 +3,9 @@ import json
 from scalecodec.utils.ss58 import ss58_encode, ss58_decode, get_ss58_format
 from scalecodec.base import ScaleBytes
 from typing import Union, Optional
+import os
 import time
+import threading
 import binascii
 import re
 import secrets
@@ -183,6 +185,12 @@ class Keypair(c.Module):
         if password != None:
             key_json = cls.encrypt(data=key_json, password=password)
         cls.put(path, key_json)
+        cls.uncache_key(path)
+        if cls.address2key_index != None:
+            with cls.key_cache_lock:
+                cls.address2key_index = {a:k for a,k in cls.address2key_index.items() if k != path}
+                cls.address2key_index[key.ss58_address] = path
+        cls.update_key2address(path, key.ss58_address)
         return  json.loads(key_json)
     
     
@@ -317,6 +325,59 @@ class Keypair(c.Module):
 
     
 
+    # KEY CACHE
+    # keypairs by key file, a cached keypair is used until its file changes (stat on every hit)
+    # encrypted keys are never cached
+    key_cache = {}
+    key_cache_lock = threading.Lock()
+    address2key_index = None # address -> key name, loaded on first use
+
+    @classmethod
+    def key_file_version(cls, path:str) -> Optional[tuple]:
+        try:
+            stat = os.stat(cls.resolve_path(path, extension='json'))
+        except (FileNotFoundError, TypeError):
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    @classmethod
+    def get_cached_key(cls, path:str) -> Optional['Keypair']:
+        version = cls.key_file_version(path)
+        if version == None:
+            return None
+        with cls.key_cache_lock:
+            entry = cls.key_cache.get(path)
+        if entry != None and entry['version'] == version:
+            return entry['key']
+        return None
+
+    @classmethod
+    def cache_key(cls, path:str, key:'Keypair', version:tuple = None):
+        version = version or cls.key_file_version(path)
+        if version == None:
+            return
+        with cls.key_cache_lock:
+            cls.key_cache[path] = {'version': version, 'key': key}
+            if cls.address2key_index != None:
+                cls.address2key_index[key.ss58_address] = path
+
+    @classmethod
+    def uncache_key(cls, path:str):
+        with cls.key_cache_lock:
+            entry = cls.key_cache.pop(path, None)
+            if entry != None and cls.address2key_index != None:
+                cls.address2key_index.pop(entry['key'].ss58_address, None)
+
+    @classmethod
+    def get_address_index(cls, update:bool = False) -> dict:
+        with cls.key_cache_lock:
+            address2key_index = cls.address2key_index
+        if address2key_index == None or update:
+            address2key_index = { v: k for k,v in cls.key2address(update=update).items()}
+            with cls.key_cache_lock:
+                cls.address2key_index = address2key_index
+        return address2key_index
+
     @classmethod
     def get_key(cls, 
                 path:str,
@@ -324,6 +385,26 @@ class Keypair(c.Module):
                 json:bool=False,
                 create_if_not_exists:bool = True,
                 **kwargs):
+
+        if not json:
+            key = cls.get_cached_key(path)
+            if key != None:
+                return key
+        if isinstance(path, str) and cls.valid_ss58_address(path):
+            # the address of a key, the index is rebuilt if it misses or points to a key with another address
+            address = path
+            for update in [False, True]:
+                path = cls.get_address_index(update=update).get(address, address)
+                key = None if json else cls.get_cached_key(path)
+                if key == None and path != address:
+                    try:
+                        key = cls.get_key(path, password=password, create_if_not_exists=False)
+                    except ValueError:
+                        key = None
+                if key != None and key.ss58_address == address:
+                    break
+            if key != None and key.ss58_address == address:
+                return key
         
         if cls.key_exists(path) == False:
             if create_if_not_exists == True:
@@ -332,10 +413,13 @@ class Keypair(c.Module):
             else:
                 raise ValueError(f'key does not exist at --> {path}')
         
+        # the version before the read, so a write during the read invalidates the entry
+        version = cls.key_file_version(path)
         key_json = cls.get(path)
 
         # if key is encrypted, decrypt it
-        if c.is_encrypted(key_json):
+        encrypted = c.is_encrypted(key_json)
+        if encrypted:
             key_json = cls.decrypt(data=key_json, password=password)
             if key_json == None:
                 c.print({'status': 'error', 'message': f'key is encrypted, please {path} provide password'}, color='red')
@@ -351,6 +435,8 @@ class Keypair(c.Module):
             return key_json
         else:
             key = cls.from_json(key_json)
+            if not encrypted:
+                cls.cache_key(path, key, version=version)
             return key
         
         
@@ -382,9 +468,25 @@ class Keypair(c.Module):
             key2address =  {k:v for k,v in key2address.items() if  search in k}
         return key2address
 
+    @classmethod
+    def update_key2address(cls, key:str, address:str = None):
+        """
+        sets (or removes if the address is None) the key in the saved key2address, if there is one
+        """
+        path = 'key2address'
+        with cls.key_cache_lock:
+            key2address = cls.get(path, None)
+            if not isinstance(key2address, dict):
+                return
+            if address == None:
+                key2address.pop(key, None)
+            else:
+                key2address[key] = address
+            cls.put(path, key2address)
+
     @classmethod
     def address2key(cls, search:Optional[str]=None, update:bool=False):
-        address2key =  { v: k for k,v in cls.key2address(update=update).items()}
+        address2key =  dict(cls.get_address_index(update=update))
         if search != None :
             return address2key.get(search, None)
         else:
@@ -466,6 +568,11 @@ class Keypair(c.Module):
             raise Exception(f'key {key} not found, available keys: {keys}')
         c.rm(key2path[key])
         assert c.exists(key2path[key]) == False, 'key not deleted'
+        cls.uncache_key(key)
+        if cls.address2key_index != None:
+            with cls.key_cache_lock:
+                cls.address2key_index = {a:k for a,k in cls.address2key_index.items() if k != key}
+        cls.update_key2address(key)
         
         return {'deleted':[key]}
     @property
@@ -952,10 +1059,14 @@ class Keypair(c.Module):
         signature in bytes
 
         """
-        if not isinstance(data, str):
+        # raw bytes (ie. msgpack payloads) are signed as they are
+        is_bytes = isinstance(data, bytes)
+        if not isinstance(data, (str, bytes, ScaleBytes)):
             data = c.python2str(data)
         if type(data) is ScaleBytes:
             data = bytes(data.data)
+        elif is_bytes:
+            pass
         elif data[0:2] == '0x':
             data = bytes.fromhex(data[2:])
         elif type(data) is str:
@@ -978,7 +1089,7 @@ class Keypair(c.Module):
         
         if return_json:
             return {
-                'data': data.decode(),
+                'data': data if is_bytes else data.decode(),
                 'crypto_type': self.crypto_type,
                 'signature': signature.hex(),
                 'address': self.ss58_address,
@@ -1021,7 +1132,7 @@ class Keypair(c.Module):
             if 'data' in data:
                 data = data.pop('data')
             
-            if not isinstance(data, str):
+            if not isinstance(data, (str, bytes)):
                 data = c.python2str(data)
             
                 
@@ -1314,6 +1425,21 @@ class Keypair(c.Module):
         assert not self.key_exists('test'), f'Key management failed, key still exists'
         return {'success': True, 'msg': 'test_key_management passed'}
 
+    @classmethod
+    def test_key_cache(cls, key='test.key_cache'):
+        if cls.key_exists(key):
+            cls.rm_key(key)
+        key1 = cls.get_key(key)
+        assert cls.get_key(key) is key1, 'the key was not cached'
+        assert cls.get_key(key1.ss58_address) is key1, 'the address did not resolve to the cached key'
+        # a new key at the same path invalidates the cache
+        cls.add_key(key, refresh=True)
+        key2 = cls.get_key(key)
+        assert key2.ss58_address != key1.ss58_address, 'the key was not invalidated'
+        assert cls.get_key(key2.ss58_address) is key2
+        cls.rm_key(key)
+        return {'success': True, 'msg': 'test_key_cache passed'}
+
     @classmethod
     def getmem(cls, key):
     
@@ -5,6 +5,8 @@ from typing import Union, Optional, List
 import os, sys
 from typing import *
 from loguru import logger
+import concurrent.futures
+import queue
 import torch
 from torch import nn
 import commune as c
@@ -25,6 +27,9 @@ class ModelTransformer(Model):
                  max_new_tokens: int = 256,
                  load: bool = False,  # Assuming load is a boolean
                  quantize: str = None,
+                 batching: bool = False, # batch concurrent generate calls into shared forward passes
+                 batch_window: float = 0.005, # seconds to wait for requests to join a new batch
+                 max_batch_size: int = 32, # max sequences decoded together
                  test:bool = True): # OPTIONS = ['int4', 'int8', None]
 
         # Here you would initial
@@ -477,31 +482,319 @@ class ModelTransformer(Model):
     
 
 
-    def generate_stream(self, text: str, 
-                max_length: int = 20, 
-                max_new_tokens: int = None,
-                min_length: int = 0, 
-                min_new_tokens: int = None,
-                early_stopping: bool = True,
-                max_time: float = None,
-                chunk_size: int = 10,
-                **kwargs) -> List[str]:
-        if isinstance(text, str):
-            text = [text]
+    def sample_token(self, logits: torch.Tensor, temperature: float = 0.0, top_p: float = 1.0) -> torch.Tensor:
+        """
+        logits: [batch, vocab] of the last position
+        greedy when temperature is 0, otherwise nucleus sampling
+        """
+        if temperature <= 0:
+            return torch.argmax(logits, dim=-1)
+        probs = torch.softmax(logits / temperature, dim=-1)
+        if top_p < 1.0:
+            sorted_probs, sorted_idx = torch.sort(probs, dim=-1, descending=True)
+            # drop the tokens after the cumulative probability passes top_p (keeping at least one)
+            drop = torch.cumsum(sorted_probs, dim=-1) - sorted_probs > top_p
+            sorted_probs[drop] = 0
+            probs = torch.zeros_like(probs).scatter_(-1, sorted_idx, sorted_probs)
+        return torch.multinomial(probs, num_samples=1).squeeze(-1)
 
-         
-        input_ids = self.tokenize(text)['input_ids']
+    @staticmethod
+    def stop_prefix_length(text: str, stop: List[str]) -> int:
+        # the longest end of the text that could be the start of a stop sequence
+        n = 0
+        for s in stop:
+            for k in range(min(len(s) - 1, len(text)), n, -1):
+                if text.endswith(s[:k]):
+                    n = k
+                    break
+        return n
+
+    @torch.no_grad()
+    def generate_stream(self, text: str, 
+                max_new_tokens: int = 256,
+                max_length: int = 512,
+                temperature: float = 0.0,
+                top_p: float = 1.0,
+                stop: Union[str, List[str]] = None,
+                skip_special_tokens: bool = True,
+                **kwargs) -> Iterator[str]:
+        """
+        Yields the new text as it is generated (the deltas, not the full text)
+        The kv cache (past_key_values) is kept between steps, so each step only runs the last token
+        stop: stops when the output contains one of these, the stop sequence is not yielded
+        """
+        if isinstance(text, list):
+            assert len(text) == 1, 'generate_stream takes one text, use generate for batches'
+            text = text[0]
+        max_new_tokens = min(max_new_tokens, self.config.max_new_tokens)
+        max_length = min(max_length, self.config.max_length)
+        stop = [stop] if isinstance(stop, str) else (stop or [])
+
+        sample = self.tokenize([text], max_length=max_length)
+        input_ids = sample['input_ids']
+        attention_mask = sample['attention_mask']
+        past_key_values = None
+        eos_token_id = self.tokenizer.eos_token_id
+
+        output_ids = []
+        output_text = ''
+        yielded = 0 # the number of characters of output_text that were yielded
+        # incremental decoding, only the tokens after prefix_offset are decoded each step
+        # (a few tokens of context, so merges and spaces across the token boundary decode right)
+        prefix_offset, read_offset = 0, 0
+        max_stop_length = max([len(s) for s in stop] + [0])
+        stopped = False
         for i in range(max_new_tokens):
-            output_ids = self.model.generate(input_ids, 
-                                            max_length=max_length, 
-                                            max_new_tokens=chunk_size,
-                                            min_length=min_length, 
-                                            min_new_tokens=min_new_tokens,
-                                            early_stopping=early_stopping,
-                                            max_time=max_time, **kwargs)
-            output_text = self.decode(output_ids)
-            yield output_text
-            text = output_text
+            output = self.model(input_ids=input_ids, 
+                                attention_mask=attention_mask, 
+                                past_key_values=past_key_values, 
+                                use_cache=True)
+            past_key_values = output.past_key_values
+            next_token = self.sample_token(output.logits[:, -1, :], temperature=temperature, top_p=top_p)
+            if next_token.item() == eos_token_id:
+                break
+            output_ids.append(next_token.item())
+            # only the new token goes in next step, the rest is in the cache
+            input_ids = next_token.view(1, 1)
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones((1, 1))], dim=-1)
+
+            prefix_text = self.tokenizer.decode(output_ids[prefix_offset:read_offset], skip_special_tokens=skip_special_tokens)
+            new_text = self.tokenizer.decode(output_ids[prefix_offset:], skip_special_tokens=skip_special_tokens)
+            if len(new_text) <= len(prefix_text) or new_text.endswith('\ufffd'):
+                # a partial utf-8 character, wait for the next token
+                continue
+            search_start = max(len(output_text) - max_stop_length, 0)
+            output_text += new_text[len(prefix_text):]
+            prefix_offset, read_offset = read_offset, len(output_ids)
+            # a stop sequence can only start in the last max_stop_length characters before the new text
+            stop_idx = [output_text.find(s, search_start) for s in stop if s in output_text[search_start:]]
+            if len(stop_idx) > 0:
+                output_text = output_text[:min(stop_idx)]
+                stopped = True
+                break
+            # hold back what could be the start of a stop sequence
+            end = len(output_text) - self.stop_prefix_length(output_text, stop)
+            if end > yielded:
+                yield output_text[yielded:end]
+                yielded = end
+        if not stopped and read_offset < len(output_ids):
+            # the tokens still held back as a partial character
+            prefix_text = self.tokenizer.decode(output_ids[prefix_offset:read_offset], skip_special_tokens=skip_special_tokens)
+            output_text += self.tokenizer.decode(output_ids[prefix_offset:], skip_special_tokens=skip_special_tokens)[len(prefix_text):]
+
+        if len(output_text) > yielded:
+            yield output_text[yielded:]
+
+    # CONTINUOUS BATCHING
+    # concurrent generate calls are decoded together, one forward pass per step for the whole batch.
+    # sequences leave the batch when they finish and new requests join between steps.
+
+    @staticmethod
+    def to_legacy_cache(cache) -> List[tuple]:
+        if hasattr(cache, 'to_legacy_cache'):
+            cache = cache.to_legacy_cache()
+        return [tuple(layer) for layer in cache]
+
+    @staticmethod
+    def from_legacy_cache(cache: List[tuple]):
+        try:
+            from transformers import DynamicCache
+            return DynamicCache.from_legacy_cache(tuple(cache))
+        except ImportError:
+            return tuple(cache)
+
+    @staticmethod
+    def left_pad(x: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+        pad = length - x.shape[dim]
+        if pad <= 0:
+            return x
+        shape = list(x.shape)
+        shape[dim] = pad
+        return torch.cat([x.new_zeros(shape), x], dim=dim)
+
+    def merge_batches(self, a: dict, b: dict) -> dict:
+        """
+        concatenates two batches {cache, mask}, the shorter one is padded on the left (masked out)
+        """
+        if a == None or b == None:
+            return b if a == None else a
+        length = max(a['mask'].shape[1], b['mask'].shape[1])
+        cache = []
+        for (ka, va), (kb, vb) in zip(a['cache'], b['cache']):
+            cache.append((torch.cat([self.left_pad(ka, length, -2), self.left_pad(kb, length, -2)], dim=0),
+                          torch.cat([self.left_pad(va, length, -2), self.left_pad(vb, length, -2)], dim=0)))
+        mask = torch.cat([self.left_pad(a['mask'], length, 1), self.left_pad(b['mask'], length, 1)], dim=0)
+        return {'cache': cache, 'mask': mask}
+
+    def select_batch(self, batch: dict, idx: List[int]) -> dict:
+        """
+        keeps the rows in idx and drops the padding columns no row uses anymore
+        """
+        if len(idx) == 0:
+            return None
+        idx = torch.tensor(idx, device=batch['mask'].device)
+        mask = batch['mask'].index_select(0, idx)
+        start = int((mask.sum(0) > 0).nonzero()[0])
+        cache = [(k.index_select(0, idx)[..., start:, :], v.index_select(0, idx)[..., start:, :]) for k, v in batch['cache']]
+        return {'cache': cache, 'mask': mask[:, start:]}
+
+    def add_token(self, request: dict, token: int) -> bool:
+        """
+        adds the sampled token to the request, returns True if the request is finished
+        """
+        if token == self.tokenizer.eos_token_id:
+            return True
+        request['output_ids'].append(token)
+        if len(request['stop']) > 0:
+            text = self.tokenizer.decode(request['output_ids'], skip_special_tokens=True)
+            if any([s in text for s in request['stop']]):
+                return True
+        return len(request['output_ids']) >= request['max_new_tokens']
+
+    def finish_request(self, request: dict):
+        text = self.tokenizer.decode(request['output_ids'], skip_special_tokens=True)
+        stop_idx = [text.find(s) for s in request['stop'] if s in text]
+        if len(stop_idx) > 0:
+            text = text[:min(stop_idx)]
+        request['future'].set_result(text)
+
+    def prefill(self, requests: List[dict]) -> dict:
+        """
+        runs the prompts of the new requests and samples their first token
+        """
+        batch = None
+        for request in requests:
+            sample = self.tokenize([request['text']], max_length=request['max_length'], padding=False)
+            output = self.model(**sample, use_cache=True)
+            token = self.sample_token(output.logits[:, -1, :], temperature=request['temperature'], top_p=request['top_p'])
+            request['token'] = token.item()
+            batch = self.merge_batches(batch, {'cache': self.to_legacy_cache(output.past_key_values), 'mask': sample['attention_mask']})
+        return batch
+
+    def batch_loop(self):
+        active = [] # the requests in the batch, in the order of the batch rows
+        batch = None
+        while True:
+            # collect the requests that arrived, block (then wait the window) when idle
+            new_requests = []
+            if len(active) == 0:
+                new_requests.append(self.batch_queue.get())
+                deadline = c.time() + self.config.batch_window
+                while len(new_requests) < self.config.max_batch_size:
+                    try:
+                        new_requests.append(self.batch_queue.get(timeout=max(deadline - c.time(), 0)))
+                    except queue.Empty:
+                        break
+            else:
+                while len(active) + len(new_requests) < self.config.max_batch_size:
+                    try:
+                        new_requests.append(self.batch_queue.get_nowait())
+                    except queue.Empty:
+                        break
+            try:
+                with torch.no_grad():
+                    if len(new_requests) > 0:
+                        new_batch = self.prefill(new_requests)
+                        keep = []
+                        for i, request in enumerate(new_requests):
+                            # the first token might already finish the request
+                            if self.add_token(request, request['token']):
+                                self.finish_request(request)
+                            else:
+                                keep.append(i)
+                        batch = self.merge_batches(batch, self.select_batch(new_batch, keep))
+                        active += [new_requests[i] for i in keep]
+                    if len(active) == 0:
+                        continue
+
+                    # one decode step for the whole batch
+                    input_ids = torch.tensor([[r['token']] for r in active], device=batch['mask'].device)
+                    mask = torch.cat([batch['mask'], batch['mask'].new_ones((len(active), 1))], dim=1)
+                    position_ids = mask.sum(dim=1, keepdim=True) - 1
+                    output = self.model(input_ids=input_ids, 
+                                        attention_mask=mask,
+                                        position_ids=position_ids,
+                                        past_key_values=self.from_legacy_cache(batch['cache']), 
+                                        use_cache=True)
+                    batch = {'cache': self.to_legacy_cache(output.past_key_values), 'mask': mask}
+                    logits = output.logits[:, -1, :]
+                    keep = []
+                    for i, request in enumerate(active):
+                        request['token'] = self.sample_token(logits[i:i+1], temperature=request['temperature'], top_p=request['top_p']).item()
+                        if self.add_token(request, request['token']):
+                            self.finish_request(request)
+                        else:
+                            keep.append(i)
+                    if len(keep) < len(active):
+                        batch = self.select_batch(batch, keep)
+                        active = [active[i] for i in keep]
+            except Exception as e:
+                # fail every request in the batch, the loop keeps serving new ones
+                for request in active + new_requests:
+                    if not request['future'].done():
+                        request['future'].set_exception(e)
+                active, batch = [], None
+
+    def start_batching(self):
+        if getattr(self, 'batch_thread', None) == None:
+            self.batch_queue = queue.Queue()
+            self.batch_thread = c.thread(self.batch_loop)
+        return {'success': True, 'max_batch_size': self.config.max_batch_size, 'batch_window': self.config.batch_window}
+
+    def batch_generate(self, text: Union[str, List[str]], 
+                       max_new_tokens: int = 256,
+                       max_length: int = 512,
+                       temperature: float = 0.0,
+                       top_p: float = 1.0,
+                       stop: Union[str, List[str]] = None,
+                       timeout: float = None,
+                       **kwargs) -> Union[str, List[str]]:
+        """
+        queues the texts for the batching loop and waits for their outputs
+        the batching loop samples itself, so the other generate kwargs are not supported
+        """
+        if len(kwargs) > 0:
+            raise ValueError(f'batch_generate does not support {list(kwargs.keys())}, use generate_nonbatched')
+        self.start_batching()
+        is_string = isinstance(text, str)
+        texts = [text] if is_string else text
+        futures = []
+        for t in texts:
+            future = concurrent.futures.Future()
+            self.batch_queue.put({'text': t, 
+                                  'max_new_tokens': min(max_new_tokens, self.config.max_new_tokens),
+                                  'max_length': min(max_length, self.config.max_length),
+                                  'temperature': temperature,
+                                  'top_p': top_p,
+                                  'stop': [stop] if isinstance(stop, str) else (stop or []),
+                                  'output_ids': [],
+                                  'future': future})
+            futures.append(future)
+        outputs = [f.result(timeout=timeout) for f in futures]
+        return outputs[0] if is_string else outputs
+
+    @classmethod
+    def test_batching(cls, model:str = 'gpt2', concurrency:List[int] = [1, 8, 32], max_new_tokens:int = 32, text:str = 'The meaning of life is'):
+        """
+        tokens per second of concurrent generate calls, with batching and with model.generate per call
+        """
+        self = cls(model=model, test=False, batching=True)
+        results = []
+        for n in concurrency:
+            for batching in [False, True]:
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=n)
+                t = c.time()
+                fn = self.batch_generate if batching else self.generate_nonbatched
+                futures = [executor.submit(fn, text, max_new_tokens=max_new_tokens) for i in range(n)]
+                outputs = [f.result() for f in futures]
+                latency = c.time() - t
+                executor.shutdown()
+                tokens = sum([len(self.tokenizer.encode(o)) for o in outputs])
+                results.append({'concurrency': n, 'batching': batching, 'tokens_per_second': tokens / latency, 'latency': latency})
+        return c.df(results)
+
+    # the kwargs the batching loop handles, generate falls back to model.generate for the others
+    batch_generate_kwargs = ['temperature', 'top_p', 'stop', 'timeout']
 
     hf = c.module('hf')()
     def generate(self, text: str, 
@@ -515,7 +808,16 @@ class ModelTransformer(Model):
             return self.generate_stream(text, 
                                         max_new_tokens=max_new_tokens, 
                                         early_stopping=early_stopping, **kwargs)
+        if self.config.get('batching', False) and all([k in self.batch_generate_kwargs for k in kwargs]):
+            return self.batch_generate(text, max_new_tokens=max_new_tokens, max_length=max_length, **kwargs)
+        return self.generate_nonbatched(text, max_new_tokens=max_new_tokens, max_length=max_length, early_stopping=early_stopping, **kwargs)
 
+    def generate_nonbatched(self, text: str, 
+                max_new_tokens: int = 1000,
+                max_length: int = 512, 
+                early_stopping: bool = True,
+                **kwargs) -> List[str]:
+        # model.generate per call, also the baseline for test_batching
         is_string = isinstance(text, str)
         if is_string:
             text = [text]
@@ -554,6 +856,17 @@ class ModelTransformer(Model):
         output_text = self.generate(text=text, max_new_tokens=100, early_stopping=False)
         return output_text
 
+    def test_generate_stream(self, text='hey whadup fam?', max_new_tokens=32):
+        t = c.time()
+        deltas = []
+        time_to_first_token = None
+        for delta in self.generate_stream(text, max_new_tokens=max_new_tokens):
+            if len(deltas) == 0:
+                time_to_first_token = c.time() - t
+            deltas.append(delta)
+        assert all([isinstance(d, str) for d in deltas])
+        return {'success': True, 'text': ''.join(deltas), 'time_to_first_token': time_to_first_token, 'latency': c.time() - t}
+
     @classmethod
     def test_encode(cls, model='gpt2.7b', text='Whadup?', **kwargs):
         '''
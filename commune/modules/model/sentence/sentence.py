@@ -1,28 +1,188 @@
 
 import commune as c
+import os
+import atexit
+import json
+import queue
+import hashlib
+import threading
+import numpy as np
+import concurrent.futures
+from collections import OrderedDict
 
 
 class Sentence(c.Module):
-    def __init__(self, 
+    def __init__(self,
                 config=None,
                   **kwargs):
         config = self.set_config(config=config, kwargs=kwargs)
         self.set_model(model=config.model, device=config.device)
-    
+        self.set_cache(cache_size=config.cache_size, cache_path=config.cache_path, disk_cache_size=config.disk_cache_size)
+        self.batch_queue = None
+
     def set_model(self, model:str, device:str):
         from sentence_transformers import SentenceTransformer
         self.model = SentenceTransformer(model, device=device)
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    # CACHE
+    # embeddings are keyed by the hash of the text and the encode kwargs,
+    # an in memory lru in front of an optional memmap on disk
+
+    def set_cache(self, cache_size:int = 100000, cache_path:str = None, disk_cache_size:int = 1000000):
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_lock = threading.Lock()
+        self.cache_stats = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+        self.disk_cache = None
+        self.last_saved = c.time()
+        if cache_path != None:
+            cache_path = self.resolve_path(cache_path)
+            os.makedirs(cache_path, exist_ok=True)
+            vectors_path = os.path.join(cache_path, 'vectors.npy')
+            if os.path.exists(vectors_path):
+                vectors = np.lib.format.open_memmap(vectors_path, mode='r+')
+            else:
+                vectors = np.lib.format.open_memmap(vectors_path, mode='w+', dtype=np.float32, shape=(disk_cache_size, self.dim))
+            self.disk_cache = {
+                'path': cache_path,
+                'vectors': vectors,
+                'index': self.get_json(os.path.join(cache_path, 'index'), default={'hash2row': {}, 'row2hash': {}, 'count': 0}),
+                'size': len(vectors),
+            }
+            # the index only reaches the disk on save, so it is also saved on exit
+            atexit.register(self.save_cache)
+        return {'cache_size': cache_size, 'cache_path': cache_path}
+
+    @staticmethod
+    def hash_text(text:str, kwargs:dict) -> str:
+        return hashlib.sha256((text + json.dumps(kwargs, sort_keys=True, default=str)).encode()).hexdigest()
+
+    def cache_get(self, key:str):
+        with self.cache_lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.cache_stats['hits'] += 1
+                return self.cache[key]
+            if self.disk_cache != None and key in self.disk_cache['index']['hash2row']:
+                embedding = np.array(self.disk_cache['vectors'][self.disk_cache['index']['hash2row'][key]])
+                self.cache_stats['disk_hits'] += 1
+                self.cache_put(key, embedding, disk=False)
+                return embedding
+            self.cache_stats['misses'] += 1
+        return None
+
+    def cache_put(self, key:str, embedding:np.ndarray, disk:bool = True):
+        # called with the cache lock held
+        self.cache[key] = embedding
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        if disk and self.disk_cache != None:
+            # the disk cache is a ring, the oldest row is overwritten when it is full
+            index = self.disk_cache['index']
+            row = index['count'] % self.disk_cache['size']
+            index['hash2row'].pop(index['row2hash'].get(str(row), None), None)
+            self.disk_cache['vectors'][row] = embedding
+            index['hash2row'][key] = row
+            index['row2hash'][str(row)] = key
+            index['count'] += 1
+
+    def save_cache(self):
+        if self.disk_cache != None:
+            with self.cache_lock:
+                self.disk_cache['vectors'].flush()
+                self.put_json(os.path.join(self.disk_cache['path'], 'index'), self.disk_cache['index'])
+                self.last_saved = c.time()
+        return {'success': True, **self.cache_stats}
+
+    def sync_cache(self):
+        # saves the disk cache if it has not been saved in the last save_interval seconds
+        if self.disk_cache != None and c.time() - self.last_saved > self.config.save_interval:
+            self.save_cache()
 
-    def forward(self, text, **kwargs):
+    # BATCHING
+    # concurrent forward calls are coalesced into one model.encode call
+
+    def batch_loop(self):
+        while True:
+            requests = [self.batch_queue.get()]
+            deadline = c.time() + self.config.batch_window
+            n = len(requests[0]['texts'])
+            while n < self.config.batch_size:
+                try:
+                    request = self.batch_queue.get(timeout=max(deadline - c.time(), 0))
+                except queue.Empty:
+                    break
+                requests.append(request)
+                n += len(request['texts'])
+            # requests with the same encode kwargs share a batch
+            groups = {}
+            for request in requests:
+                groups.setdefault(json.dumps(request['kwargs'], sort_keys=True, default=str), []).append(request)
+            for group in groups.values():
+                texts = list(dict.fromkeys([t for r in group for t in r['texts']]))
+                try:
+                    kwargs = {'batch_size': self.config.batch_size, **group[0]['kwargs']}
+                    embeddings = self.model.encode(texts, **kwargs)
+                    text2embedding = dict(zip(texts, embeddings))
+                    for request in group:
+                        request['future'].set_result([text2embedding[t] for t in request['texts']])
+                except Exception as e:
+                    for request in group:
+                        request['future'].set_exception(e)
+
+    def encode(self, texts:list, **kwargs) -> list:
+        if not self.config.batching:
+            return list(self.model.encode(texts, **kwargs))
+        if self.batch_queue == None:
+            self.batch_queue = queue.Queue()
+            c.thread(self.batch_loop)
+        future = concurrent.futures.Future()
+        self.batch_queue.put({'texts': texts, 'kwargs': kwargs, 'future': future})
+        return future.result()
+
+    def quantize(self, embeddings:np.ndarray, dtype:str = 'float32'):
+        """
+        float16, or int8 with one scale per vector (embedding ~= int8 * scale)
+        """
+        if dtype == 'float32':
+            return embeddings.astype(np.float32)
+        elif dtype == 'float16':
+            return embeddings.astype(np.float16)
+        elif dtype == 'int8':
+            scales = np.abs(embeddings).max(axis=-1, keepdims=True) / 127
+            scales[scales == 0] = 1
+            return {'embeddings': np.round(embeddings / scales).astype(np.int8), 'scales': scales.astype(np.float32)}
+        else:
+            raise ValueError(f'Invalid dtype {dtype}, use float32, float16 or int8')
+
+    def forward(self, text, dtype:str = None, convert_to_tensor:bool = False, **kwargs):
         initially_string = isinstance(text, str)
         if initially_string:
             text = [text]
         assert isinstance(text, list)
         assert isinstance(text[0], str)
-        embeddings = self.model.encode(text, **kwargs)
+        keys = [self.hash_text(t, kwargs) for t in text]
+        embeddings = [self.cache_get(k) for k in keys]
+        missing = [i for i, e in enumerate(embeddings) if e is None]
+        if len(missing) > 0:
+            new_embeddings = self.encode([text[i] for i in missing], **kwargs)
+            with self.cache_lock:
+                for i, embedding in zip(missing, new_embeddings):
+                    embeddings[i] = embedding
+                    self.cache_put(keys[i], embedding)
+            self.sync_cache()
+        embeddings = self.quantize(np.stack(embeddings), dtype=dtype or self.config.dtype)
+        if convert_to_tensor:
+            # the cache holds numpy arrays, the tensors are made on the way out
+            import torch
+            to_tensor = lambda x: torch.from_numpy(x).to(self.model.device)
+            embeddings = {k: to_tensor(v) for k,v in embeddings.items()} if isinstance(embeddings, dict) else to_tensor(embeddings)
         if initially_string:
-            embeddings = embeddings[0]
+            embeddings = {k: v[0] for k,v in embeddings.items()} if isinstance(embeddings, dict) else embeddings[0]
         return embeddings
+
     def test(self):
         sentences = ["This is an example sentence", "Each sentence is converted"]
         embeddings = self.model.encode(sentences)
@@ -31,5 +191,18 @@ class Sentence(c.Module):
         embeddings = self.model.encode(sentences)
         c.print(embeddings.shape)
         return embeddings
-    
-    
+
+    def test_forward(self, n:int = 64):
+        sentences = [f'This is sentence {i}' for i in range(n)]
+        futures = [c.submit(self.forward, args=[s]) for s in sentences]
+        embeddings = c.wait(futures, timeout=60)
+        assert all([e.shape == (self.dim,) for e in embeddings])
+        # the second time they come from the cache
+        assert np.allclose(self.forward(sentences), np.stack(embeddings))
+        q = self.forward(sentences, dtype='int8')
+        assert np.abs(q['embeddings'] * q['scales'] - np.stack(embeddings)).max() < 0.01
+        t = self.forward(sentences, convert_to_tensor=True)
+        assert np.allclose(t.cpu().numpy(), np.stack(embeddings))
+        return {'success': True, **self.cache_stats}
+
+
@@ -1,5 +1,8 @@
 import commune as c
 from typing import *
+import os
+import json
+import threading
 
 # THIS IS WHAT THE INTERNET IS, A BUNCH OF NAMESPACES, AND A BUNCH OF SERVERS, AND A BUNCH OF MODULES.
 # THIS IS THE INTERNET OF INTERNETS.
@@ -7,27 +10,113 @@ class Namespace(c.Module):
 
     # the default
     network : str = 'local'
+    # path -> (file version, namespace), reloaded only when the file changes
+    namespace_cache = {}
+    cache_lock = threading.Lock()
+
+    @classmethod
+    def namespace_path(cls, network:str) -> str:
+        return cls.resolve_path(network, extension='json')
+
+    @classmethod
+    def file_version(cls, path:str) -> Optional[tuple]:
+        # writes go through a rename, so the inode changes on every write
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    @classmethod
+    def read_namespace(cls, network:str, strict:bool = False) -> dict:
+        """
+        the namespace from the in process cache, a stat call when the file did not change
+        strict: raise on a corrupt file instead of reading it as empty (so a write does not replace it)
+        """
+        path = cls.namespace_path(network)
+        version = cls.file_version(path)
+        if version == None:
+            return {}
+        cached = cls.namespace_cache.get(path)
+        if cached != None and cached[0] == version:
+            return cached[1]
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError as e:
+            if strict:
+                raise ValueError(f'Namespace file {path} is corrupt, fix or remove it ({e})')
+            return {}
+        # same format as cls.put
+        if isinstance(data, dict) and 'data' in data:
+            data = data['data']
+        namespace = data if isinstance(data, dict) else {}
+        with cls.cache_lock:
+            cls.namespace_cache[path] = (version, namespace)
+        return namespace
+
+    @classmethod
+    def write_namespace(cls, network:str, namespace:dict) -> str:
+        """
+        writes to a temp file and renames it over the namespace, so readers never see a partial file
+        """
+        path = cls.namespace_path(network)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        data = {'data': namespace, 'encrypted': False, 'timestamp': c.timestamp()}
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        with cls.cache_lock:
+            cls.namespace_cache[path] = (cls.file_version(path), namespace)
+        return path
+
+    @classmethod
+    def modify_namespace(cls, network:str, fn:Callable) -> dict:
+        """
+        read-modify-write of the namespace under a file lock, 
+        so servers registering at the same time do not overwrite each other
+        fn: takes the namespace and returns the new namespace
+        """
+        path = cls.namespace_path(network)
+        with open(path + '.lock', 'w') as lock:
+            cls.lock_file(lock)
+            try:
+                namespace = fn(dict(cls.read_namespace(network, strict=True)))
+                assert isinstance(namespace, dict), 'Namespace must be a dict.'
+                # one name per address
+                address2name = {v: k for k, v in namespace.items()}
+                namespace = {v:k for k,v in address2name.items()}
+                cls.write_namespace(network, namespace)
+            finally:
+                cls.unlock_file(lock)
+        return namespace
 
     @classmethod
     def register_server(cls, name:str, address:str, network=network) -> None:
-        namespace = cls.get_namespace(network=network)
-        namespace[name] = address
-        cls.put_namespace(network, namespace)
+        def register(namespace):
+            namespace[name] = address
+            return namespace
+        cls.modify_namespace(network, register)
         return {'success': True, 'msg': f'Block {name} registered to {network}.'}
     
     
     @classmethod
     def deregister_server(cls, name:str, network=network) -> Dict:
-
-        namespace = cls.get_namespace(network=network)
-        address2name = {v: k for k, v in namespace.items()}
-        if name in address2name:
-            name = address2name[name]
-        
-        if name in namespace:
-            del namespace[name]
-            cls.put_namespace(network, namespace)
-            return {'status': 'success', 'msg': f'Block {name} deregistered.'}
+        removed = []
+        def deregister(namespace):
+            address2name = {v: k for k, v in namespace.items()}
+            server = address2name.get(name, name)
+            if server in namespace:
+                del namespace[server]
+                removed.append(server)
+            return namespace
+        cls.modify_namespace(network, deregister)
+        if len(removed) > 0:
+            return {'status': 'success', 'msg': f'Block {removed[0]} deregistered.'}
         else:
             return {'success': False, 'msg': f'Block {name} not found.'}
     
@@ -71,7 +160,7 @@ class Namespace(c.Module):
         else:
             if update:
                 cls.update_namespace(network=network, full_scan=bool(network=='local'))
-            namespace = cls.get(network, {})
+            namespace = cls.read_namespace(network)
         if search != None:
             namespace = {k:v for k,v in namespace.items() if search in k}
 
@@ -88,10 +177,7 @@ class Namespace(c.Module):
     def put_namespace(cls, network:str, namespace:dict = None) -> None:
         if namespace == None:
             namespace = cls.get_namespace(network=network)
-        address2name = {v: k for k, v in namespace.items()}
-        namespace = {v:k for k,v in address2name.items()}
-        assert isinstance(namespace, dict), 'Namespace must be a dict.'
-        cls.put(network, namespace)
+        cls.modify_namespace(network, lambda _: dict(namespace))
         return {'success': False, 'msg': f'Namespace {network} updated.'}
     
     add_namespace = put_namespace
@@ -101,6 +187,7 @@ class Namespace(c.Module):
     def rm_namespace(cls,network:str) -> None:
         if cls.exists(network):
             cls.rm(network)
+            cls.namespace_cache.pop(cls.namespace_path(network), None)
             return {'success': True, 'msg': f'Namespace {network} removed.'}
         else:
             return {'success': False, 'msg': f'Namespace {network} not found.'}
@@ -122,7 +209,7 @@ class Namespace(c.Module):
     
     @classmethod
     def networks(cls) -> dict:
-        return [p.split('/')[-1].split('.')[0] for p in cls.ls()]
+        return list(set([p.split('/')[-1].split('.')[0] for p in cls.ls() if p.endswith('.json')]))
     
     @classmethod
     def namespace_exists(cls, network:str) -> bool:
@@ -143,10 +230,112 @@ class Namespace(c.Module):
         return bool(module in namespace)
     
 
+    # DISCOVERY
+    # scanned ports that did not accept a connection -> time until they are probed again
+    negative_cache = {}
+    negative_ttl = 10
+
+    @classmethod
+    async def probe_server(cls, address:str, timeout:int = 10, connect_timeout:float = 0.5, use_cache:bool = True) -> Optional[str]:
+        """
+        the server name at the address, or None
+        a tcp connect with a short timeout filters the closed ports before the (slower) server_name call
+        use_cache: skip addresses that refused a connection in the last negative_ttl seconds
+        """
+        import asyncio
+        expiry = cls.negative_cache.get(address)
+        if use_cache and expiry != None and expiry > c.time():
+            return None
+        ip, port = address.split('://')[-1].split(':')[:2]
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, int(port)), timeout=connect_timeout)
+            writer.close()
+        except (asyncio.TimeoutError, OSError, ValueError):
+            cls.negative_cache[address] = c.time() + cls.negative_ttl
+            return None
+        try:
+            name = await asyncio.wait_for(c.async_call(module=address, fn='server_name', timeout=timeout), timeout=timeout)
+        except Exception as e:
+            return None
+        return name if isinstance(name, str) else None
+
+    @classmethod
+    def scan_addresses(cls, network:str = network, full_scan:bool = True) -> List[str]:
+        """
+        the ports to scan for servers that are not in the namespace
+        """
+        namespace = cls.get_namespace(network=network, update=False)
+        if network != 'local' or (full_scan == False and len(namespace) > 0):
+            return []
+        known = set(namespace.values())
+        addresses = [c.default_ip+':'+str(p) for p in range(*c.port_range())]
+        return [a for a in addresses if a not in known]
+
+    @classmethod
+    async def async_update_namespace(cls,
+                        timeout:int = 10,
+                        connect_timeout:float = 0.5,
+                        max_concurrency:int = 64,
+                        flush_interval:float = 0.5,
+                        full_scan:bool = True,
+                        network:str = network)-> dict:
+        """
+        probes the candidate addresses concurrently and applies the diff to the namespace as the responses arrive
+        """
+        import asyncio
+        namespace = cls.get_namespace(network=network, update=False)
+        # the registered servers are always probed, the negative cache only skips scanned ports,
+        # so a server is never dropped because of a cached refusal
+        known = list(dict.fromkeys(namespace.values()))
+        # the connect probe is the port scan
+        scan = cls.scan_addresses(network=network, full_scan=full_scan)
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+        async def probe(address, use_cache):
+            async with semaphore:
+                return address, await cls.probe_server(address, timeout=timeout, connect_timeout=connect_timeout, use_cache=use_cache)
+
+        found = {} # address -> name
+        pending = {} # address -> name (None if it did not answer)
+        last_flush = c.time()
+        loop = asyncio.get_running_loop()
+        def write(changes):
+            def apply(namespace):
+                address2name = {v: k for k, v in namespace.items()}
+                for address, name in changes.items():
+                    old_name = address2name.get(address)
+                    if old_name != None and old_name != name:
+                        namespace.pop(old_name, None)
+                    if name != None:
+                        namespace[name] = address
+                return namespace
+            # only write when something changed
+            address2name = {v: k for k, v in cls.read_namespace(network).items()}
+            if any([address2name.get(a) != n for a, n in changes.items()]):
+                cls.modify_namespace(network, apply)
+        async def flush():
+            changes = dict(pending)
+            pending.clear()
+            # the file lock and the fsync block, so the write runs off the event loop
+            await loop.run_in_executor(None, write, changes)
+
+        probes = [probe(a, False) for a in known] + [probe(a, True) for a in scan]
+        for future in asyncio.as_completed(probes):
+            address, name = await future
+            if name != None:
+                found[address] = name
+            pending[address] = name
+            if c.time() - last_flush > flush_interval:
+                await flush()
+                last_flush = c.time()
+        await flush()
+        return {name: address for address, name in found.items()}
+
     @classmethod
     def update_namespace(cls,
-                        chunk_size:int=50, 
                         timeout:int = 10,
+                        connect_timeout:float = 0.5,
+                        max_concurrency:int = 64,
                         full_scan:bool = True,
                         network:str = network)-> dict:
         '''
@@ -154,35 +343,29 @@ class Namespace(c.Module):
         When a module is served "module.serve())"
         it will register itself with the namespace_local dictionary.
         '''
+        import math
+        coroutine = cls.async_update_namespace(timeout=timeout, 
+                                               connect_timeout=connect_timeout, 
+                                               max_concurrency=max_concurrency, 
+                                               full_scan=full_scan, 
+                                               network=network)
+        # every probe is bounded by connect_timeout + timeout and at most max_concurrency run at once
+        n = len(cls.get_namespace(network=network, update=False)) + len(cls.scan_addresses(network=network, full_scan=full_scan))
+        rounds = math.ceil(n / max_concurrency)
+        return c.gather(coroutine, timeout=rounds * (timeout + connect_timeout) + 10)
+
+    @classmethod
+    def test_update_namespace(cls, network:str = 'test_discovery'):
+        cls.rm_namespace(network)
+        cls.register_server('dead.server', f'{c.default_ip}:1', network=network)
+        t = c.time()
+        namespace = cls.update_namespace(network=network, full_scan=False, connect_timeout=0.1)
+        assert namespace == {}, namespace
+        assert cls.get_namespace(network=network) == {}, 'the dead server was not removed'
+        assert f'{c.default_ip}:1' in cls.negative_cache
+        cls.rm_namespace(network)
+        return {'success': True, 'latency': c.time() - t}
 
-        namespace = cls.get_namespace(network=network, update=False) # get local namespace from redis
-
-        addresses = c.copy(list(namespace.values()))
-        namespace = {}
-
-        if network == 'local':
-            if full_scan == True or len(addresses) == 0 and network == 'local':
-                addresses = [c.default_ip+':'+str(p) for p in c.used_ports()]
-        import asyncio
-
-        for i in range(0, len(addresses), chunk_size):
-            addresses_chunk = addresses[i:i+chunk_size]
-            futures = []
-
-            for address in addresses_chunk:
-
-                futures += [c.async_call(module=address, fn='server_name')]
-
-            names_chunk = c.gather(futures, timeout=timeout)
-            
-            for i in range(len(names_chunk)):
-                if isinstance(names_chunk[i], str):
-                    namespace[names_chunk[i]] = addresses_chunk[i]
-
-        cls.put_namespace(network, namespace)
-            
-        return namespace
-    
     @classmethod
     def migrate_namespace(cls, network:str='local'):
         namespace = c.get_json('local_namespace', {})
@@ -371,6 +554,12 @@ class Namespace(c.Module):
         assert cls.get_namespace(network=network) == {'test': 'test'}, f'Namespace not restored. {cls.get_namespace(network=network)}'
         cls.deregister_server('test', network=network2)
         assert cls.get_namespace(network2) == {}
+
+        # concurrent registrations are not lost
+        n = 20
+        futures = [c.submit(cls.register_server, kwargs=dict(name=f'test{i}', address=f'0.0.0.0:{i}', network=network2), return_future=True) for i in range(n)]
+        c.wait(futures, timeout=20)
+        assert len(cls.get_namespace(network=network2)) == n, f'Lost registrations {cls.get_namespace(network=network2)}'
         cls.rm_namespace(network)
         assert cls.namespace_exists(network) == False
         cls.rm_namespace(network2)
@@ -68,66 +68,40 @@ class Network(c.Module):
         return "/ipv%i/%s:%i" % (ip_type, ip_str, port)
 
 
+    ip_urls = ['https://ifconfig.me/ip',
+               'https://api.ipify.org', 
+               'https://checkip.amazonaws.com', 
+               'https://myip.dnsomatic.com', 
+               'https://ident.me']
+
     @classmethod
-    def get_external_ip(cls,verbose: bool = False, default_ip='') -> str:
-        r""" Checks CURL/URLLIB/IPIFY/AWS for your external ip.
+    def get_external_ip(cls,verbose: bool = False, default_ip='', timeout:float = 2) -> str:
+        r""" Checks IFCONFIG/IPIFY/AWS/DNSOMATIC/IDENT for your external ip, the first valid answer wins.
+            Args:
+                timeout (float):
+                    Seconds per endpoint, so an offline machine gives up quickly.
             Returns:
                 external_ip  (:obj:`str` `required`):
-                    Your routers external facing ip as a string.
-
-            Raises:
-                Exception(Exception):
-                    Raised if all external ip attempts fail.
+                    Your routers external facing ip as a string, default_ip if all attempts fail.
         """
-        # --- Try curl.
-        ip = '0.0.0.0'
-        try:
-            ip = c.cmd('curl -s ifconfig.me')
-            assert isinstance(cls.ip_to_int(ip), int)
-            c.print(ip, 'ifconfig.me', verbose=verbose)
-        except Exception as e:
-            c.print(e, verbose=verbose)
-
-        try:
-            ip = requests.get('https://api.ipify.org').text
-            assert isinstance(cls.ip_to_int(ip), int)
-            c.print(ip, 'ipify.org', verbose=verbose)
-        except Exception as e:
-            c.print(e, verbose=verbose)
-
-        # --- Try AWS
-        try:
-            ip = requests.get('https://checkip.amazonaws.com').text.strip()
-            assert isinstance(cls.ip_to_int(ip), int)
-        except Exception as e:
-            c.print(e, verbose=verbose)
-
-        # --- Try myip.dnsomatic 
-        try:
-            process = os.popen('curl -s myip.dnsomatic.com')
-            ip  = process.readline()
-            assert isinstance(cls.ip_to_int(ip), int)
-            process.close()
-        except Exception as e:
-            c.print(e, verbose=verbose)    
-
-        # --- Try urllib ipv6 
-        try:
-            ip = urllib.request.urlopen('https://ident.me').read().decode('utf8')
-            assert isinstance(cls.ip_to_int(ip), int)
-        except Exception as e:
-            c.print(e, verbose=verbose)
+        for url in cls.ip_urls:
+            try:
+                ip = requests.get(url, timeout=timeout).text.strip()
+                assert isinstance(cls.ip_to_int(ip), int)
+                c.print(ip, url, verbose=verbose)
+                return ip
+            except Exception as e:
+                c.print(e, verbose=verbose)
 
         # --- Try Wikipedia 
         try:
-            ip = requests.get('https://www.wikipedia.org').headers['X-Client-IP']
+            ip = requests.get('https://www.wikipedia.org', timeout=timeout).headers['X-Client-IP']
             assert isinstance(cls.ip_to_int(ip), int)
+            return ip
         except Exception as e:
             c.print(e, verbose=verbose)
 
-        if len(ip) == 0:
-            ip = default_ip
-        return ip
+        return default_ip
 
     @staticmethod
     def upnpc_create_port_map(port: int):
@@ -2,6 +2,7 @@ import commune as c
 import streamlit as st
 from typing import *
 import json
+import threading
 import paramiko
 
 class Remote(c.Module):
@@ -9,24 +10,96 @@ class Remote(c.Module):
     host_data_path = f'{c.datapath}/hosts.{filetype}'
     host_url = 'https://raw.githubusercontent.com/communeai/commune/main/hosts.yaml'
     executable_path='commune/bin/c'
-    @classmethod
-    def ssh_cmd(cls, *cmd_args, 
+    # SSH POOL
+    # one connection per host, reused by every command (each command is a new channel on its transport)
+    # with keepalives, a bounded number of concurrent channels per host, and idle connections closed
+    ssh_pool = {}
+    ssh_pool_lock = threading.Lock()
+    keepalive_interval = 30 # seconds between keepalive packets
+    idle_timeout = 300 # seconds a connection without channels is kept open
+    max_channels = 8 # concurrent commands per host (sshd MaxSessions defaults to 10)
+    evictor = None
+
+    @classmethod
+    def get_ssh_entry(cls, host_name:str, channel:bool = False) -> dict:
+        """
+        channel: count the caller as a channel of the host (until it decrements it), 
+        in the same lock as the lookup so the evictor cannot close the connection in between
+        """
+        with cls.ssh_pool_lock:
+            if host_name not in cls.ssh_pool:
+                cls.ssh_pool[host_name] = {'client': None, 
+                                          'lock': threading.Lock(), 
+                                          'semaphore': threading.BoundedSemaphore(cls.max_channels),
+                                          'channels': 0,
+                                          'last_used': c.time()}
+            if cls.evictor == None:
+                cls.evictor = c.thread(cls.evict_loop)
+            entry = cls.ssh_pool[host_name]
+            if channel:
+                entry['channels'] += 1
+            return entry
+
+    @classmethod
+    def get_ssh_client(cls, host_name:str, timeout:int = 10) -> 'paramiko.SSHClient':
+        """
+        the pooled client of the host, connected on first use and reconnected if the transport died
+        """
+        entry = cls.get_ssh_entry(host_name)
+        # one handshake per host at a time
+        with entry['lock']:
+            client = entry['client']
+            if client == None or client.get_transport() == None or not client.get_transport().is_active():
+                if client != None:
+                    client.close()
+                host = cls.hosts()[host_name]
+                client = paramiko.SSHClient()
+                # Automatically add the server's host key (this is insecure and used for demonstration; 
+                # in production, you should have the remote server's public key in known_hosts)
+                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                client.connect(host['host'],
+                               port=host['port'], 
+                               username=host['user'], 
+                               password=host['pwd'],
+                               timeout=timeout)
+                client.get_transport().set_keepalive(cls.keepalive_interval)
+                entry['client'] = client
+            entry['last_used'] = c.time()
+            return client
+
+    @classmethod
+    def close_ssh_client(cls, host_name:str):
+        with cls.ssh_pool_lock:
+            entry = cls.ssh_pool.pop(host_name, None)
+        if entry != None and entry['client'] != None:
+            entry['client'].close()
+
+    @classmethod
+    def evict_loop(cls, interval:int = 10):
+        while True:
+            c.sleep(interval)
+            # checked and removed in one step, so a command that just took the entry keeps its connection
+            with cls.ssh_pool_lock:
+                idle = {h: e for h, e in cls.ssh_pool.items() if e['channels'] == 0 and c.time() - e['last_used'] > cls.idle_timeout}
+                for host_name in idle:
+                    cls.ssh_pool.pop(host_name)
+            for host_name, entry in idle.items():
+                c.print(f'Closing idle ssh connection to {host_name}', color='yellow')
+                if entry['client'] != None:
+                    entry['client'].close()
+
+    @classmethod
+    def ssh_stream(cls, *cmd_args, 
                 host:str= None,  
                 cwd:str=None, 
-                verbose=False, 
                 sudo=False, 
-                key=None, 
-                timeout=10,  
-                **kwargs ):
-        """s
-        Run a command on a remote server using Remote.
-
-        :param host: Hostname or IP address of the remote machine.
-        :param port: Remote port (typically 22).
-        :param username: Remote username.
-        :param password: Remote password.
-        :param command: Command to be executed on the remote machine.
-        :return: Command output.
+                timeout=10,
+                stderr:bool = False,
+                labeled:bool = False,
+                **kwargs ) -> Generator[str, None, None]:
+        """
+        runs the command on the host and yields the stdout lines as they arrive (then the stderr lines if stderr)
+        labeled: yield (stdout|stderr, line) 
         """
         command = ' '.join(cmd_args).strip()
         
@@ -36,60 +109,80 @@ class Remote(c.Module):
         if cwd != None:
             command = f'cd {cwd} && {command}'
 
-        
         hosts = cls.hosts()
         host_name = host
         if host_name == None:
-            host = c.choice(list(hosts.keys()))
-            host_name = host
+            host_name = c.choice(list(hosts.keys()))
         if host_name not in hosts:
             raise Exception(f'Host {host_name} not found')
         host = hosts[host_name]
 
-        # Create an Remote client instance.
-        client = paramiko.SSHClient()
-
-        # Automatically add the server's host key (this is insecure and used for demonstration; 
-        # in production, you should have the remote server's public key in known_hosts)
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                
-        # Connect to the remote server
-        client.connect(host['host'],
-                       port=host['port'], 
-                       username=host['user'], 
-                       password=host['pwd'])
-        
         if sudo and host['user'] != "root":
             command = "sudo -S -p '' %s" % command
-        stdin, stdout, stderr = client.exec_command(command)
 
+        entry = cls.get_ssh_entry(host_name, channel=True)
         try:
-            if sudo:
-                stdin.write(host['pwd'] + "\n")
-                stdin.flush()
-            color = c.random_color()
-            # Print the output of ls command
-            outputs = {'error': '', 'output': ''}
-
-            for line in stdout.readlines():
-                if verbose:
-                    c.print(f'[bold]{host_name}[/bold]', line.strip('\n'), color=color)
-                outputs['output'] += line
+            with entry['semaphore']:
+                client = None
+                try:
+                    client = cls.get_ssh_client(host_name, timeout=timeout)
+                    stdin, stdout, stderr_file = client.exec_command(command)
+                except (paramiko.SSHException, EOFError, OSError) as e:
+                    # the pooled connection died, reconnect once
+                    c.print(f'Reconnecting to {host_name} ({e})', color='yellow')
+                    with entry['lock']:
+                        if client != None and entry['client'] is client:
+                            client.close()
+                            entry['client'] = None
+                    client = cls.get_ssh_client(host_name, timeout=timeout)
+                    stdin, stdout, stderr_file = client.exec_command(command)
+                if sudo:
+                    stdin.write(host['pwd'] + "\n")
+                    stdin.flush()
+                for line in stdout:
+                    yield ('stdout', line) if labeled else line
+                if stderr:
+                    for line in stderr_file:
+                        yield ('stderr', line) if labeled else line
+        finally:
+            with cls.ssh_pool_lock:
+                entry['channels'] -= 1
+                entry['last_used'] = c.time()
+
+    @classmethod
+    def ssh_cmd(cls, *cmd_args, 
+                host:str= None,  
+                cwd:str=None, 
+                verbose=False, 
+                sudo=False, 
+                key=None, 
+                timeout=10,  
+                **kwargs ):
+        """s
+        Run a command on a remote server using Remote.
 
-            for line in stderr.readlines():
+        :param host: Hostname or IP address of the remote machine.
+        :param port: Remote port (typically 22).
+        :param username: Remote username.
+        :param password: Remote password.
+        :param command: Command to be executed on the remote machine.
+        :return: Command output.
+        """
+        host_name = host or c.choice(list(cls.hosts().keys()))
+        color = c.random_color()
+        outputs = {'error': '', 'output': ''}
+        try:
+            stream = cls.ssh_stream(*cmd_args, host=host_name, cwd=cwd, sudo=sudo, timeout=timeout, stderr=True, labeled=True)
+            for name, line in stream:
                 if verbose:
-                    c.print(f'[bold]{host_name}[/bold]', line.strip('\n'))
-                outputs['error'] += line
-        
-            if len(outputs['error']) == 0:
-                outputs = outputs['output']
-    
-            # stdin.close()
-            # stdout.close()
-            # stderr.close()
-            # client.close()
+                    c.print(f'[bold]{host_name}[/bold]', line.strip('\n'), color=color if name == 'stdout' else None)
+                outputs['output' if name == 'stdout' else 'error'] += line
         except Exception as e:
             c.print(e)
+            outputs['error'] += str(e)
+    
+        if len(outputs['error']) == 0:
+            outputs = outputs['output']
         return outputs
 
     @classmethod
@@ -232,14 +325,7 @@ class Remote(c.Module):
         # Test Remote
         c.print(self.ssh_cmd('ls'))
     @classmethod
-    def cmd(cls, *commands, 
-            search=None, 
-            hosts:Union[list, dict, str] = None, 
-            cwd=None,
-              host:str=None,  
-              timeout=5 , 
-              verbose:bool = True,**kwargs):
-        output = {}
+    def resolve_hosts(cls, hosts:Union[list, dict, str] = None, host:str = None, search:str = None) -> dict:
         if hosts == None:
             hosts = cls.hosts()
             if host != None:
@@ -247,14 +333,27 @@ class Remote(c.Module):
         if search != None:
             hosts = {k:v for k,v in hosts.items() if search in k}
         if isinstance(hosts, list):
-            hosts = {h:hosts[h] for h in hosts}
+            all_hosts = cls.hosts()
+            hosts = {h:all_hosts[h] for h in hosts}
         elif isinstance(hosts, str):
-            hosts = {hosts:cls.hosts(hosts)}
+            hosts = {hosts:cls.hosts()[hosts]}
 
         assert isinstance(hosts, dict), f'Hosts must be a dict, got {type(hosts)}'
+        return hosts
 
-        results = {}
-        errors = {}
+    @classmethod
+    def cmd_as_completed(cls, *commands, 
+            search=None, 
+            hosts:Union[list, dict, str] = None, 
+            cwd=None,
+            host:str=None,  
+            timeout=5 , 
+            verbose:bool = True,
+            **kwargs) -> Generator[Tuple[str, Any], None, None]:
+        """
+        runs the command on every host over the pooled connections and yields (host, result) as each finishes
+        """
+        hosts = cls.resolve_hosts(hosts=hosts, host=host, search=search)
         host2future = {}
         for host in hosts:
             host2future[host] = c.submit(cls.ssh_cmd, 
@@ -263,19 +362,27 @@ class Remote(c.Module):
                                             return_future=True
                                             )
         future2host = {v:k for k,v in host2future.items()}
-
-
         try:
             for future in c.as_completed(list(host2future.values()), timeout=timeout):
-                result = future.result()
-                host = future2host[future]
-                if not c.is_error(result):
-                    results[host] = result
-                else:
-                    errors[host]= result
+                yield future2host[future], future.result()
         except Exception as e:
             c.print(e)
 
+    @classmethod
+    def cmd(cls, *commands, 
+            search=None, 
+            hosts:Union[list, dict, str] = None, 
+            cwd=None,
+              host:str=None,  
+              timeout=5 , 
+              verbose:bool = True,**kwargs):
+        results = {}
+        errors = {}
+        for host, result in cls.cmd_as_completed(*commands, search=search, hosts=hosts, cwd=cwd, host=host, timeout=timeout, verbose=verbose, **kwargs):
+            if not c.is_error(result):
+                results[host] = result
+            else:
+                errors[host]= result
 
         if all([v == None for v in results.values()]):
             raise Exception(f'all results are None')
@@ -7,7 +7,7 @@ import numpy as np
 import torch
 import msgpack
 import msgpack_numpy
-from typing import Tuple, List, Union, Optional
+from typing import Any, Tuple, List, Union, Optional
 from copy import deepcopy
 from munch import Munch
 
@@ -17,16 +17,22 @@ import json
 
 class Serializer(c.Module):
 
-
+    json_content_type = 'application/json'
+    msgpack_content_type = 'application/msgpack'
     
     def serialize(self,x:dict, mode = 'str'):
-        x = c.copy(x)
+        if mode == 'msgpack':
+            # binary wire format, tensors and arrays travel as raw buffers
+            return self.python2msgpack(x)
+        # no deep copy of the input, every container is shallow copied before it is written to
         x_type = type(x)
         if x_type in [dict, list, set, tuple]:
             k_list = []
             if isinstance(x, dict):
+                x = dict(x)
                 k_list = list(x.keys())
             elif isinstance(x, list):
+                x = list(x)
                 k_list = list(range(len(x)))
             elif type(x) in [tuple, set]: 
                 # convert to list, to format as json
@@ -80,8 +86,11 @@ class Serializer(c.Module):
     def deserialize(self, x) -> object:
         """Serializes a torch object to DataBlock wire format.
         """
-        if isinstance(x, dict) and isinstance(x.get('data', None), str):
+        if isinstance(x, dict) and isinstance(x.get('data', None), (str, bytes)):
             x = x['data']
+        if isinstance(x, (bytes, bytearray, memoryview)):
+            # binary wire format (see serialize(mode='msgpack'))
+            return self.msgpack2python(x)
         if isinstance(x, str):
             if x.startswith('{') or x.startswith('['):
                 x = self.str2dict(x)
@@ -182,11 +191,83 @@ class Serializer(c.Module):
         json_object_bytes = msgpack.unpackb(data)
         return json.loads(json_object_bytes)
 
+    """
+    ################ MSGPACK WIRE FORMAT ############################
+    """
+
+    def python2msgpack(self, data: Any) -> bytes:
+        return msgpack.packb(data, default=self.msgpack_default, use_bin_type=True)
+
+    def msgpack2python(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, object_hook=self.msgpack_object_hook, raw=False)
+
+    def msgpack_default(self, data: Any) -> Any:
+        """
+        packs the objects msgpack does not know about, arrays go as a small header 
+        (dtype, shape) followed by a memoryview of their contiguous buffer
+        """
+        data_type = self.get_type_str(data)
+        if data_type == 'torch':
+            return {'data': self.torch2buffer(data), 
+                    'dtype': str(data.dtype).split('.')[-1], 
+                    'shape': list(data.shape), 
+                    'data_type': data_type, 
+                    'serialized': True}
+        elif data_type == 'numpy':
+            return {'data': self.numpy2buffer(data), 
+                    'dtype': data.dtype.str, 
+                    'shape': list(data.shape), 
+                    'data_type': data_type, 
+                    'serialized': True}
+        elif data_type == 'pandas':
+            return data.to_dict()
+        elif isinstance(data, set):
+            return list(data)
+        raise TypeError(f'Cannot serialize {data_type} to msgpack')
+
+    def msgpack_object_hook(self, data: dict) -> Any:
+        if data.get('serialized', False) and isinstance(data.get('data', None), bytes) and 'shape' in data:
+            if data['data_type'] == 'torch':
+                return self.buffer2torch(data['data'], dtype=data['dtype'], shape=data['shape'])
+            return self.buffer2numpy(data['data'], dtype=data['dtype'], shape=data['shape'])
+        return data
+
+    def numpy2buffer(self, data: np.ndarray) -> memoryview:
+        # no copy if the array is already contiguous
+        data = np.ascontiguousarray(data)
+        return memoryview(data.reshape(-1).view(np.uint8))
+
+    def torch2buffer(self, data: 'torch.Tensor') -> memoryview:
+        # viewing as uint8 also covers dtypes numpy does not have (ie. bfloat16)
+        data = data.detach().cpu().contiguous()
+        return memoryview(data.reshape(-1).view(torch.uint8).numpy())
+
+    def buffer2numpy(self, data: bytes, dtype: str, shape: list) -> np.ndarray:
+        """
+        read-only view on the received buffer (no copy), call .copy() before writing to it
+        """
+        return np.frombuffer(data, dtype=np.dtype(dtype)).reshape(shape)
+
+    # the dtypes a received tensor can have, the name comes from the wire so it is not looked up on torch blindly
+    torch_dtypes = ['bool', 'uint8', 'int8', 'int16', 'int32', 'int64', 
+                    'float16', 'bfloat16', 'float32', 'float64', 'complex64', 'complex128']
+
+    def buffer2torch(self, data: bytes, dtype: str, shape: list) -> 'torch.Tensor':
+        """
+        the tensor owns a writable copy of the received buffer (one memcpy), bytes are immutable
+        """
+        if dtype not in self.torch_dtypes:
+            raise ValueError(f'Unsupported torch dtype {dtype}')
+        dtype = getattr(torch, dtype)
+        if len(data) == 0:
+            return torch.empty(shape, dtype=dtype)
+        return torch.frombuffer(bytearray(data), dtype=dtype).reshape(shape)
+
     """
     ################ BIG TORCH LAND ############################
     """
     def torch2bytes(self, data:'torch.Tensor')-> bytes:
-        return self.numpy2bytes(self.torch2numpy(data))
+        return self.python2msgpack(data)
     
     def torch2numpy(self, data:'torch.Tensor')-> np.ndarray:
         if data.requires_grad:
@@ -200,15 +281,7 @@ class Serializer(c.Module):
         return output
     
     def bytes2torch(self, data:bytes, ) -> 'torch.Tensor':
-        numpy_object = self.bytes2numpy(data)
-        
-        int64_workaround = bool(numpy_object.dtype == np.int64)
-        if int64_workaround:
-            numpy_object = numpy_object.astype(np.float64)
-        torch_object = torch.tensor(numpy_object)
-        if int64_workaround:
-            dtype = torch.int64
-        return torch_object
+        return self.msgpack2python(data)
     
     def bytes2numpy(self, data:bytes) -> np.ndarray:
         output = msgpack.unpackb(data, object_hook=msgpack_numpy.decode)
@@ -349,4 +422,60 @@ class Serializer(c.Module):
         stats['compression_ratio'] = stats['size_bytes'] / stats['size_bytes_compressed']
         stats['mb_per_second'] = c.round((stats['size_bytes'] / stats['elapsed_time']) / 1e6, 3)
 
-        return stats
\ No newline at end of file
+        return stats
+
+    @classmethod
+    def test_zero_copy(cls):
+        self = cls()
+        data = {'tensor': torch.randn(100, 100), 'bf16': torch.randn(10).bfloat16(), 'array': np.random.randn(10, 10)}
+        # the input is never copied or written to
+        self.serialize(data)
+        assert isinstance(data['tensor'], torch.Tensor)
+        output = self.deserialize(self.serialize(data, mode='msgpack'))
+        assert torch.equal(output['tensor'], data['tensor'])
+        assert torch.equal(output['bf16'], data['bf16'])
+        assert np.array_equal(output['array'], data['array'])
+        # arrays are views on the received buffer
+        assert not output['array'].flags.writeable
+        # tensors own a writable buffer
+        output['tensor'].add_(1)
+        try:
+            self.buffer2torch(b'\x00' * 4, dtype='Tensor', shape=[1])
+            raise AssertionError('an unknown dtype was accepted')
+        except ValueError:
+            pass
+        return {'success': True, 'msg': 'zero copy serialization works'}
+
+    @classmethod
+    def test_wire_throughput(cls, 
+                             sizes = [1e3, 1e4, 1e5, 1e6, 1e7, 1e8], 
+                             modes = ['str', 'msgpack'],
+                             dtype = 'float32'):
+        """
+        compares payload size and encode/decode throughput of the json (hex) and msgpack wire formats
+        sizes are in bytes of the tensor
+        """
+        self = cls()
+        stats = []
+        for size in sizes:
+            numel = int(size) // torch.tensor([], dtype=getattr(torch, dtype)).element_size()
+            data = {'tensor': torch.randn(numel).to(getattr(torch, dtype))}
+            num_bytes = numel * data['tensor'].element_size()
+            for mode in modes:
+                t = c.time()
+                serialized_data = self.serialize(data, mode=mode)
+                encode_time = c.time() - t
+                t = c.time()
+                deserialized_data = self.deserialize(serialized_data)
+                decode_time = c.time() - t
+                assert deserialized_data['tensor'].shape == data['tensor'].shape
+                stats.append({
+                    'mode': mode,
+                    'size_bytes': num_bytes,
+                    'payload_bytes': len(serialized_data),
+                    'payload_ratio': c.round(len(serialized_data) / num_bytes, 3),
+                    'encode_mb_per_second': c.round((num_bytes / max(encode_time, 1e-9)) / 1e6, 3),
+                    'decode_mb_per_second': c.round((num_bytes / max(decode_time, 1e-9)) / 1e6, 3),
+                })
+        c.print(c.df(stats))
+        return stats
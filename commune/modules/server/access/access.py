@@ -1,5 +1,6 @@
 import commune as c
 from typing import *
+import threading
 
 
 class Access(c.Module):
@@ -11,12 +12,15 @@ class Access(c.Module):
                 chain: str =  'main', # mainnet
                 netuid: int = 0, # subnet id
                 sync_interval: int =  30, #  1000 seconds per sync with the network
+                snapshot_interval: int = 60, # seconds between snapshots of the state to disk
                 timescale:str =  'min', # 'sec', 'min', 'hour', 'day'
                 stake2rate: int =  100.0,  # 1 call per every N tokens staked per timescale
                 max_rate: int =  1000.0, # 1 call per every N tokens staked per timescale
                 role2rate: dict =  {}, # role to rate map, this overrides the default rate,
                 state_path = f'state_path', # the path to the state
                 refresh: bool = False,
+                background: bool = True, # sync the stakes and snapshot the state in a background thread
+                chain_sync: bool = False, # follow the chain block by block (subspace.sync) instead of rereading the stakes
                 **kwargs):
         
         config = self.set_config(kwargs=locals())
@@ -32,10 +36,18 @@ class Access(c.Module):
         self.state_path = state_path
         if refresh:
             self.rm_state()
-        self.last_time_synced = c.time()
-        self.state = {}
-        
-        # c.thread(self.sync_loop_thread)
+        # the state lives in memory, the disk only holds snapshots
+        self.lock = threading.Lock()
+        self.state = {**self.default_state(), **self.get(self.state_path, {})}
+        self.stakes = self.state.get('stakes', {})
+        self.last_time_synced = self.state.get('sync_time', 0)
+        self.last_time_saved = c.time()
+        # one sync at a time, the first one is done by the background loop when it runs
+        self.sync_lock = threading.Lock()
+        self.synced = threading.Event()
+        self.running = background
+        if background:
+            c.thread(self.sync_loop)
 
     def default_state(self):
         state = {
@@ -59,37 +71,66 @@ class Access(c.Module):
         self.put(self.state_path, {})
         return {'success': True, 'msg': f'removed {self.state_path}'}
     def save_state(self):
-        self.put(self.state_path, self.state)
+        with self.lock:
+            state = c.copy(self.state)
+        self.put(self.state_path, state)
+        self.last_time_saved = c.time()
         return {'success': True, 'msg': f'saved {self.state_path}'}
-    def sync_network(self, update=False):
-        state = self.get(self.state_path, {})
-        if len(self.state) == 0:
-            self.get
-            update=True
-            
-        time_since_sync = c.time() - state.get('sync_time', 0)
-        
-        if time_since_sync > self.config.sync_interval or update:
-            self.subspace = c.module('subspace')(network=self.config.chain)
-            self.stakes = self.subspace.stakes(fmt='j', netuid=self.config.netuid, update=False)
-            c.print('gettting ')
 
-            state['stake_from'] = self.subspace.my_stake_from(netuid=self.config.netuid, update=False)
-            state['sync_time'] = c.time()
-
-        self.last_time_synced = state['sync_time']
-
-        self.state = state
-        self.save_state()
+    def sync_loop(self, sleep_interval:int = 1):
+        """
+        refreshes the stakes every sync_interval and snapshots the state every snapshot_interval
+        so neither happens on the request path
+        """
+        while self.running:
+            try:
+                if c.time() - self.last_time_synced > self.config.sync_interval:
+                    self.sync_network()
+                if c.time() - self.last_time_saved > self.config.snapshot_interval:
+                    self.save_state()
+            except Exception as e:
+                c.print(f'Error in access sync loop: {e}', color='red')
+                # dont hammer the chain if it is down
+                self.last_time_synced = c.time()
+            c.sleep(sleep_interval)
+
+    def stop(self):
+        self.running = False
+        return self.save_state()
 
-        response = {  
+    def sync_network(self, update=False):
+        with self.sync_lock:
+            time_since_sync = c.time() - self.last_time_synced
+            if time_since_sync > self.config.sync_interval or update:
+                try:
+                    self.subspace = c.module('subspace')(network=self.config.chain)
+                    if self.config.chain_sync:
+                        engine = c.module('subspace.sync').get_engine(network=self.config.chain)
+                        if engine.block == None:
+                            # the engine is still loading the maps, try again in sync_interval
+                            self.last_time_synced = c.time()
+                            return {'success': False, 'msg': 'the chain sync engine is still loading', 'time_since_sync': time_since_sync}
+                        stakes = engine.stakes(fmt='j', netuid=self.config.netuid)
+                    else:
+                        stakes = self.subspace.stakes(fmt='j', netuid=self.config.netuid, update=False)
+                    stake_from = self.subspace.my_stake_from(netuid=self.config.netuid, update=False)
+                except Exception as e:
+                    # record the attempt, so an unavailable chain is not retried on every call
+                    self.last_time_synced = c.time()
+                    raise e
+                finally:
+                    self.synced.set()
+                with self.lock:
+                    self.stakes = stakes
+                    self.state['stakes'] = stakes
+                    self.state['stake_from'] = stake_from
+                    self.state['sync_time'] = c.time()
+                self.last_time_synced = self.state['sync_time']
+                c.print(f'🔄 Synced {self.state_path} at {self.state["sync_time"]}... 🔄\033', color='yellow')
 
-                    }
-        c.print(f'🔄 Synced {self.state_path} at {state["sync_time"]}... 🔄\033', color='yellow')
         response = {'success': True, 'msg': f'synced {self.state_path}', 
                     'until_sync': self.config.sync_interval - time_since_sync,
                     'time_since_sync': time_since_sync}
-        c.print(response)
         return response
 
     def verify(self, input:dict) -> dict:
@@ -97,7 +138,8 @@ class Access(c.Module):
         input : dict 
             address:
 
-        
+        token bucket rate limit per address, the bucket holds up to rate_limit calls 
+        and refills at rate_limit calls per timescale
         """
         fn = input['fn']
         address = input['address']
@@ -118,15 +160,16 @@ class Access(c.Module):
 
         current_time = c.time()
 
-        # sync of the state is not up to date 
-        self.sync_network()
-
-        # get the rate limit for the user
-        role2rate = self.state.get('role2rate', {})
+        # the first request waits for the stakes if we have never synced, after that the background thread keeps them fresh
+        if self.last_time_synced == 0:
+            if self.running:
+                # the background loop does the first sync
+                self.synced.wait(timeout=self.config.sync_interval)
+            else:
+                self.sync_network()
 
         # get the role of the user
         role = self.user_module.get_role(address) or 'public'
-        rate_limit = role2rate.get(role, 0)
 
         # stake rate limit
         stake = self.stakes.get(address, 0)
@@ -147,37 +190,40 @@ class Access(c.Module):
         # STEP 3: CHECK THE MAX RATE
         max_rate = fn2info.get('max_rate', self.config.max_rate)
         rate_limit = min(rate_limit, max_rate) # cap the rate limit at the max rate
+        period = self.timescale_map[self.config.timescale]
         
         # NOW LETS CHECK THE RATE LIMIT
-        user_info = self.state.get('user_info', {}).get(address, {})
-        # check if the user has exceeded the rate limit
-        time_since_called = current_time - user_info.get('timestamp', 0)
-        period = self.timescale_map[self.config.timescale]
-        # if the time since the last call is greater than the seconds in the period, reset the requests
-        if time_since_called > period:
-            user_info['rate'] = 0
-
-        try:
-
-            assert user_info['rate'] <= rate_limit
-            user_info['passed'] = True
-        except Exception as e:
-            user_info['error'] = c.detailed_error(e)
-            user_info['passed'] = False
-       
-        # update the user info
-        user_info['rate_limit'] = rate_limit
-        user_info['period'] = period
-        user_info['role'] = role
-        user_info['fn2requests'] = user_info.get('fn2requests', {})
-        user_info['fn2requests'][fn] = user_info['fn2requests'].get(fn, 0) + 1
-        user_info['timestamp'] = current_time
-        user_info['stake'] = stake
-        user_info['stake_from'] = stake_from
-        user_info['rate'] = user_info.get('rate', 0) + 1
-        user_info['timescale'] = self.config.timescale
-        # store the user info into the state
-        self.state['user_info'][address] = user_info
+        with self.lock:
+            user_info = self.state['user_info'].get(address, {})
+            # refill the bucket for the time since the last call
+            time_since_called = current_time - user_info.get('timestamp', current_time)
+            # at least one call per timescale (as when the count was reset every period), so a rate below 1 is not locked out for good
+            capacity = max(rate_limit, 1)
+            tokens = user_info.get('tokens', capacity) + time_since_called * (capacity / period)
+            tokens = min(tokens, capacity)
+            if tokens >= 1:
+                tokens -= 1
+                user_info['passed'] = True
+                user_info.pop('error', None)
+            else:
+                user_info['error'] = f'Rate limit exceeded for {address}, {rate_limit} calls per {self.config.timescale}'
+                user_info['passed'] = False
+        
+            # update the user info
+            user_info['tokens'] = tokens
+            user_info['rate_limit'] = rate_limit
+            user_info['period'] = period
+            user_info['role'] = role
+            user_info['fn2requests'] = user_info.get('fn2requests', {})
+            user_info['fn2requests'][fn] = user_info['fn2requests'].get(fn, 0) + 1
+            user_info['timestamp'] = current_time
+            user_info['stake'] = stake
+            user_info['stake_from'] = stake_from
+            user_info['rate'] = rate_limit - tokens
+            user_info['timescale'] = self.config.timescale
+            # store the user info into the state
+            self.state['user_info'][address] = user_info
+            user_info = dict(user_info)
         # check the rate limit
         return user_info
 
@@ -188,7 +234,7 @@ class Access(c.Module):
 
     @classmethod
     def test(cls, key='vali::fam', base_rate=2):
-        module = cls(module=c.module('module')(),  base_rate=base_rate)
+        module = cls(module=c.module('module')(),  base_rate=base_rate, background=False)
         key = c.get_key(key)
 
         for i in range(base_rate*3):    
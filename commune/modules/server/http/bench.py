@@ -0,0 +1,22 @@
+import commune as c
+import asyncio
+import time
+
+class ServerHTTPBench(c.Module):
+    """
+    dummy handlers for ServerHTTP.test_throughput
+    """
+    whitelist = ['sync_sleep', 'async_sleep', 'stream_sleep']
+
+    def sync_sleep(self, delay:float = 0.05) -> float:
+        time.sleep(delay)
+        return delay
+
+    async def async_sleep(self, delay:float = 0.05) -> float:
+        await asyncio.sleep(delay)
+        return delay
+
+    def stream_sleep(self, n:int = 10, delay:float = 0.05):
+        for i in range(n):
+            time.sleep(delay)
+            yield i
@@ -1,11 +1,17 @@
 
-from typing import Dict, List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import inspect
+import asyncio
+import json
 import commune as c
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 
 class ServerHTTP(c.Module):
+    default_max_workers = 64
     def __init__(
         self,
         module: Union[c.Module, object] = None,
@@ -20,12 +26,14 @@ class ServerHTTP(c.Module):
         verbose: bool = False,
         timeout: int = 256,
         access_module: str = 'server.access',
+        verifier_module: str = 'server.verifier',
         public: bool = False,
         serializer: str = 'serializer',
         save_history:bool= True,
         history_path:str = None , 
         nest_asyncio = True,
         new_loop = True,
+        max_workers: int = None,
         **kwargs
         
         ) -> 'Server':
@@ -43,6 +51,7 @@ class ServerHTTP(c.Module):
         self.chunk_size = chunk_size
         self.timeout = timeout
         self.public = public
+        self.set_executor(max_workers=max_workers)
         
         # name 
         if isinstance(module, str):
@@ -65,6 +74,7 @@ class ServerHTTP(c.Module):
         self.module = module 
         self.set_key(key)
         self.access_module = c.module(access_module)(module=self.module)  
+        self.verifier = c.module(verifier_module)(max_staleness=self.max_request_staleness)
         self.set_history_path(history_path)
         self.set_api(ip=self.ip, port=self.port)
 
@@ -77,6 +87,12 @@ class ServerHTTP(c.Module):
             self.key = c.get_key(self.key)  
 
 
+    def set_executor(self, max_workers:int = None):
+        # bounded pool for sync functions, key verification and (de)serialization
+        self.max_workers = max_workers or self.default_max_workers
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='ServerHTTP')
+        return {'max_workers': self.max_workers}
+
     def set_address(self,ip='0.0.0.0', port:int=None):
         if '://' in ip:
             assert ip.startswith('http'), f"Invalid ip {ip}"
@@ -87,7 +103,68 @@ class ServerHTTP(c.Module):
         while c.port_used(self.port):
             self.port = c.free_port()
         self.address = f"http://{self.ip}:{self.port}"
-    def forward(self, fn:str, input:dict):
+
+    def process_input(self, fn:str, input:dict, verify:bool = True) -> Tuple[dict, dict]:
+        """
+        verifies and deserializes the request (cpu bound, so keep it off the event loop)
+        returns the processed input and the user info from the access module
+        verify: verify the signature here (the async path verifies it in batches beforehand)
+        """
+        input['fn'] = fn
+        # you can verify the input with the server key class
+        if not self.public and verify:
+            assert self.verifier.verify(input), f"Data not signed with correct key or the request was replayed"
+
+        if 'args' in input and 'kwargs' in input:
+            input['data'] = {'args': input['args'], 
+                                'kwargs': input['kwargs'], 
+                                'timestamp': input['timestamp'], 
+                                'address': input['address']}
+        input['data'] = self.serializer.deserialize(input['data'])
+        # here we want to verify the data is signed with the correct key
+        request_staleness = c.timestamp() - input['data'].get('timestamp', 0)
+        # verifty the request is not too old
+        assert request_staleness < self.max_request_staleness, f"Request is too old, {request_staleness} > MAX_STALENESS ({self.max_request_staleness})  seconds old"
+        
+        # verify the access module
+        user_info = self.access_module.verify(input)
+        if user_info['passed']:
+            assert 'args' in input['data'], f"args not in input data"
+        return input, user_info
+
+    def get_fn_obj(self, fn:str, input:dict) -> Any:
+        fn_name = f"{self.name}::{fn}"
+        c.print(f'🚀 Forwarding {input["address"]} --> {fn_name} 🚀\033', color='yellow')
+        return getattr(self.module, fn)
+
+    def process_output(self, fn:str, input:dict, result:Any, user_info:dict = None, content_type:str = 'application/json') -> Any:
+        success = not (isinstance(result, dict) and 'error' in result)
+        if success:
+            c.print(f'✅ Success: {self.name}::{fn} --> {input.get("address")}... ✅\033 ', color='green')
+        else:
+            c.print(f'🚨 Error: {self.name}::{fn} --> {input.get("address")}... 🚨\033', color='red')
+
+        result = self.process_result(result, content_type=content_type)
+
+        if self.save_history:
+            data = input.get('data', {})
+            data = data if isinstance(data, dict) else {}
+            output = {
+            'module': self.name,
+            'fn': fn,
+            'timestamp': data.get('timestamp', input.get('timestamp', c.timestamp())),
+            'address': input.get('address'),
+            'args': data.get('args', []),
+            'kwargs': data.get('kwargs', {}),
+            'result': None if self.sse or isinstance(result, Response) else result,
+            'user': user_info,
+            }
+            output['latency'] = c.time() - output['timestamp']
+            self.add_history(output)
+
+        return result
+
+    def forward(self, fn:str, input:dict, content_type:str = 'application/json'):
         """
         fn (str): the function to call
         input (dict): the input to the function
@@ -98,83 +175,66 @@ class ServerHTTP(c.Module):
                 address: the address of the caller
 
             signature: the signature of the request
+        content_type (str): the format of the response (application/json or application/msgpack)
    
         """
         user_info = None
         try:
-            input['fn'] = fn
-            # you can verify the input with the server key class
-            if not self.public:
-                assert self.key.verify(input), f"Data not signed with correct key"
-
-
-            if 'args' in input and 'kwargs' in input:
-                input['data'] = {'args': input['args'], 
-                                 'kwargs': input['kwargs'], 
-                                 'timestamp': input['timestamp'], 
-                                 'address': input['address']}
-            input['data'] = self.serializer.deserialize(input['data'])
-            # here we want to verify the data is signed with the correct key
-            request_staleness = c.timestamp() - input['data'].get('timestamp', 0)
-            # verifty the request is not too old
-            assert request_staleness < self.max_request_staleness, f"Request is too old, {request_staleness} > MAX_STALENESS ({self.max_request_staleness})  seconds old"
-            
-            # verify the access module
-            user_info = self.access_module.verify(input)
+            input, user_info = self.process_input(fn=fn, input=input)
             if not user_info['passed']:
                 return user_info
-            assert 'args' in input['data'], f"args not in input data"
-
             data = input['data']
-            args = data.get('args',[])
-            kwargs = data.get('kwargs', {})
-
-            fn_name = f"{self.name}::{fn}"
-
-            c.print(f'🚀 Forwarding {input["address"]} --> {fn_name} 🚀\033', color='yellow')
-            
-            fn_obj = getattr(self.module, fn)
-            
+            fn_obj = self.get_fn_obj(fn=fn, input=input)
             if callable(fn_obj):
-                result = fn_obj(*args, **kwargs)
+                result = fn_obj(*data.get('args', []), **data.get('kwargs', {}))
             else:
                 result = fn_obj
-
-            # if the result is a future, we need to wait for it to finish
+            # if the result is a coroutine, we need to wait for it to finish
+            if c.is_coroutine(result):
+                result = c.gather(result, timeout=self.timeout)
         except Exception as e:
             result = c.detailed_error(e)
-        if isinstance(result, dict) and 'error' in result:
-            success = False 
-        success = True
 
+        return self.process_output(fn=fn, input=input, result=result, user_info=user_info, content_type=content_type)
 
-        if success:
-            c.print(f'✅ Success: {self.name}::{fn} --> {input["address"]}... ✅\033 ', color='green')
-        else:
-            c.print(f'🚨 Error: {self.name}::{fn} --> {input["address"]}... 🚨\033', color='red')
-        
-
-        result = self.process_result(result)
-        
-
-        if self.save_history:
-
-            output = {
-            'module': self.name,
-            'fn': fn,
-            'timestamp': input['data']['timestamp'],
-            'address': input['address'],
-            'args': input['data']['args'],
-            'kwargs': input['data']['kwargs'],
-            'result': None if self.sse else result,
-            'user': user_info,
+    async def run_in_executor(self, fn:Callable, *args, **kwargs) -> Any:
+        """
+        runs a blocking function on the bounded executor so the event loop stays free
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(fn, *args, **kwargs))
 
-            }
-            output.update(output.pop('data', {}))
-            output['latency'] = c.time() - output['timestamp']
-            self.add_history(output)
+    async def async_forward(self, fn:str, input:dict, content_type:str = 'application/json'):
+        """
+        async version of forward, used by the api 
+        - coroutine functions are awaited on the event loop
+        - sync functions, key verification and (de)serialization run on the executor
+        """
+        user_info = None
+        try:
+            if not self.public:
+                verified = await self.verifier.async_verify(input)
+                assert verified, f"Data not signed with correct key or the request was replayed"
+            input, user_info = await self.run_in_executor(self.process_input, fn=fn, input=input, verify=False)
+            if not user_info['passed']:
+                return user_info
+            data = input['data']
+            args = data.get('args', [])
+            kwargs = data.get('kwargs', {})
+            fn_obj = self.get_fn_obj(fn=fn, input=input)
+            if inspect.iscoroutinefunction(fn_obj):
+                result = await asyncio.wait_for(fn_obj(*args, **kwargs), timeout=self.timeout)
+            elif callable(fn_obj):
+                result = await asyncio.wait_for(self.run_in_executor(fn_obj, *args, **kwargs), timeout=self.timeout)
+                # the function can still return an awaitable (ie. a sync wrapper of a coroutine)
+                if inspect.isawaitable(result):
+                    result = await asyncio.wait_for(result, timeout=self.timeout)
+            else:
+                result = fn_obj
+        except Exception as e:
+            result = c.detailed_error(e)
 
-        return result
+        return await self.run_in_executor(self.process_output, fn=fn, input=input, result=result, user_info=user_info, content_type=content_type)
 
 
     def set_api(self, ip:str = '0.0.0.0', port:int = 8888):
@@ -191,8 +251,17 @@ class ServerHTTP(c.Module):
             )
        
         @self.app.post("/{fn}")
-        def forward_api(fn:str, input:dict):
-            return self.forward(fn=fn, input=input)
+        async def forward_api(fn:str, request: Request):
+            body = await request.body()
+            try:
+                input = await self.run_in_executor(self.load_request, body=body, content_type=request.headers.get('content-type', ''))
+            except Exception as e:
+                # a body that does not decode is a client error
+                error = {'success': False, 'error': f'Invalid request body: {e}'}
+                return Response(content=json.dumps(error), status_code=400, media_type='application/json')
+            # respond in the format the client accepts, json is the fallback
+            content_type = self.resolve_content_type(request.headers.get('accept', ''))
+            return await self.async_forward(fn=fn, input=input, content_type=content_type)
         
         try:
             c.print(f'\033🚀 Serving {self.name} on {self.address} 🚀\033')
@@ -208,15 +277,11 @@ class ServerHTTP(c.Module):
 
     @classmethod
     def history_paths(cls, server=None, history_path='history', n=100, key=None):
-        if server == None:
-            dirpath  = f'{history_path}'
-            paths =  cls.glob(dirpath)
-        else:
-            
-            dirpath  = f'{history_path}/{server}'
-            paths =  cls.ls(dirpath)
-        paths = sorted(paths, reverse=True)[:n]
-        return paths
+        """
+        the history segments (newest first), see the history module
+        """
+        dirpath = history_path if server == None else f'{history_path}/{server}'
+        return c.module('history').segments(cls.resolve_path(dirpath))[:n]
 
 
     def state_dict(self) -> Dict:
@@ -230,37 +295,63 @@ class ServerHTTP(c.Module):
     
 
 
-    def process_result(self,  result):
-        if c.is_generator(result):
+    def load_request(self, body:bytes, content_type:str = 'application/json') -> dict:
+        if self.serializer.msgpack_content_type in content_type:
+            input = self.serializer.msgpack2python(body)
+        else:
+            input = json.loads(body)
+        if not isinstance(input, dict):
+            raise ValueError(f'the request must be an object, got {type(input).__name__}')
+        return input
+
+    def resolve_content_type(self, accept:str = '') -> str:
+        if self.serializer.msgpack_content_type in accept:
+            return self.serializer.msgpack_content_type
+        return self.serializer.json_content_type
+
+    def process_result(self,  result, content_type:str = 'application/json'):
+        if c.is_generator(result) or inspect.isasyncgen(result):
             from sse_starlette.sse import EventSourceResponse
             # for sse we want to wrap the generator in an eventsource response
-            result = self.generator_wrapper(result)
+            if inspect.isasyncgen(result):
+                result = self.async_generator_wrapper(result)
+            else:
+                result = self.generator_wrapper(result)
             return EventSourceResponse(result)
+        elif content_type == self.serializer.msgpack_content_type:
+            # binary envelope, the signature covers the msgpack bytes
+            result = self.serializer.serialize(result, mode='msgpack')
+            result = self.key.sign(result, return_json=True)
+            result = self.serializer.serialize(result, mode='msgpack')
+            return Response(content=result, media_type=content_type)
         else:
             # if we are not using sse, then we can do this with json
             result = self.serializer.serialize(result)
             result = self.key.sign(result, return_json=True)
             return result
-        
-    
-    def generator_wrapper(self, generator):
 
-        for item in generator:
- 
-            # we wrap the item in a json object, just like the serializer does
-            item = self.serializer.serialize({'data': item})
-            item_size = len(str(item))
-            # we need to add a chunk start and end to the item
-            if item_size > self.chunk_size:
-                # if the item is too big, we need to chunk it
-                chunks =[item[i:i+self.chunk_size] for i in range(0, item_size, self.chunk_size)]
-                # we need to yield the chunks in a format that the eventsource response can understand
-                for chunk in chunks:
-                    yield chunk
-            else:
-                yield item
+    def item2events(self, item) -> List[dict]:
+        """
+        we wrap the item in a json object, just like the serializer does.
+        if the item is too big, we chunk it, every chunk but the last is a "chunk" event
+        and the last one is an "item" event so the client knows when to reassemble it
+        """
+        item = self.serializer.serialize({'data': item})
+        item_size = len(item)
+        chunks = [item[i:i+self.chunk_size] for i in range(0, item_size, self.chunk_size)] or ['']
+        events = [{'event': 'chunk', 'data': chunk} for chunk in chunks[:-1]]
+        events += [{'event': 'item', 'data': chunks[-1]}]
+        return events
 
+    def generator_wrapper(self, generator):
+        for item in generator:
+            for event in self.item2events(item):
+                yield event
 
+    async def async_generator_wrapper(self, generator):
+        async for item in generator:
+            for event in self.item2events(item):
+                yield event
 
 
     @classmethod
@@ -271,15 +362,49 @@ class ServerHTTP(c.Module):
         module.put("hey",1)
         c.kill(module_name)
 
+    @classmethod
+    def test_throughput(cls, 
+                        module:str = 'server.http.bench', 
+                        fns = ['sync_sleep', 'async_sleep'],
+                        n:int = 256, 
+                        concurrency:int = 128,
+                        delay:float = 0.05,
+                        timeout:int = 60):
+        """
+        benchmarks requests per second for sync vs async handlers under concurrent load
+        """
+        server_name = module + '::bench'
+        c.serve(module, tag='bench', wait_for_server=True)
+        client = c.connect(server_name, virtual=False)
+        stats = {}
+        try:
+            for fn in fns:
+                semaphore = asyncio.Semaphore(concurrency)
+                async def call():
+                    async with semaphore:
+                        return await client.async_forward(fn=fn, kwargs={'delay': delay}, timeout=timeout)
+                t1 = c.time()
+                results = c.gather([call() for _ in range(n)], timeout=timeout)
+                elapsed = c.time() - t1
+                num_success = len([r for r in results if not c.is_error(r)])
+                stats[fn] = {'requests_per_second': c.round(num_success / elapsed, 3), 
+                             'latency': c.round(elapsed / n, 4),
+                             'success_rate': num_success / n}
+        finally:
+            c.kill(server_name)
+        c.print(stats)
+        return stats
+
 
 
     # HISTORY 
     def add_history(self, item:dict):    
-        path = self.history_path + '/' + item['address'] + '/'+  str(item['timestamp']) 
-        self.put(path, item)
+        # queued for the background writer, this never blocks the request
+        return self.history_sink.add(item)
 
     def set_history_path(self, history_path):
         self.history_path = history_path or f'history/{self.name}'
+        self.history_sink = c.module('history').get_sink(self.resolve_path(self.history_path))
         return {'history_path': self.history_path}
 
     @classmethod
@@ -299,11 +424,18 @@ class ServerHTTP(c.Module):
                 history_path='history',
                 features=[ 'module', 'fn', 'seconds_ago', 'latency', 'address'], 
                 to_list=False,
+                server = None,
+                n:int = 100,
+                since:float = None,
+                address:str = None,
+                fn:str = None,
                 **kwargs
                 ):
-        key = c.get_key(key)
-        history_path = cls.history_paths(key=key, history_path=history_path)
-        df =  c.df([cls.get(path) for path in history_path])
+        dirpath = history_path if server == None else f'{history_path}/{server}'
+        records = c.module('history').query(cls.resolve_path(dirpath), n=n, since=since, address=address, fn=fn)
+        if len(records) == 0:
+            return []
+        df =  c.df(records)
         now = c.timestamp()
         df['seconds_ago'] = df['timestamp'].apply(lambda x: now - x)
         df = df[features]
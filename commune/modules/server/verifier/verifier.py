@@ -0,0 +1,209 @@
+import commune as c
+from typing import *
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import lru_cache
+import threading
+import asyncio
+import sr25519
+import ed25519_zebra
+from substrateinterface.utils.ecdsa_helpers import ecdsa_verify
+
+# crypto types, see KeypairType in key.py
+ED25519, SR25519, ECDSA = 0, 1, 2
+
+
+def verify_signature(data:bytes, signature:bytes, public_key:bytes, crypto_type:int = SR25519) -> bool:
+    """
+    pure signature check so it can run in a worker process
+    """
+    if crypto_type == SR25519:
+        crypto_verify_fn = sr25519.verify
+    elif crypto_type == ED25519:
+        crypto_verify_fn = ed25519_zebra.ed_verify
+    elif crypto_type == ECDSA:
+        crypto_verify_fn = ecdsa_verify
+    else:
+        raise ValueError(f'Crypto type {crypto_type} not supported')
+    verified = crypto_verify_fn(signature, data, public_key)
+    if not verified:
+        # Another attempt with the data wrapped, as discussed in https://github.com/polkadot-js/extension/pull/743
+        verified = crypto_verify_fn(signature, b'<Bytes>' + data + b'</Bytes>', public_key)
+    return verified
+
+
+def verify_signatures(batch:List[tuple]) -> List[bool]:
+    """
+    verifies a batch of (data, signature, public_key, crypto_type) in one call,
+    so a batch costs one round trip to the worker pool
+    """
+    results = []
+    for args in batch:
+        try:
+            results.append(verify_signature(*args))
+        except Exception:
+            results.append(False)
+    return results
+
+
+@lru_cache(maxsize=10000)
+def address2public_key(address:str) -> bytes:
+    return bytes.fromhex(c.ss58_decode(address).replace('0x', ''))
+
+
+class Verifier(c.Module):
+    """
+    Verifies request signatures for the server
+    - remembers the signatures it has seen for max_staleness seconds (bounded lru),
+      a signature that shows up twice in that window is a replay and is rejected without any crypto
+    - async requests are queued and verified in batches on an executor
+    - batches bigger than burst_threshold go to a process pool so bursts do not starve the server
+    """
+
+    def __init__(self,
+                 max_staleness:int = 60, # seconds a signature is remembered, match the server max_request_staleness
+                 max_size:int = 100000, # max number of remembered signatures, should be > peak requests per max_staleness
+                 batch_size:int = 64, # max requests per verification batch (1 disables batching)
+                 batch_window:float = 0.002, # seconds to wait for a batch to fill up
+                 burst_threshold:int = 32, # batches this big are verified in the process pool
+                 max_workers:int = None, # workers of the process pool
+                 mode:str = 'thread', # thread or process, process always uses the process pool
+                 **kwargs):
+        self.max_staleness = max_staleness
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.burst_threshold = burst_threshold
+        self.max_workers = max_workers or max(c.cpu_count() // 2, 1)
+        self.mode = mode
+        self.signatures = OrderedDict() # signature -> timestamp it was first seen
+        self.lock = threading.Lock()
+        self.batch = []
+        self.batch_handle = None
+        self.thread_executor = None
+        self.process_executor = None
+
+    def evict_signatures(self):
+        # the oldest signatures are at the front
+        now = c.time()
+        while len(self.signatures) > 0:
+            signature, timestamp = next(iter(self.signatures.items()))
+            if now - timestamp < self.max_staleness and len(self.signatures) <= self.max_size:
+                break
+            self.signatures.popitem(last=False)
+
+    def is_replay(self, signature:bytes) -> bool:
+        with self.lock:
+            self.evict_signatures()
+            return signature in self.signatures
+
+    def add_signature(self, signature:bytes) -> bool:
+        """
+        returns False if the signature was already seen (concurrent replay)
+        """
+        with self.lock:
+            if signature in self.signatures:
+                return False
+            self.signatures[signature] = c.time()
+            self.evict_signatures()
+            return True
+
+    def get_signature_args(self, input:dict) -> tuple:
+        data = input['data']
+        if not isinstance(data, (str, bytes)):
+            data = c.python2str(data)
+        if isinstance(data, str):
+            data = bytes.fromhex(data[2:]) if data[0:2] == '0x' else data.encode()
+        signature = input['signature']
+        if isinstance(signature, str):
+            signature = bytes.fromhex(signature[2:] if signature[:2].lower() == '0x' else signature)
+        public_key = address2public_key(input['address'])
+        crypto_type = int(input.get('crypto_type', SR25519))
+        return (data, signature, public_key, crypto_type)
+
+    def verify(self, input:dict) -> bool:
+        """
+        input: the signed request {data, signature, address, crypto_type}
+        """
+        args = self.get_signature_args(input)
+        # the replay cache is keyed by the decoded signature, so re-encodings of it ('0x', case) are replays too
+        signature = args[1]
+        if self.is_replay(signature):
+            return False
+        verified = verify_signature(*args)
+        if verified:
+            verified = self.add_signature(signature)
+        return verified
+
+    async def async_verify(self, input:dict) -> bool:
+        args = self.get_signature_args(input)
+        signature = args[1]
+        if self.is_replay(signature):
+            return False
+        loop = asyncio.get_running_loop()
+        if self.batch_size <= 1:
+            verified = await loop.run_in_executor(self.get_executor(n=1), verify_signature, *args)
+        else:
+            future = loop.create_future()
+            self.batch.append((args, future))
+            if len(self.batch) >= self.batch_size:
+                self.flush_batch()
+            elif self.batch_handle == None:
+                self.batch_handle = loop.call_later(self.batch_window, self.flush_batch)
+            verified = await future
+        if verified:
+            verified = self.add_signature(signature)
+        return verified
+
+    def flush_batch(self):
+        if self.batch_handle != None:
+            self.batch_handle.cancel()
+            self.batch_handle = None
+        batch, self.batch = self.batch, []
+        if len(batch) == 0:
+            return
+        loop = batch[0][1].get_loop()
+        task = loop.run_in_executor(self.get_executor(n=len(batch)), verify_signatures, [args for args, _ in batch])
+
+        def set_results(task):
+            try:
+                results = task.result()
+            except Exception as e:
+                c.print(f'Error verifying batch: {e}', color='red')
+                results = [False] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+        task.add_done_callback(set_results)
+
+    def get_executor(self, n:int = 1):
+        if self.mode == 'process' or n >= self.burst_threshold:
+            if self.process_executor == None:
+                self.process_executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self.process_executor
+        if self.thread_executor == None:
+            self.thread_executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='Verifier')
+        return self.thread_executor
+
+    def stats(self) -> dict:
+        return {'signatures': len(self.signatures),
+                'pending': len(self.batch),
+                'public_keys': address2public_key.cache_info()._asdict()}
+
+    @classmethod
+    def test(cls, n:int = 100):
+        self = cls()
+        key = c.get_key('test.verifier')
+        inputs = [key.sign({'i': i, 'timestamp': c.timestamp()}, return_json=True) for i in range(n)]
+        assert all([self.verify(input) for input in inputs[:n//2]])
+        # replays are rejected, also with the signature encoded differently
+        assert not any([self.verify(input) for input in inputs[:n//2]])
+        for input in inputs[:n//2]:
+            signature = input['signature'].replace('0x', '').upper()
+            assert not self.verify({**input, 'signature': signature})
+            assert not self.verify({**input, 'signature': '0x' + signature})
+        async def verify_batch():
+            return await asyncio.gather(*[self.async_verify(input) for input in inputs[n//2:]])
+        assert all(c.gather(verify_batch(), timeout=20))
+        return {'success': True, 'msg': 'verified and rejected replays', **self.stats()}
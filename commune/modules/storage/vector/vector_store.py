@@ -1,112 +1,275 @@
 import commune as c
-import torch
+import os
+import numpy as np
 
 class VectorStore(c.Module):
-    def __init__(self, 
+    """
+    Inner product vector index
+    - vectors live in a preallocated float32 matrix that doubles when full (amortized O(1) appends)
+    - deletes mark a tombstone, the rows are reclaimed by compact()
+    - optional ivf index (kmeans lists, nprobe lists are scanned per query)
+    - save/load as .npy files, loaded memory mapped
+    """
+    def __init__(self,
                     config = None,
                     **kwargs
                  ):
-        self.set_config(config=config, kwargs=kwargs)
+        config = self.set_config(config=config, kwargs=kwargs)
+        self.model = None
+        self.set_index(dim=config.dim, capacity=config.capacity)
+        if config.path != None and self.exists(config.path + '/keys'):
+            self.load(config.path)
+
+    def set_index(self, dim:int = None, capacity:int = 1024):
+        self.dim = dim
+        self.vectors = None if dim == None else np.zeros((capacity, dim), dtype=np.float32)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.n = 0 # rows used (including tombstones)
+        self.keys = [] # row -> key
         self.k2index = {}
-        self.index2k = {}
-        self.vectors = []
-        self.example_vector = None
-        config = self.set_config(config)
-        self.set_model(config.model)
-        
-        
+        # ivf
+        self.centroids = None
+        self.assignments = np.full(capacity, -1, dtype=np.int32) # row -> list
+        self.lists = []
+        self.list_arrays = {}
+        return {'dim': dim, 'capacity': capacity}
+
+    @property
+    def capacity(self) -> int:
+        return 0 if self.vectors is None else len(self.vectors)
+
+    def __len__(self):
+        return len(self.k2index)
 
     def set_model(self, model='model'):
         self.model = c.connect(model)
-        
-        
-        
+
     def encode(self, text:str, **kwargs):
+        if self.model == None:
+            self.set_model(self.config.model)
         return self.model.encode(text, **kwargs)
-    
-
-    def resolve_vector(self, v:torch.Tensor):
-        
-        if isinstance(v, list):
-            v = torch.tensor(v)
-        elif isinstance(v, np.ndarray):
-            v = torch.from_numpy(v)
-            
-        assert isinstance(v, torch.Tensor), f'Expected a torch.Tensor, got {type(v)}'
-        if self.example_vector == None:
-            self.example_vector = v
-        assert self.example_vector.shape == v.shape, f'Expected a vector of shape {self.example_vector.shape}, got {v.shape}'
-        
+
+    def resolve_vectors(self, v) -> np.ndarray:
+        if hasattr(v, 'detach'):
+            v = v.detach().cpu().numpy()
+        v = np.asarray(v, dtype=np.float32)
+        if v.ndim == 1:
+            v = v[None, :]
+        assert v.ndim == 2, f'Expected a vector or a matrix, got shape {v.shape}'
+        if self.dim == None:
+            self.set_index(dim=v.shape[1], capacity=self.config.capacity)
+        assert v.shape[1] == self.dim, f'Expected vectors of dimension {self.dim}, got {v.shape[1]}'
         return v
-    
-    @classmethod
-    def resolve_model(self, model=None):
-        if model == None:
-            model = self.model
-        elif isinstance(model, str):
-            model = c.connect(model)
-            
-        return model
-        
-
-    def embed(self, text:str, model=None, **kwargs):
-        model = self.resolve_model(model)
-        vectors = self.model.embed(text, **kwargs)
-    
-    def add_vector(self, k, v , verbose=True):
-    
-
-        v = self.resolve_vector(v)
-        stacked_vectors = []
-        if len(self.vectors) == 0:
-            stacked_vectors = [v]
-        else:
-            stacked_vectors = [self.vectors, v]
-        
-        self.vectors = torch.stack(stacked_vectors)
-        idx = len(self.vectors) - 1
+
+    def grow(self, n:int):
+        # double the capacity until n rows fit, one copy per doubling
+        capacity = max(self.capacity, 1)
+        while capacity < n:
+            capacity *= 2
+        if capacity == self.capacity:
+            return
+        vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+        vectors[:self.n] = self.vectors[:self.n]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:self.n] = self.alive[:self.n]
+        assignments = np.full(capacity, -1, dtype=np.int32)
+        assignments[:self.n] = self.assignments[:self.n]
+        self.vectors, self.alive, self.assignments = vectors, alive, assignments
+
+    def add_vectors(self, keys:list, vectors) -> dict:
+        """
+        adds (or replaces) the vectors of the keys in one batch
+        """
+        vectors = self.resolve_vectors(vectors)
+        assert len(keys) == len(vectors), f'Got {len(keys)} keys and {len(vectors)} vectors'
+        # replacing a key leaves a tombstone where it was
+        for k in keys:
+            if k in self.k2index:
+                self.rm_vector(k)
+        self.grow(self.n + len(keys))
+        rows = np.arange(self.n, self.n + len(keys))
+        self.vectors[rows] = vectors
+        self.alive[rows] = True
+        for k, row in zip(keys, rows):
+            self.k2index[k] = int(row)
+        self.keys += list(keys)
+        self.n += len(keys)
+        if self.centroids is not None:
+            self.assign(rows)
+        elif self.config.index == 'ivf' and len(self) >= self.config.ivf_min_size:
+            self.train_ivf()
+        return {'success': True, 'added': len(keys), 'n': len(self)}
+
+    def add_vector(self, k, v , verbose=False):
         if verbose:
-            c.print(f'Adding vector {k} at index {idx}, {self.vectors}')
-        self.k2index[k] = idx
-        self.index2k[idx] = k
-        
+            c.print(f'Adding vector {k} at index {self.n}')
+        return self.add_vectors([k], v)
+
     def rm_vector(self, k):
-        last_idx = len(self.vectors) - 1
-        print(f'last_idx: {last_idx}')
-        # swap the vector to be removed with the last vector
-        idx = self.k2index[k]
-        last_k = self.index2k[last_idx]
-        last_v = self.vectors[last_idx]
-        self.vectors[idx] = last_v
-        self.k2index[last_k] = idx
-        self.index2k[idx] = last_k
-        # remove the last vector
-        del self.index2k[last_idx]
-        del self.k2index[last_k]
-        
-        self.vectors = self.vectors[:-1]
-
-
-
-
-    def search(self, query, top_k=10, chunks=1):
-        assert len(self.vectors) > 0, 'No vectors stored in the vector store'
-        c.print(f'query: {query}', 'vector shape:', self.vectors.shape)
-        query_vector = torch.tensor(query) 
-        if len(query_vector.shape) == 1:
-            query_vector = query_vector.unsqueeze(0)
-        # Convert the query into a tensor (assuming it's a vector representation)
-        print(query_vector.shape, self.vectors.shape)
-        similarities = torch.einsum('ij,kj->i', query_vector, self.vectors)  # Compute the similarity scores between the query and stored vectors
-        indices = similarities.argsort(descending=True)[:top_k]  # Sort the similarity scores and retrieve the indices of the top-k results
-        results = {}  # Create an empty dictionary to store the results
-        indices = indices.tolist()  # Convert the indices tensor to a list
-        for idx in indices:
-            key = self.index2k[idx]  # Retrieve the key corresponding to the index
-            score = similarities[idx].item()  # Retrieve the similarity score for the corresponding index
-            results[key] = score  # Store the key-score pair in the results dictionary
-        return results  # Return the dictionary of results
+        idx = self.k2index.pop(k)
+        self.alive[idx] = False
+        list_id = self.assignments[idx]
+        if list_id >= 0:
+            self.list_arrays.pop(int(list_id), None)
+        if self.n - len(self) > self.config.compact_ratio * self.n:
+            self.compact()
+        return {'success': True, 'key': k}
+
+    def compact(self):
+        """
+        drops the tombstones, the rows are renumbered
+        """
+        rows = np.nonzero(self.alive[:self.n])[0]
+        self.vectors[:len(rows)] = self.vectors[rows]
+        self.assignments[:len(rows)] = self.assignments[rows]
+        self.keys = [self.keys[i] for i in rows]
+        self.n = len(rows)
+        self.alive[:] = False
+        self.alive[:self.n] = True
+        self.assignments[self.n:] = -1
+        self.k2index = {k: i for i, k in enumerate(self.keys)}
+        if self.centroids is not None:
+            self.lists = [[] for _ in range(len(self.centroids))]
+            for row, list_id in enumerate(self.assignments[:self.n]):
+                self.lists[list_id].append(row)
+            self.list_arrays = {}
+        return {'success': True, 'n': self.n}
+
+    # IVF
 
+    def train_ivf(self, nlist:int = None, iterations:int = 10, sample_size:int = 100000):
+        """
+        kmeans on a sample of the vectors, then every vector is assigned to its closest centroid
+        """
+        nlist = nlist or self.config.nlist
+        rows = np.nonzero(self.alive[:self.n])[0]
+        assert len(rows) >= nlist, f'Need at least {nlist} vectors to train {nlist} lists, got {len(rows)}'
+        sample = self.vectors[np.random.choice(rows, min(sample_size, len(rows)), replace=False)]
+        centroids = sample[np.random.choice(len(sample), nlist, replace=False)].copy()
+        for i in range(iterations):
+            assignments = self.closest_centroids(sample, centroids)
+            for j in range(nlist):
+                members = sample[assignments == j]
+                if len(members) > 0:
+                    centroids[j] = members.mean(0)
+        self.centroids = centroids
+        self.lists = [[] for _ in range(nlist)]
+        self.list_arrays = {}
+        self.assignments[:] = -1
+        self.assign(rows)
+        return {'success': True, 'nlist': nlist, 'n': len(rows)}
+
+    def closest_centroids(self, vectors:np.ndarray, centroids:np.ndarray, chunk_size:int = 65536) -> np.ndarray:
+        # l2 distance, the norm of the vector does not change the argmin so it is left out
+        centroid_norms = (centroids ** 2).sum(1)
+        return np.concatenate([np.argmin(centroid_norms - 2 * vectors[i:i+chunk_size] @ centroids.T, axis=1)
+                               for i in range(0, len(vectors), chunk_size)])
+
+    def assign(self, rows:np.ndarray):
+        list_ids = self.closest_centroids(self.vectors[rows], self.centroids)
+        self.assignments[rows] = list_ids
+        for row, list_id in zip(rows, list_ids):
+            self.lists[list_id].append(int(row))
+            self.list_arrays.pop(int(list_id), None)
+
+    def get_list(self, list_id:int) -> np.ndarray:
+        # the live rows of a list, cached until the list changes
+        if list_id not in self.list_arrays:
+            rows = np.array(self.lists[list_id], dtype=np.int64)
+            self.list_arrays[list_id] = rows[self.alive[rows]] if len(rows) > 0 else rows
+        return self.list_arrays[list_id]
+
+    # SEARCH
+
+    def topk(self, scores:np.ndarray, rows:np.ndarray, top_k:int) -> dict:
+        if len(scores) > top_k:
+            idx = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            idx = np.arange(len(scores))
+        idx = idx[np.argsort(-scores[idx])]
+        return {self.keys[rows[i]]: float(scores[i]) for i in idx}
+
+    def search_batch(self, queries, top_k:int = 10, nprobe:int = None, chunk_size:int = 1000000) -> list:
+        """
+        the top_k keys and scores of every query
+        """
+        if len(self) == 0:
+            return [{} for _ in range(len(queries))]
+        queries = self.resolve_vectors(queries)
+        if self.centroids is not None:
+            nprobe = min(nprobe or self.config.nprobe, len(self.centroids))
+            # the lists closest to the query, the same distance the vectors were assigned with
+            probes = np.argsort((self.centroids ** 2).sum(1) - 2 * queries @ self.centroids.T, axis=1)[:, :nprobe]
+            results = []
+            for query, query_probes in zip(queries, probes):
+                rows = np.concatenate([self.get_list(int(l)) for l in query_probes])
+                results.append(self.topk(self.vectors[rows] @ query, rows, top_k))
+            return results
+        # exact, scanned in chunks so the scores of a chunk fit in memory
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, self.n, chunk_size):
+            end = min(start + chunk_size, self.n)
+            scores = queries @ self.vectors[start:end].T
+            scores[:, ~self.alive[start:end]] = -np.inf
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, end), scores.shape)], axis=1)
+            if best_scores.shape[1] > top_k:
+                idx = np.argpartition(-best_scores, top_k, axis=1)[:, :top_k]
+                best_scores = np.take_along_axis(best_scores, idx, axis=1)
+                best_rows = np.take_along_axis(best_rows, idx, axis=1)
+        results = []
+        for scores, rows in zip(best_scores, best_rows):
+            alive = scores > -np.inf
+            results.append(self.topk(scores[alive], rows[alive], top_k))
+        return results
+
+    def search(self, query, top_k=10, nprobe:int = None, **kwargs):
+        assert len(self) > 0, 'No vectors stored in the vector store'
+        query = np.asarray(query, dtype=np.float32)
+        results = self.search_batch(query, top_k=top_k, nprobe=nprobe)
+        return results[0] if query.ndim == 1 else results
+
+    # PERSISTENCE
+    # the index config is saved with the centroids, so a loaded store searches the same lists
+    index_config_keys = ['index', 'ivf_min_size', 'nlist', 'nprobe']
+
+    def save(self, path:str = None):
+        """
+        writes the live rows (compacted) as .npy files
+        """
+        path = self.resolve_path(path or self.config.path)
+        os.makedirs(path, exist_ok=True)
+        self.compact()
+        np.save(os.path.join(path, 'vectors.npy'), self.vectors[:self.n])
+        np.save(os.path.join(path, 'assignments.npy'), self.assignments[:self.n])
+        if self.centroids is not None:
+            np.save(os.path.join(path, 'centroids.npy'), self.centroids)
+        self.put_json(os.path.join(path, 'keys'), self.keys)
+        self.put_json(os.path.join(path, 'index'), {k: self.config[k] for k in self.index_config_keys})
+        return {'success': True, 'path': path, 'n': self.n}
+
+    def load(self, path:str = None):
+        """
+        the vectors are memory mapped (copy on write), they are copied into memory on the first growth
+        """
+        path = self.resolve_path(path or self.config.path)
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='c')
+        self.dim = self.vectors.shape[1]
+        self.keys = self.get_json(os.path.join(path, 'keys'))
+        self.n = len(self.keys)
+        self.k2index = {k: i for i, k in enumerate(self.keys)}
+        self.alive = np.ones(self.n, dtype=bool)
+        self.assignments = np.load(os.path.join(path, 'assignments.npy'))
+        self.config.update(self.get_json(os.path.join(path, 'index'), default={}))
+        centroids_path = os.path.join(path, 'centroids.npy')
+        self.centroids = np.load(centroids_path) if os.path.exists(centroids_path) else None
+        self.lists, self.list_arrays = [], {}
+        if self.centroids is not None:
+            self.lists = [[] for _ in range(len(self.centroids))]
+            for row, list_id in enumerate(self.assignments):
+                self.lists[list_id].append(row)
+        return {'success': True, 'path': path, 'n': self.n}
 
     @classmethod
     def test(cls):
@@ -114,8 +277,25 @@ class VectorStore(c.Module):
         self.add_vector('test', [1,2,3])
         assert self.search([1,2,3]) == {'test': 14.0}
         self.rm_vector('test')
-        assert len(self.vectors) == 0
+        assert len(self) == 0
         print('test passed')
-        
-        
-        
+
+    @classmethod
+    def test_ivf(cls, n:int = 20000, dim:int = 64, top_k:int = 10, num_queries:int = 100):
+        self = cls(index='ivf', ivf_min_size=n, nlist=64, nprobe=8)
+        vectors = np.random.randn(n, dim).astype(np.float32)
+        self.add_vectors(list(range(n)), vectors)
+        assert self.centroids is not None
+        queries = vectors[:num_queries]
+        t = c.time()
+        results = self.search_batch(queries, top_k=top_k)
+        latency = (c.time() - t) / num_queries
+        # the query vector itself is in the lists that are probed first
+        recall = np.mean([i in r for i, r in enumerate(results)])
+        assert recall > 0.9, recall
+        path = 'test_vector_store'
+        self.save(path)
+        other = cls(path=path)
+        assert other.search_batch(queries[:1], top_k=top_k) == results[:1]
+        cls.rm(path)
+        return {'success': True, 'recall': recall, 'latency_per_query': latency}
@@ -5,11 +5,70 @@ import json
 import os
 import commune as c
 import requests 
+import threading
 from substrateinterface import SubstrateInterface
 
 U32_MAX = 2**32 - 1
 U16_MAX = 2**16 - 1
 
+def concat_hash_len(key_hasher: str) -> int:
+    # the hashers that keep the key after the hash, and the length of the hash
+    if key_hasher == "Blake2_128Concat":
+        return 16
+    elif key_hasher == "Twox64Concat":
+        return 8
+    elif key_hasher == "Identity":
+        return 0
+    else:
+        raise ValueError(f'Unsupported hash type {key_hasher}')
+
+# one substrate per url in each decode process, it is only used for its runtime (the types)
+decode_substrates = {}
+
+def decode_storage_items(url:str, block_hash:str, key_type:str, value_type:str, prefix_length:int, items:list, substrate:SubstrateInterface = None) -> tuple:
+    """
+    decodes raw (key, value) hex pairs of a storage map into columns, 
+    this is a module function so it can run in a process pool
+    substrate: decode with this connection instead of the process one for the url
+    """
+    if substrate == None:
+        if url not in decode_substrates:
+            decode_substrates[url] = SubstrateInterface(url=url)
+        substrate = decode_substrates[url]
+    keys, values = [], []
+    for k, v in items:
+        # the key is (hash, param, hash, param, ...), the params are the key of the entry
+        key = substrate.decode_scale(type_string=key_type, scale_bytes='0x' + k[prefix_length:], block_hash=block_hash)
+        keys.append(list(key[1::2]))
+        values.append(None if v == None else substrate.decode_scale(type_string=value_type, scale_bytes=v, block_hash=block_hash))
+    return keys, values
+
+class PooledSubstrate:
+    """
+    a pooled connection shared by threads, every method call holds the connection lock for the whole operation
+    (init_runtime, query, ...), `with substrate:` holds it across calls that depend on the same runtime
+    """
+    def __init__(self, substrate:SubstrateInterface, url:str, **kwargs):
+        self.substrate = substrate
+        self.lock = threading.RLock()
+        self.pool_info = {'url': url, 'kwargs': kwargs, 'last_checked': c.time()}
+
+    def __getattr__(self, key:str):
+        attr = getattr(self.substrate, key)
+        if not callable(attr):
+            return attr
+        def locked(*args, **kwargs):
+            with self.lock:
+                return attr(*args, **kwargs)
+        return locked
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.lock.release()
+
 class Subspace(c.Module):
     """
     Handles interactions with the subspace chain.
@@ -51,39 +110,127 @@ class Subspace(c.Module):
         **kwargs,
     ):
         config = self.set_config(kwargs=kwargs)
+        # block hash -> {storage path: map}, maps at the same block are one snapshot
+        self.snapshots = {}
+        self.snapshots_lock = threading.Lock()
     connection_mode = 'ws'
 
-    def resolve_url(self, url:str = None, network:str = network, mode=None , **kwargs):
+    def resolve_urls(self, network:str = network, mode=None, **kwargs) -> List[str]:
+        """
+        the node urls of the providers in url_search
+        """
         mode = mode or self.config.connection_mode
         network = 'network' or self.config.network
-        if url == None:
-            
-            url_search_terms = [x.strip() for x in self.config.url_search.split(',')]
-            is_match = lambda x: any([url in x for url in url_search_terms])
-            urls = []
-            for provider, mode2url in self.config.urls.items():
-                if is_match(provider):
-                    chain = c.module('subspace.chain')
-                    if provider == 'commune':
-                        url = chain.resolve_node_url(url=url, chain=network, mode=mode) 
-                    elif provider == 'local':
-                        url = chain.resolve_node_url(url=url, chain='local', mode=mode)
-                    else:
-                        url = mode2url[mode]
+        url_search_terms = [x.strip() for x in self.config.url_search.split(',')]
+        is_match = lambda x: any([url in x for url in url_search_terms])
+        urls = []
+        for provider, mode2url in self.config.urls.items():
+            if is_match(provider):
+                chain = c.module('subspace.chain')
+                if provider == 'commune':
+                    url = chain.resolve_node_url(url=None, chain=network, mode=mode) 
+                elif provider == 'local':
+                    url = chain.resolve_node_url(url=None, chain='local', mode=mode)
+                else:
+                    url = mode2url[mode]
 
-                    if isinstance(url, list):
-                        urls += url
-                    else:
-                        urls += [url] 
+                if isinstance(url, list):
+                    urls += url
+                else:
+                    urls += [url] 
+        ip = c.ip()
+        return [url.replace(ip, '0.0.0.0') for url in urls]
 
-            url = c.choice(urls)
-        
+    def resolve_url(self, url:str = None, network:str = network, mode=None , **kwargs):
+        if url == None:
+            # round robin over the urls, a Subspace keeps its url so one query never mixes nodes
+            pinned_urls = self.__dict__.setdefault('pinned_urls', {})
+            key = (network, mode or self.config.connection_mode)
+            if key not in pinned_urls:
+                urls = self.resolve_urls(network=network, mode=mode)
+                with self.pool_lock:
+                    pinned_urls[key] = urls[self.url_counter % len(urls)]
+                    Subspace.url_counter += 1
+            url = pinned_urls[key]
         url = url.replace(c.ip(), '0.0.0.0')
-        
-
         return url
-    
-    url2substrate = {}
+
+    def unpin_url(self, network:str = network, mode=None):
+        # the next resolve_url moves on to the next url
+        self.__dict__.get('pinned_urls', {}).pop((network, mode or self.config.connection_mode), None)
+    
+    # SUBSTRATE POOL
+    # a fixed number of connections per url shared by every Subspace in the process,
+    # the operations on a connection are serialized by its lock so it can be used from any thread
+    url2pool = {}
+    pool_lock = threading.Lock()
+    url_counter = 0
+
+    def connect_substrate(self, url:str, **kwargs) -> PooledSubstrate:
+        return PooledSubstrate(SubstrateInterface(url=url, **kwargs), url, **kwargs)
+
+    def is_healthy(self, substrate:PooledSubstrate) -> bool:
+        websocket = getattr(substrate, 'websocket', None)
+        if websocket != None and not getattr(websocket, 'connected', True):
+            return False
+        if c.time() - substrate.pool_info['last_checked'] > self.config.substrate_health_interval:
+            try:
+                substrate.rpc_request('system_health', [])
+            except Exception as e:
+                return False
+            substrate.pool_info['last_checked'] = c.time()
+        return True
+
+    def get_pooled_substrate(self, url:str, **kwargs) -> PooledSubstrate:
+        """
+        the next connection of the url (round robin), unhealthy connections are replaced
+        """
+        with self.pool_lock:
+            pool = self.url2pool.setdefault(url, {'substrates': [], 'locks': [], 'counter': 0})
+            if len(pool['substrates']) < self.config.substrate_pool_size:
+                idx = len(pool['substrates'])
+                pool['substrates'].append(None)
+                pool['locks'].append(threading.Lock())
+            else:
+                idx = pool['counter'] % len(pool['substrates'])
+                pool['counter'] += 1
+            slot_lock = pool['locks'][idx]
+        # the health check and the replacement are one step, so a dropped connection is replaced once
+        with slot_lock:
+            substrate = pool['substrates'][idx]
+            if substrate == None or not self.is_healthy(substrate):
+                substrate = pool['substrates'][idx] = self.connect_substrate(url, **kwargs)
+        return substrate
+
+    def get_substrates(self, url:str = None, n:int = None, **kwargs) -> List[PooledSubstrate]:
+        """
+        n distinct connections of the url from the pool (for parallel requests)
+        """
+        url = url or self.url
+        pool_size = self.config.substrate_pool_size
+        n = min(n or pool_size, pool_size)
+        substrates = []
+        for i in range(pool_size):
+            substrate = self.get_pooled_substrate(url, **kwargs)
+            if all([s is not substrate for s in substrates]):
+                substrates.append(substrate)
+            if len(substrates) >= n:
+                break
+        return substrates
+
+    @classmethod
+    def close_substrates(cls):
+        with cls.pool_lock:
+            for url, pool in cls.url2pool.items():
+                for substrate in pool['substrates']:
+                    if substrate != None:
+                        try:
+                            substrate.close()
+                        except Exception as e:
+                            pass
+            cls.url2pool = {}
+        return {'success': True}
+
     def get_substrate(self, 
                 network:str = 'main',
                 url : str = None,
@@ -108,55 +255,52 @@ class Subspace(c.Module):
         A specialized class in interfacing with a Substrate node.
 
         Parameters
-       A specialized class in interfacing with a Substrate node.
-
-        Parameters
-        url : the URL to the substrate node, either in format <https://127.0.0.1:9933> or wss://127.0.0.1:9944
+        url : the URL to the substrate node, either in format <https://127.0.0.1:9933> or wss://127.0.0.1:9944
         
-        ss58_format : The address type which account IDs will be SS58-encoded to Substrate addresses. Defaults to 42, for Kusama the address type is 2
+        ss58_format : The address type which account IDs will be SS58-encoded to Substrate addresses. Defaults to 42, for Kusama the address type is 2
         
-        type_registry : A dict containing the custom type registry in format: {'types': {'customType': 'u32'},..}
+        type_registry : A dict containing the custom type registry in format: {'types': {'customType': 'u32'},..}
         
-        type_registry_preset : The name of the predefined type registry shipped with the SCALE-codec, e.g. kusama
+        type_registry_preset : The name of the predefined type registry shipped with the SCALE-codec, e.g. kusama
         
-        cache_region : a Dogpile cache region as a central store for the metadata cache
+        cache_region : a Dogpile cache region as a central store for the metadata cache
         
-        use_remote_preset : When True preset is downloaded from Github master, otherwise use files from local installed scalecodec package
+        use_remote_preset : When True preset is downloaded from Github master, otherwise use files from local installed scalecodec package
         
-        ws_options : dict of options to pass to the websocket-client create_connection function
-        : dict of options to pass to the websocket-client create_connection function
-                
-        '''
-        if cache:
-            if url in self.url2substrate:
-                return self.url2substrate[url]
-
+        ws_options : dict of options to pass to the websocket-client create_connection function
+        : dict of options to pass to the websocket-client create_connection function
 
+        cache : use the connection pool (a connection per url is shared), otherwise open a new connection
+        '''
+        kwargs = dict(websocket=websocket, 
+                    ss58_format=ss58_format, 
+                    type_registry=type_registry, 
+                    type_registry_preset=type_registry_preset, 
+                    cache_region=cache_region, 
+                    runtime_config=runtime_config, 
+                    ws_options=ws_options, 
+                    auto_discover=auto_discover, 
+                    auto_reconnect=auto_reconnect)
+
+        resolved_url = url
         while trials > 0:
             try:
-                url = self.resolve_url(url, mode=mode, network=network)
-
-                substrate= SubstrateInterface(url=url, 
-                            websocket=websocket, 
-                            ss58_format=ss58_format, 
-                            type_registry=type_registry, 
-                            type_registry_preset=type_registry_preset, 
-                            cache_region=cache_region, 
-                            runtime_config=runtime_config, 
-                            ws_options=ws_options, 
-                            auto_discover=auto_discover, 
-                            auto_reconnect=auto_reconnect)
+                resolved_url = self.resolve_url(url, mode=mode, network=network)
+                if cache:
+                    substrate = self.get_pooled_substrate(resolved_url, **kwargs)
+                else:
+                    substrate = self.connect_substrate(resolved_url, **kwargs)
                 break
             except Exception as e:
                 trials = trials - 1
-                if trials > 0:
+                c.print(f'Could not connect to {resolved_url} {e}', color='red')
+                # the next trial moves on to the next url
+                self.unpin_url(network=network, mode=mode)
+                if trials == 0:
                     raise e
-        
-        if cache:
-            self.url2substrate[url] = substrate
 
         self.network = network
-        self.url = url
+        self.url = resolved_url
         
         return substrate
 
@@ -181,7 +325,12 @@ class Subspace(c.Module):
 
 
     def rank_modules(self,search=None, k='stake', n=10, modules=None, reverse=True, names=False, **kwargs):
-        modules = self.modules(search=search, **kwargs) if modules == None else modules
+        if modules == None:
+            table = self.modules(search=search, df=True, sortby=None, **kwargs)
+            table = table.sort_values(k, ascending=not reverse, kind='stable')
+            if names:
+                return table['name'].tolist()[:n]
+            return table.iloc[:n].to_dict('records')
         modules = sorted(modules, key=lambda x: x[k], reverse=reverse)
         if names:
             return [m['name'] for m in modules]
@@ -326,7 +475,7 @@ class Subspace(c.Module):
         response =  substrate.query(
             module=module,
             storage_function = name,
-            block_hash = None if block == None else substrate.get_block_hash(block), 
+            block_hash = None if block == None else self.block_hash(block, network=network), 
             params = params
         )
         value =  response.value
@@ -361,6 +510,8 @@ class Subspace(c.Module):
     
 
 
+    max_snapshots = 4 # blocks kept in memory and on disk
+
     def query_map(self, name: str = 'StakeFrom', 
                   params: list = None,
                   block: Optional[int] = None, 
@@ -387,7 +538,7 @@ class Subspace(c.Module):
 
         network = self.resolve_network(network, new_connection=new_connection, mode=mode)
 
-        path = f'query/{network}/{module}.{name}'
+        storage_path = f'{module}.{name}'
         # resolving the params
         params = params or []
 
@@ -398,40 +549,35 @@ class Subspace(c.Module):
         if not isinstance(params, list):
             params = [params]
         if len(params) > 0 :
-            path = path + f'::params::' + '-'.join([str(p) for p in params])
+            storage_path = storage_path + f'::params::' + '-'.join([str(p) for p in params])
 
-        value = None if update else self.get(path, None, max_age=max_age)
-        
-        if value == None:
-            network = self.resolve_network(network)
-            # if the value is a tuple then we want to convert it to a list
-            block = block or self.block
-            substrate = self.get_substrate(network=network, mode=mode)
-            qmap =  substrate.query_map(
-                module=module,
-                storage_function = name,
-                params = params,
-                page_size = page_size,
-                max_results = max_results,
-                block_hash =substrate.get_block_hash(block)
-            )
-
-            new_qmap = {} 
-            progress_bar = c.progress(qmap, desc=f'Querying {name} map')
-            for (k,v) in qmap:
-                progress_bar.update(1)
-                if not isinstance(k, tuple):
-                    k = [k]
-                if type(k) in [tuple,list]:
-                    # this is a double map
-                    k = [_k.value for _k in k]
-                if hasattr(v, 'value'):
-                    v = v.value
-                    c.dict_put(new_qmap, k, v)
+        substrate = self.get_substrate(network=network, mode=mode)
+        if block == None and not update:
+            # the latest snapshot of this map, if it is recent enough
+            latest = self.get(f'query_map/{network}/latest/{storage_path}', None, max_age=max_age)
+            block_hash = latest['block_hash'] if latest != None else None
         else:
-            new_qmap = value
+            block_hash = self.block_hash(block, network=network)
 
-        # this is a double
+        new_qmap = None
+        if block_hash != None:
+            new_qmap = self.load_snapshot(network, block_hash, storage_path)
+        
+        if new_qmap == None:
+            block_hash = block_hash or self.block_hash(network=network)
+            keys, values = self.query_map_columns(module=module, 
+                                                  name=name, 
+                                                  params=params, 
+                                                  block_hash=block_hash, 
+                                                  network=network, 
+                                                  mode=mode,
+                                                  page_size=page_size, 
+                                                  max_results=max_results)
+            self.save_snapshot(network, block_hash, storage_path, {'keys': keys, 'values': values})
+            self.put(f'query_map/{network}/latest/{storage_path}', {'block_hash': block_hash})
+            new_qmap = self.cache_snapshot(block_hash, storage_path, self.columns2map(keys, values))
+            
+        # the cached map is shared, the dicts below are new so callers can change them
         if isinstance(new_qmap, dict) and len(new_qmap) > 0:
 
             k = list(new_qmap.keys())[0]    
@@ -446,10 +592,188 @@ class Subspace(c.Module):
                     if c.is_digit(_k):
                         new_qmap[k] = dict(sorted(new_qmap[k].items(), key=lambda x: x[0]))
                         new_qmap[k] = {int(_k): _v for _k, _v in v.items()}
-
-        self.put(path, new_qmap)
+                    else:
+                        new_qmap[k] = dict(v)
 
         return new_qmap
+
+    @staticmethod
+    def columns2map(keys:list, values:list) -> dict:
+        # nested dict, one level per key param
+        qmap = {}
+        for key, value in zip(keys, values):
+            d = qmap
+            for k in key[:-1]:
+                d = d.setdefault(k, {})
+            d[key[-1]] = value
+        return qmap
+
+    def query_map_columns(self, 
+                          module:str, 
+                          name:str, 
+                          params:list, 
+                          block_hash:str, 
+                          network:str = 'main',
+                          mode:str = 'ws',
+                          page_size:int = 1000, 
+                          max_results:int = 100000,
+                          connections:int = None,
+                          decode_workers:int = None,
+                          return_items:bool = False) -> Tuple[list, list]:
+        """
+        fetches a storage map at the block as columns (keys, values)
+        - the storage keys are paged in order, every page of values is fetched as soon as its keys arrive,
+          over a pool of connections
+        - big maps are decoded in a process pool
+        return_items: also return the raw (storage key, value) hex pairs
+        """
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+        import queue
+        connections = connections or self.config.query_map_connections
+        decode_workers = self.config.decode_workers if decode_workers == None else decode_workers
+        substrate = self.get_substrate(network=network, mode=mode)
+        storage_types = self.storage_types(module=module, name=name, params=params, block_hash=block_hash, substrate=substrate)
+        key_type, value_type, prefix = storage_types['key_type'], storage_types['value_type'], storage_types['prefix']
+
+        # a connection is used by one thread at a time
+        pool = queue.Queue()
+        for s in self.get_substrates(url=self.url, n=connections):
+            pool.put(s)
+
+        def fetch_values(keys):
+            substrate = pool.get()
+            try:
+                response = substrate.rpc_request(method="state_queryStorageAt", params=[keys, block_hash])
+            finally:
+                pool.put(substrate)
+            return [item for group in response['result'] for item in group['changes']]
+
+        items = []
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = []
+            start_key = None
+            num_keys = 0
+            while num_keys < max_results:
+                substrate = pool.get()
+                try:
+                    response = substrate.rpc_request(method="state_getKeysPaged", 
+                                                     params=[prefix, min(page_size, max_results - num_keys), start_key or prefix, block_hash])
+                finally:
+                    pool.put(substrate)
+                keys = response['result']
+                if len(keys) == 0:
+                    break
+                futures.append(executor.submit(fetch_values, keys))
+                num_keys += len(keys)
+                start_key = keys[-1]
+                if len(keys) < page_size:
+                    break
+            for future in futures:
+                items += future.result()
+
+        prefix_length = len(prefix)
+        url = self.url
+        if decode_workers > 0 and len(items) > self.config.decode_threshold:
+            chunk_size = len(items) // decode_workers + 1
+            chunks = [items[i:i+chunk_size] for i in range(0, len(items), chunk_size)]
+            with ProcessPoolExecutor(max_workers=decode_workers) as executor:
+                futures = [executor.submit(decode_storage_items, url, block_hash, key_type, value_type, prefix_length, chunk) for chunk in chunks]
+                results = [f.result() for f in futures]
+        else:
+            with substrate:
+                results = [decode_storage_items(url, block_hash, key_type, value_type, prefix_length, items, substrate=substrate)]
+        keys, values = [], []
+        for k, v in results:
+            keys += k
+            values += v
+        if return_items:
+            return keys, values, items
+        return keys, values
+
+    def storage_types(self, 
+                      module:str, 
+                      name:str, 
+                      params:list = None, 
+                      block_hash:str = None, 
+                      network:str = 'main', 
+                      substrate:PooledSubstrate = None) -> dict:
+        """
+        the scale types of the keys (after the params) and values of a storage map, and its storage key prefix
+        """
+        params = params or []
+        substrate = substrate or self.get_substrate(network=network)
+        # init_runtime switches the runtime of the connection, so the metadata is read under the same lock
+        with substrate:
+            substrate.init_runtime(block_hash=block_hash)
+            storage_function = substrate.metadata.get_metadata_pallet(module).get_storage_function(name)
+            param_types = storage_function.get_params_type_string()
+            key_hashers = storage_function.get_param_hashers()
+            value_type = storage_function.get_value_type_string()
+            prefix = substrate.create_storage_key(module, name, params, block_hash=block_hash).to_hex()
+        key_type = []
+        for i in range(len(params), len(param_types)):
+            key_type += [f'[u8; {concat_hash_len(key_hashers[i])}]', param_types[i]]
+        key_type = f"({', '.join(key_type)})"
+        return {'key_type': key_type, 'value_type': value_type, 'prefix': prefix}
+
+    def snapshot_path(self, network:str, block_hash:str, storage_path:str) -> str:
+        return self.resolve_path(f'query_map/{network}/{block_hash}/{storage_path}.msgpack')
+
+    def save_snapshot(self, network:str, block_hash:str, storage_path:str, columns:dict):
+        """
+        the map as columns {keys, values} in msgpack, one directory per block
+        """
+        import msgpack
+        path = self.snapshot_path(network, block_hash, storage_path)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(msgpack.packb(columns, use_bin_type=True))
+        os.replace(path + '.tmp', path)
+        # keep a few snapshots on disk, the blocks of the latest pointers are never removed
+        latest = self.latest_block_hashes(network) | {block_hash}
+        blocks = sorted(self.glob(f'query_map/{network}/0x*', files_only=False), key=os.path.getmtime)
+        for old_block in blocks[:-self.max_snapshots]:
+            if os.path.basename(old_block) not in latest:
+                self.rm(old_block)
+        return path
+
+    def latest_block_hashes(self, network:str) -> set:
+        """
+        the block hashes that the latest/ pointers of the network refer to
+        """
+        block_hashes = set()
+        for path in self.glob(f'query_map/{network}/latest'):
+            try:
+                with open(path) as f:
+                    block_hashes.add(json.load(f)['data']['block_hash'])
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+        return block_hashes
+
+    def cache_snapshot(self, block_hash:str, storage_path:str, qmap:dict) -> dict:
+        """
+        keeps the map in memory, the oldest blocks are evicted past max_snapshots
+        """
+        with self.snapshots_lock:
+            self.snapshots.setdefault(block_hash, {})[storage_path] = qmap
+            while len(self.snapshots) > self.max_snapshots:
+                self.snapshots.pop(next(b for b in self.snapshots if b != block_hash))
+        return qmap
+
+    def load_snapshot(self, network:str, block_hash:str, storage_path:str) -> Optional[dict]:
+        """
+        the map at the block, the cached map is shared so it must not be changed
+        """
+        with self.snapshots_lock:
+            qmap = self.snapshots.get(block_hash, {}).get(storage_path)
+        if qmap != None:
+            return qmap
+        path = self.snapshot_path(network, block_hash, storage_path)
+        if not os.path.exists(path):
+            return None
+        import msgpack
+        with open(path, 'rb') as f:
+            columns = msgpack.unpackb(f.read(), raw=False, strict_map_key=False)
+        return self.cache_snapshot(block_hash, storage_path, self.columns2map(columns['keys'], columns['values']))
     
     def runtime_spec_version(self, network:str = 'main'):
         # Get the runtime version
@@ -839,9 +1163,15 @@ class Subspace(c.Module):
         return {'success': True, 'block': self.block}
 
 
-    def loop(self, intervals = {'light': 5, 'full': 600}, network=None, remote:bool=True):
+    def loop(self, intervals = {'light': 5, 'full': 600}, network=None, remote:bool=True, sync:bool = False):
+        """
+        sync: follow the chain block by block with subspace.sync (only the changed entries are fetched),
+        otherwise resync the whole state every intervals['full'] seconds
+        """
         if remote:
-            return self.remote_fn('loop', kwargs=dict(intervals=intervals, network=network, remote=False))
+            return self.remote_fn('loop', kwargs=dict(intervals=intervals, network=network, remote=False, sync=sync))
+        if sync:
+            return c.module('subspace.sync')(network=network or self.config.network).run()
         last_update = {k:0 for k in intervals.keys()}
         staleness = {k:0 for k in intervals.keys()}
         c.get_event_loop()
@@ -1369,13 +1699,24 @@ class Subspace(c.Module):
         self.resolve_network(network)
         return self.substrate.get_block( block_hash=block_hash)['header']['number']
 
+    # (network, block) -> block hash, a block resolves to one hash per process,
+    # so the maps read at a block in one modules()/state_dict call are from the same block
+    block_hashes = {}
+    max_block_hashes = 1024
+    block_hashes_lock = threading.Lock()
+
     def block_hash(self, block = None, network='main'): 
         if block == None:
             block = self.block
-
-        substrate = self.get_substrate(network=network)
-        
-        return substrate.get_block_hash(block)
+        key = (network, block)
+        if key not in self.block_hashes:
+            block_hash = self.get_substrate(network=network).get_block_hash(block)
+            with self.block_hashes_lock:
+                if len(self.block_hashes) >= self.max_block_hashes:
+                    self.block_hashes.pop(next(iter(self.block_hashes)), None)
+                # the first resolved hash wins
+                self.block_hashes.setdefault(key, block_hash)
+        return self.block_hashes[key]
 
 
     def hash2block(self, network=None, block_hash=None):
@@ -1478,44 +1819,31 @@ class Subspace(c.Module):
         return {'name': None, 'key': None, 'uid': None, 'address': None, 'stake': 0, 'balance': 0, 'emission': 0, 'incentive': 0, 'dividends': 0, 'stake_to': {}, 'stake_from': {}, 'weight': []}
         
         
-    def name2module(self, name:str = None, netuid: int = None, **kwargs) -> 'ModuleInfo':
-        modules = self.modules(netuid=netuid, **kwargs)
-        name2module = { m['name']: m for m in modules }
-        default = {}
+    def name2module(self, name:str = None, netuid: int = 0, fmt:str = 'nano', **kwargs) -> 'ModuleInfo':
         if name != None:
-            return name2module.get(name, self.null_module)
-        return name2module
-        
-        
-        
-        
-        
-    def key2module(self, key: str = None, netuid: int = None, default: dict =None, **kwargs) -> Dict[str, str]:
-        modules = self.modules(netuid=netuid, **kwargs)
-        key2module =  { m['key']: m for m in modules }
+            module = self.lookup_module(name, field='name', netuid=netuid, fmt=fmt, **kwargs)
+            return module if module != None else self.null_module
+        table = self.module_table(netuid=netuid, fmt=fmt, **kwargs)
+        return dict(zip(table['name'], table.to_dict('records')))
         
+    def key2module(self, key: str = None, netuid: int = 0, default: dict =None, fmt:str = 'nano', **kwargs) -> Dict[str, str]:
         if key != None:
             key_ss58 = self.resolve_key_ss58(key)
-            return  key2module.get(key_ss58, default if default != None else {})
-        return key2module
-        
-    def module2key(self, module: str = None, **kwargs) -> Dict[str, str]:
-        modules = self.modules(**kwargs)
-        module2key =  { m['name']: m['key'] for m in modules }
+            module = self.lookup_module(key_ss58, field='key', netuid=netuid, fmt=fmt, **kwargs)
+            return module if module != None else (default if default != None else {})
+        table = self.module_table(netuid=netuid, fmt=fmt, **kwargs)
+        return dict(zip(table['key'], table.to_dict('records')))
         
+    def module2key(self, module: str = None, netuid: int = 0, fmt:str = 'nano', **kwargs) -> Dict[str, str]:
         if module != None:
-            return module2key[module]
-        return module2key
-    
-
-    
-    
+            info = self.lookup_module(module, field='name', netuid=netuid, fmt=fmt, **kwargs)
+            return info['key'] if info != None else None
+        table = self.module_table(netuid=netuid, fmt=fmt, **kwargs)
+        return dict(zip(table['name'], table['key']))
 
-    def module2stake(self,*args, **kwargs) -> Dict[str, str]:
-        
-        module2stake =  { m['name']: m['stake'] for m in self.modules(*args, **kwargs) }
-        
-        return module2stake
+    def module2stake(self, netuid: int = 0, fmt:str = 'nano', **kwargs) -> Dict[str, str]:
+        table = self.module_table(netuid=netuid, fmt=fmt, **kwargs)
+        return dict(zip(table['name'], table['stake'].tolist()))
 
     @classmethod
     def get_feature(cls, feature, **kwargs):
@@ -1563,6 +1891,153 @@ class Subspace(c.Module):
         'address': 'addresses',
         'name': 'names',
         }
+    def get_raw_modules(self,
+                network = 'main',
+                netuid: int = 0,
+                block: Optional[int] = None,
+                features : List[str] = module_features,
+                timeout = 100,
+                update: bool = False,
+                **kwargs) -> List['ModuleInfo']:
+        """
+        the unformatted modules of a subnet (amounts in nano), fetched from the chain on update
+        """
+        path = f'modules/{network}.{netuid}'
+        modules = [] if update else self.get(path, [])
+        if len(modules) > 0:
+            return modules
+
+        block = block or self.block
+        # pin the block hash before the features are fetched in parallel
+        self.block_hash(block, network=network)
+        state = {}
+        key2future = {}
+        while len(state) < len(features):
+            features_left = [f for f in features if f not in state and f not in key2future]                
+            c.print( f'Fetching {features_left} ')
+            for f in features_left:
+                kw = dict(feature=self.feature2key.get(f,f), 
+                          network=network, 
+                          netuid=netuid, 
+                          block=block, 
+                          update=True)
+                key2future[f] = c.submit(self.get_feature,kwargs=kw)
+            future2key = {v:k for k,v in key2future.items()}
+            futures = list(key2future.values())
+
+            progress = c.tqdm(total=len(futures), desc=f'Fetching {len(futures)} features')
+        
+            for future in  c.as_completed(futures, timeout=timeout):
+                key = future2key[future]
+                result = future.result()
+                futures.remove(future)  
+                if not c.is_error(result):
+                    progress.update(1)
+                    state[key] = result
+                else:
+                    c.print('Error fetching feature', key, result)
+                    break
+
+        for uid, key in enumerate(state['key']):
+            module = { 'uid': uid, 'key': key}
+            for  f in features:
+                if f in ['name', 'address', 'emission', 'incentive', 
+                         'dividends', 'last_update', 'regblock']:
+                    module[f] = state[f][uid]
+                elif f in ['trust']:
+                    module[f] = state[f][uid] if len(state[f]) > uid else 0
+                elif f in ['delegation_fee']:
+                    module[f] = state[f].get(key, 20)
+                elif f in ['stake_from']:
+                    module[f] = state[f].get(key, [])
+                    module['stake'] =  sum([v for k,v in module['stake_from']])
+                elif f in ['weights']:
+                    module[f] = state[f].get(uid, [])
+            modules.append(module)
+        self.put(path, modules)
+        return modules
+
+    # MODULE TABLE
+    # the modules of a subnet as columns indexed by uid, formatted once with vectorized ops
+    # and kept in memory until the stored modules change
+    module_tables = {}
+
+    def format_table(self, table: 'pd.DataFrame', fmt:str='j') -> 'pd.DataFrame':
+        import numpy as np
+        for k in ['emission', 'stake']:
+            if k in table:
+                table[k] = self.format_amount(table[k].to_numpy(dtype=np.float64), fmt=fmt)
+        for k in ['incentive', 'dividends']:
+            if k in table:
+                table[k] = table[k].to_numpy(dtype=np.float64) / U16_MAX
+        if 'stake_from' in table:
+            stake_from = [list(v.items()) if isinstance(v, dict) else v for v in table['stake_from']]
+            # flatten the (key, amount) pairs so the amounts are converted and summed in one pass
+            lengths = np.array([len(v) for v in stake_from], dtype=np.int64)
+            amounts = np.array([a for v in stake_from for _, a in v], dtype=np.float64)
+            amounts = self.format_amount(amounts, fmt=fmt)
+            table['stake'] = np.bincount(np.repeat(np.arange(len(table)), lengths), weights=amounts, minlength=len(table))
+            offsets = np.concatenate([[0], np.cumsum(lengths)])
+            amounts = amounts.tolist()
+            table['stake_from'] = [[[k, amounts[offsets[i] + j]] for j, (k, _) in enumerate(v)] for i, v in enumerate(stake_from)]
+        return table
+
+    @staticmethod
+    def file_version(path:str) -> Optional[tuple]:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def module_table_entry(self,
+                     network = 'main',
+                     netuid: int = 0,
+                     fmt:str = 'j',
+                     features : List[str] = None,
+                     lite: bool = True,
+                     update: bool = False,
+                     **kwargs) -> dict:
+        """
+        the module table with its name and key indexes
+        """
+        import pandas as pd
+        features = list(features or (self.lite_module_features if lite else self.module_features))
+        if 'stake_from' in features and 'stake' not in features:
+            features += ['stake']
+        path = self.resolve_path(f'modules/{network}.{netuid}', extension='json')
+        table_key = (network, netuid, fmt, tuple(features))
+        entry = self.module_tables.get(table_key)
+        if not update and entry != None and entry['version'] == self.file_version(path):
+            return entry
+        raw_features = [f for f in features if f != 'stake']
+        modules = self.get_raw_modules(network=network, netuid=netuid, features=raw_features, update=update, **kwargs)
+        table = pd.DataFrame.from_records(modules)
+        table = table.set_index('uid', drop=False)
+        table = self.format_table(table, fmt=fmt)
+        table = table[[f for f in ['uid'] + features if f in table]]
+        entry = self.module_tables[table_key] = {
+            'table': table,
+            'version': self.file_version(path),
+            'name2uid': pd.Index(table['name']) if 'name' in table else None,
+            'key2uid': pd.Index(table['key']) if 'key' in table else None,
+        }
+        return entry
+
+    def module_table(self, network = 'main', netuid: int = 0, fmt:str = 'j', **kwargs) -> 'pd.DataFrame':
+        """
+        the modules of a subnet as a dataframe indexed by uid
+        """
+        # a copy, the cached table is shared by every caller
+        return self.module_table_entry(network=network, netuid=netuid, fmt=fmt, **kwargs)['table'].copy()
+
+    def lookup_module(self, value:str, field:str = 'key', fmt:str = 'nano', **kwargs) -> Optional['ModuleInfo']:
+        entry = self.module_table_entry(fmt=fmt, **kwargs)
+        i = entry[f'{field}2uid'].get_indexer([value])[0]
+        if i < 0:
+            return None
+        return entry['table'].iloc[[i]].to_dict('records')[0]
+
     def modules(self,
                 search:str= None,
                 network = 'main',
@@ -1576,99 +2051,42 @@ class Subspace(c.Module):
                 page_size = 100,
                 lite: bool = True,
                 page = None,
+                df: bool = False,
                 **kwargs
                 ) -> Dict[str, 'ModuleInfo']:
+        """
+        df: return the module tables (indexed by uid) instead of lists of dicts
+        """
         if search == 'all':
             netuid = search
             search = None
+        if isinstance(search, int):
+            netuid = search
+            search = None
         if isinstance(netuid, str) and netuid != 'all':
             netuid = self.subnet2netuid(netuid)
         features = self.lite_module_features if lite else features
 
         t1 = c.time()
-        state = {}
-        if update:
-            block = block or self.block
-            state = {}
-            key2future = {}
-            while len(state) < len(features):
-                features_left = [f for f in features if f not in state and f not in key2future]                
-                c.print( f'Fetching {features_left} ')
-                for f in features_left:
-                    kw = dict(feature=self.feature2key.get(f,f), 
-                              network=network, 
-                              netuid=netuid, 
-                              block=block, 
-                              update=True)
-                    key2future[f] = c.submit(self.get_feature,kwargs=kw)
-                future2key = {v:k for k,v in key2future.items()}
-                futures = list(key2future.values())
-
-                progress = c.tqdm(total=len(futures), desc=f'Fetching {len(futures)} features')
-            
-                for future in  c.as_completed(futures, timeout=timeout):
-                    key = future2key[future]
-                    result = future.result()
-                    futures.remove(future)  
-                    if not c.is_error(result):
-                        progress.update(1)
-                        state[key] = result
-                    else:
-                        c.print('Error fetching feature', key, result)
-                        break
-
-                
-        if isinstance(search, int):
-            netuid = search
-            search = None
-
-        if netuid == 'all':
-            netuids = self.netuids(network=network)
-
-        else:
-            netuids = [netuid]
-            state = {k:{netuid: v} for k,v in state.items()}
+        return_netuid = isinstance(netuid, int)
+        netuids = self.netuids(network=network) if netuid == 'all' else [netuid]
             
         all_modules = []
-        return_netuid = isinstance(netuid, int)
         for netuid in netuids:
-            c.print(netuid)
-            path = f'modules/{network}.{netuid}'
-
-            modules = [] if update else self.get(path, [])
-            
-            if len(modules) == 0:
-                for uid, key in enumerate(state['key'][netuid]):
-                    module = { 'uid': uid, 'key': key}
-                    for  f in features:
-                        if f in ['name', 'address', 'emission', 'incentive', 
-                                 'dividends', 'last_update', 'regblock']:
-                            module[f] = state[f][netuid][uid]
-                        elif f in ['trust']:
-                            module[f] = state[f][netuid][uid] if len(state[f][netuid]) > uid else 0
-                        elif f in ['delegation_fee']:
-                            module[f] = state[f][netuid].get(key, 20)
-                        elif f in ['stake_from']:
-                            module[f] = state[f].get(netuid, {}).get(key, [])
-                            module['stake'] =  sum([v for k,v in module['stake_from']])
-                        elif f in ['weights']:
-                            module[f] = state[f].get(netuid, {}).get(uid, [])
-                    modules.append(module)
-                self.put(path, modules)
-
-            for i, module in enumerate(modules):
-                modules[i] = self.format_module(modules[i], fmt=fmt, features=features)
+            table = self.module_table(network=network, netuid=netuid, fmt=fmt, features=features, update=update, block=block, timeout=timeout)
             if search != None and search != 'all':
-                modules = [m for m in modules if search in m['name']]
-        
-            all_modules.append(modules)
-            
+                table = table[table['name'].str.contains(search, regex=False)]
+            # sort by emission
+            if sortby != None and sortby in table:
+                if sortby == 'weights':
+                    table = table.iloc[table['weights'].map(len).to_numpy().argsort()[::-1]]
+                else:
+                    table = table.sort_values(sortby, ascending=False, kind='stable')
+            all_modules.append(table)
 
+        if not df:
+            all_modules = [table.to_dict('records') for table in all_modules]
         
-        # sort by emission
-        if sortby != None and sortby in features:
-            all_modules = [sorted(modules, key=lambda x: x[sortby] if 'sortby' != 'weights' else len(x[sortby]), reverse=True) for modules in all_modules]
-    
         if return_netuid:
             modules =  all_modules[0]
             n = len(modules)
@@ -1676,23 +2094,24 @@ class Subspace(c.Module):
             modules = all_modules
             n = sum([len(m) for m in modules])
 
-        c.print(f'Fetched {len(modules)} modules in {c.time() - t1} seconds')
+        c.print(f'Fetched {n} modules in {c.time() - t1} seconds')
         if page != None:
-            if isinstance(modules[0], list): 
+            if not return_netuid:
                 # flatten list
-                new_modules = []
-                for m in modules:
-                    new_modules += m
-                modules = new_modules
+                if df:
+                    import pandas as pd
+                    modules = pd.concat(modules)
+                else:
+                    new_modules = []
+                    for m in modules:
+                        new_modules += m
+                    modules = new_modules
             num_pages = n//page_size
             start_idx = page*page_size
             end_idx = start_idx + page_size
             modules = modules[start_idx:end_idx]
 
             c.print(f'Page {page} of {n//page_size} pages')
-    
-            
-
 
         return modules
     
@@ -1735,6 +2154,13 @@ class Subspace(c.Module):
     
 
     def key2uid(self, key = None, network:str=  'main' ,netuid: int = 0, update=False, **kwargs):
+        if key != None and not update and os.path.exists(self.resolve_path(f'modules/{network}.{netuid}', extension='json')):
+            # index lookup on the stored module table
+            key_ss58 = self.resolve_key_ss58(key)
+            module = self.lookup_module(key_ss58, field='key', network=network, netuid=netuid)
+            if module == None:
+                raise KeyError(key_ss58)
+            return int(module['uid'])
         key2uid =  {v:k for k,v in self.uid2key(network=network, netuid=netuid, update=update, **kwargs).items()}
         if key != None:
             key_ss58 = self.resolve_key_ss58(key)
@@ -2254,7 +2680,7 @@ class Subspace(c.Module):
         feature2params['modules'] = [get_feature, dict(feature='modules', update=update, block=block, timeout=timeout)]
     
         feature2result = {}
-        state_dict = {'block': block,'block_hash': self.block_hash(block)}
+        state_dict = {'block': block,'block_hash': self.block_hash(block, network=network)}
         while len(feature2params) > 0:
             
             for feature, (fn, kwargs) in feature2params.items():
@@ -0,0 +1,295 @@
+import commune as c
+from typing import *
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SubspaceSync(c.Module):
+    """
+    Follows the chain block by block and keeps storage maps in a local store
+    - new block headers come from a subscription on a dedicated connection
+    - every block only the changed entries are fetched (state_queryStorage between the last synced block and the new one),
+      the keys are rescanned only when the block has events that can add entries
+    - the maps are saved as query_map snapshots, so subspace.query_map(update=False) reads the latest synced block
+    """
+    # one engine per network per process
+    engines = {}
+
+    def __init__(self, config=None, **kwargs):
+        config = self.set_config(config=config, kwargs=kwargs)
+        self.network = config.network
+        self.subspace = c.module('subspace')(network=config.network)
+        # reentrant, query_map can be called while the block is held
+        self.lock = threading.RLock()
+        self.maps = {} # name -> {types, raw: {storage key: value hex}, decoded: {storage key: (key, value)}}
+        self.block = None
+        self.block_hash = None
+        self.last_saved = 0
+        self.query_storage = True # state_queryStorage is an unsafe rpc, some nodes do not serve it
+        self.headers = queue.Queue()
+        self.running = False
+        self.stats = {'blocks': 0, 'changes': 0, 'rescans': 0, 'full_loads': 0}
+
+    @classmethod
+    def get_engine(cls, network:str = 'main', **kwargs) -> 'SubspaceSync':
+        if network not in cls.engines:
+            cls.engines[network] = cls(network=network, **kwargs)
+            cls.engines[network].start()
+        return cls.engines[network]
+
+    def storage_path(self, name:str) -> str:
+        return f'{self.config.module}.{name}'
+
+    def decode(self, name:str, items:list, block_hash:str) -> list:
+        from commune.modules.subspace.subspace import decode_storage_items
+        types = self.maps[name]['types']
+        url = self.subspace.url
+        substrate = self.subspace.get_substrate(network=self.network, url=url)
+        with substrate:
+            keys, values = decode_storage_items(url, block_hash, types['key_type'], types['value_type'], len(types['prefix']), items, substrate=substrate)
+        return list(zip(keys, values))
+
+    def full_load(self, block_hash:str = None):
+        """
+        loads the whole maps at the block
+        """
+        substrate = self.subspace.get_substrate(network=self.network)
+        block_hash = block_hash or substrate.get_block_hash(self.subspace.block)
+        block = substrate.get_block_number(block_hash)
+        maps = {}
+        for name in self.config.maps:
+            keys, values, items = self.subspace.query_map_columns(module=self.config.module,
+                                                                  name=name,
+                                                                  params=[],
+                                                                  block_hash=block_hash,
+                                                                  network=self.network,
+                                                                  return_items=True)
+            maps[name] = {
+                'types': self.subspace.storage_types(module=self.config.module, name=name, block_hash=block_hash, network=self.network),
+                'raw': {k: v for k, v in items},
+                'decoded': {k: (key, value) for (k, _), key, value in zip(items, keys, values)},
+            }
+        with self.lock:
+            self.maps = maps
+            self.block = block
+            self.block_hash = block_hash
+        self.stats['full_loads'] += 1
+        self.save()
+        return {'block': block, 'maps': {name: len(m['raw']) for name, m in maps.items()}}
+
+    def fetch_values(self, keys:list, block_hash:str) -> list:
+        """
+        the (storage key, value hex) of the keys at the block, value is None for deleted entries
+        """
+        def fetch(chunk, substrate):
+            response = substrate.rpc_request(method='state_queryStorageAt', params=[chunk, block_hash])
+            return [item for group in response['result'] for item in group['changes']]
+        return self.fetch_chunks(fetch, keys)
+
+    def fetch_changes(self, keys:list, from_hash:str, to_hash:str) -> list:
+        """
+        the (storage key, value hex) of the keys that changed after from_hash up to to_hash, latest value last
+        """
+        def fetch(chunk, substrate):
+            response = substrate.rpc_request(method='state_queryStorage', params=[chunk, from_hash, to_hash])
+            if 'error' in response:
+                raise Exception(response['error'])
+            # the first change set is the state at from_hash
+            return [item for group in response['result'] if group['block'] != from_hash for item in group['changes']]
+        return self.fetch_chunks(fetch, keys)
+
+    @staticmethod
+    def is_unsupported(e:Exception) -> bool:
+        """
+        whether the node refused the rpc (unsafe or unknown method), as opposed to a transient error
+        """
+        error = e.args[0] if len(e.args) > 0 else e
+        if isinstance(error, dict) and error.get('code') == -32601:
+            return True
+        msg = str(error).lower()
+        return 'unsafe' in msg or 'method not found' in msg
+
+    def fetch_chunks(self, fn:Callable, keys:list) -> list:
+        # chunks of keys are fetched over the substrate pool
+        chunk_size = self.config.keys_per_request
+        chunks = [keys[i:i+chunk_size] for i in range(0, len(keys), chunk_size)]
+        if len(chunks) == 0:
+            return []
+        substrates = self.subspace.get_substrates(url=self.subspace.url, n=min(len(chunks), self.config.connections))
+        with ThreadPoolExecutor(max_workers=len(substrates)) as executor:
+            futures = [executor.submit(fn, chunk, substrates[i % len(substrates)]) for i, chunk in enumerate(chunks)]
+            return [item for future in futures for item in future.result()]
+
+    def rescan_keys(self, name:str, block_hash:str) -> list:
+        """
+        the storage keys of the map at the block that are not in the store
+        """
+        substrate = self.subspace.get_substrate(network=self.network)
+        prefix = self.maps[name]['types']['prefix']
+        new_keys = []
+        start_key = prefix
+        while True:
+            response = substrate.rpc_request(method='state_getKeysPaged', params=[prefix, self.config.keys_per_request, start_key, block_hash])
+            keys = response['result']
+            new_keys += [k for k in keys if k not in self.maps[name]['raw']]
+            if len(keys) < self.config.keys_per_request:
+                break
+            start_key = keys[-1]
+        return new_keys
+
+    def should_rescan(self, block_hash:str) -> bool:
+        substrate = self.subspace.get_substrate(network=self.network)
+        for event in substrate.get_events(block_hash=block_hash):
+            event = event.value.get('event', event.value)
+            if event.get('module_id') == self.config.module and event.get('event_id') in self.config.rescan_events:
+                return True
+        return False
+
+    def apply_block(self, block:int):
+        """
+        applies the changes between the last synced block and the block
+        """
+        substrate = self.subspace.get_substrate(network=self.network)
+        block_hash = substrate.get_block_hash(block)
+        rescan = self.should_rescan(block_hash)
+        changes = {}
+        for name, m in self.maps.items():
+            keys = list(m['raw'].keys())
+            for trial in range(self.config.retries):
+                if not self.query_storage:
+                    break
+                try:
+                    items = self.fetch_changes(keys, self.block_hash, block_hash)
+                    break
+                except Exception as e:
+                    if self.is_unsupported(e):
+                        c.print(f'state_queryStorage is not served ({e}), comparing values instead', color='yellow')
+                        self.query_storage = False
+                    elif trial == self.config.retries - 1:
+                        raise e
+                    else:
+                        c.print(f'state_queryStorage failed ({e}), retrying', color='yellow')
+                        c.sleep(1)
+            if not self.query_storage:
+                items = [(k, v) for k, v in self.fetch_values(keys, block_hash) if m['raw'].get(k) != v]
+            if rescan:
+                new_keys = self.rescan_keys(name, block_hash)
+                items += self.fetch_values(new_keys, block_hash)
+                self.stats['rescans'] += 1
+            # the latest value of every key
+            changes[name] = list(dict(items).items())
+
+        decoded = {name: self.decode(name, items, block_hash) for name, items in changes.items()}
+        with self.lock:
+            for name, items in changes.items():
+                m = self.maps[name]
+                for (k, v), (key, value) in zip(items, decoded[name]):
+                    if v == None:
+                        m['raw'].pop(k, None)
+                        m['decoded'].pop(k, None)
+                    else:
+                        m['raw'][k] = v
+                        m['decoded'][k] = (key, value)
+            self.block = block
+            self.block_hash = block_hash
+        self.stats['blocks'] += 1
+        self.stats['changes'] += sum([len(items) for items in changes.values()])
+        if c.time() - self.last_saved > self.config.save_interval:
+            self.save()
+        return {'block': block, 'changes': {name: len(items) for name, items in changes.items()}}
+
+    def save(self):
+        """
+        saves the maps as query_map snapshots at the synced block
+        """
+        with self.lock:
+            block_hash = self.block_hash
+            columns = {name: {'keys': [key for key, _ in m['decoded'].values()],
+                              'values': [value for _, value in m['decoded'].values()]} for name, m in self.maps.items()}
+        for name, column in columns.items():
+            storage_path = self.storage_path(name)
+            self.subspace.save_snapshot(self.network, block_hash, storage_path, column)
+            self.subspace.put(f'query_map/{self.network}/latest/{storage_path}', {'block_hash': block_hash})
+        self.last_saved = c.time()
+        return {'success': True, 'block': self.block, 'block_hash': block_hash}
+
+    def subscribe(self):
+        # the subscription blocks its connection, so it gets its own
+        substrate = self.subspace.get_substrate(network=self.network, mode='ws', cache=False)
+        def handler(header, update_nr, subscription_id):
+            self.headers.put(header['header']['number'])
+            if not self.running:
+                return True
+        substrate.subscribe_block_headers(handler, finalized_only=self.config.finalized_only)
+
+    def subscribe_loop(self):
+        while self.running:
+            try:
+                self.subscribe()
+            except Exception as e:
+                c.print(f'Block subscription dropped: {e}, resubscribing', color='red')
+                c.sleep(self.config.block_time)
+
+    def run(self):
+        """
+        syncs the maps until stopped
+        """
+        self.running = True
+        while self.running:
+            try:
+                self.full_load()
+                break
+            except Exception as e:
+                c.print(f'Error loading the maps: {e}, retrying', color='red')
+                c.sleep(self.config.block_time)
+        c.thread(self.subscribe_loop)
+        while self.running:
+            block = self.headers.get()
+            # the changes are fetched as a range, so a backlog of headers is one update
+            while not self.headers.empty():
+                block = max(block, self.headers.get())
+            if block <= self.block:
+                continue
+            try:
+                c.print(self.apply_block(block))
+            except Exception as e:
+                c.print(f'Error syncing block {block}: {e}, reloading the maps', color='red')
+                try:
+                    self.full_load()
+                except Exception as e:
+                    c.print(f'Error loading the maps: {e}', color='red')
+                    c.sleep(self.config.block_time)
+
+    def start(self):
+        c.thread(self.run)
+        return {'success': True, 'network': self.network}
+
+    def stop(self):
+        self.running = False
+        return self.save()
+
+    def query_map(self, name:str = 'Stake') -> dict:
+        """
+        the map at the latest synced block
+        """
+        with self.lock:
+            decoded = list(self.maps[name]['decoded'].values())
+        return self.subspace.columns2map([k for k, _ in decoded], [v for _, v in decoded])
+
+    def stakes(self, netuid:int = 0, fmt:str = 'j') -> dict:
+        stakes = self.query_map('Stake').get(netuid, {})
+        return {k: self.subspace.format_amount(v, fmt=fmt) for k, v in stakes.items()}
+
+    @classmethod
+    def test(cls, blocks:int = 2, network:str = 'main'):
+        self = cls(network=network)
+        self.start()
+        while self.block == None or self.stats['blocks'] < blocks:
+            c.sleep(1)
+        with self.lock:
+            block = self.block
+            stakes = self.query_map('Stake')
+        self.stop()
+        assert stakes == self.subspace.query_map('Stake', block=block, update=True), f'Stake differs from the chain at block {block}'
+        return {'success': True, 'block': block, **self.stats}
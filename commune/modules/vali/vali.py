@@ -1,6 +1,9 @@
 import traceback
 import commune as c
-import concurrent
+import concurrent.futures
+import threading
+import asyncio
+import numpy as np
 
 class Vali(c.Module):
     
@@ -26,6 +29,15 @@ class Vali(c.Module):
         # merge the config with the default config
         self.config = c.dict2munch({**Vali.config(), **config})
         # we want to make sure that the config is a munch
+        self.infos = {} # name -> module info
+        self.dirty_infos = {} # name -> module info not yet written
+        self.name2slot = {} # name -> index in the weights (local order, the chain uids are resolved in votes)
+        self.weights = np.full(0, np.nan) # the score ema of each module
+        self.clients = {} # address (or (thread, address) for sync score functions) -> client
+        # the workers share the infos, the uids and the weights
+        self.lock = threading.Lock()
+        # for score functions that are not coroutines
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.config.threads_per_worker)
         self.sync()
         if self.config.start:
             c.thread(self.start)
@@ -101,13 +113,20 @@ class Vali(c.Module):
 
         
     def worker(self, id = 0):
-        worker_name = self.worker_name(id)
+        # each worker runs its own event loop, the evals are coroutines on that loop
+        loop = c.new_event_loop()
+        return loop.run_until_complete(self.async_worker(id))
 
-        batch_size = self.config.batch_size 
+    async def async_worker(self, id = 0):
+        """
+        keeps up to batch_size evals in flight on one event loop,
+        so a worker is bounded by the network and not by threads
+        """
+        worker_name = self.worker_name(id)
         self.running = True
         last_print = 0
-        executor = c.module('executor.thread')(max_workers=self.config.threads_per_worker)
-        futures = []
+        last_flush = c.time()
+        pending = set()
 
         while self.running:
             if self.last_sync_time + self.config.sync_interval < c.time():
@@ -115,55 +134,63 @@ class Vali(c.Module):
                 self.sync()
                 
             module_addresses = c.shuffle(list(self.namespace.values()))
-            batch_size = min(batch_size, len(module_addresses))
+            if len(module_addresses) == 0:
+                await asyncio.sleep(self.config.sleep_interval)
+                continue
             
-            # select a module
-            for  i, module_address in enumerate(module_addresses):
-                # if the futures are less than the batch, we can submit a new future
-                if len(futures) < batch_size:
-                    self.last_sent = c.time()
-                    future = executor.submit(self.eval_module, args=[module_address], timeout=self.config.timeout)
-                    futures.append(future)
-                else:
-                    try:
-                        for ready_future in c.as_completed(futures, timeout=self.config.timeout):
-                            try:
-                                result = ready_future.result()
-                                self.last_success = c.time()
-                            except Exception as e:
-                                result = c.detailed_error(e)
-
-                            if c.is_error(result):
-                                self.errors += 1
-                            else:
-    
-                                c.print(result, verbose=self.config.verbose)
-                                self.successes += 1
-                            futures.remove(ready_future)
-                            continue
-                    except Exception as e:
-                        self.errors += 1
-
-                            
-                        continue
-
-                    
-                    
+            for module_address in module_addresses:
+                if not self.running:
+                    break
+                # process the finished evals as they complete, not only when the slots are full
+                done = {task for task in pending if task.done()}
+                pending -= done
+                for task in done:
+                    self.process_eval(task)
+                # wait for a slot when the in flight evals are at the limit
+                while len(pending) >= self.config.batch_size:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        self.process_eval(task)
+                self.last_sent = c.time()
+                pending.add(asyncio.ensure_future(asyncio.wait_for(self.async_eval_module(module_address), timeout=self.config.timeout)))
+
+                if len(self.dirty_infos) >= self.config.batch_size or c.time() - last_flush > self.config.flush_interval:
+                    await self.async_flush_infos()
+                    last_flush = c.time()
+
                 if c.time() - last_print > self.config.print_interval:
                     stats =  {
-                        'pending': len(futures),
+                        'pending': len(pending),
                         'sent': self.requests,
                         'errors': self.errors,
                         'successes': self.successes,
                         'network': self.network,
+                        'epochs': self.epochs,
                         'last_success': c.round(c.time() - self.last_success,2),
                         'worker_name': worker_name,
                             }
                     self.put(f'clone_stats/{worker_name}', stats)
                     c.print(c.df([stats]))
                     last_print = c.time()
-                
+            self.epochs += 1
 
+        if len(pending) > 0:
+            done, _ = await asyncio.wait(pending)
+            for task in done:
+                self.process_eval(task)
+        await self.async_flush_infos()
+
+    def process_eval(self, task:'asyncio.Task'):
+        try:
+            result = task.result()
+            self.last_success = c.time()
+        except Exception as e:
+            result = c.detailed_error(e)
+        if c.is_error(result):
+            self.errors += 1
+        else:
+            c.print(result, verbose=self.config.verbose)
+        return result
 
     def clone_stats(self):
         workers = self.workers()
@@ -256,25 +283,75 @@ class Vali(c.Module):
         else:
             module_name = module
 
-        info = self.load_module_info( module_name, {})
+        # the infos are read from disk once and then kept in memory
+        if module_name not in self.infos:
+            loaded = self.load_module_info( module_name, {})
+            with self.lock:
+                self.infos.setdefault(module_name, loaded)
+        info = self.infos[module_name]
         info['address'] = module_address
         info['name'] = module_name
         info['schema'] = info.get('schema', None)
 
         return info
-    
 
-    def eval_module(self, module:str):
+    def get_slot(self, name:str) -> int:
+        """
+        the index of the module in the weight array, new modules are appended
+        this is the order the modules were first scored in, not the chain uid (votes maps the keys to uids)
+        """
+        with self.lock:
+            if name not in self.name2slot:
+                slot = len(self.name2slot)
+                if slot >= len(self.weights):
+                    # double the capacity so appends are amortized
+                    weights = np.full(max(2 * len(self.weights), 1), np.nan)
+                    weights[:len(self.weights)] = self.weights
+                    self.weights = weights
+                self.name2slot[name] = slot
+            return self.name2slot[name]
+
+    def update_weight(self, name:str, w:float) -> float:
+        # exponential moving average of the scores, seeded from the saved weight (or the first score of a new module)
+        # called before the response is merged into the info, so the info still has the previous weight
+        slot = self.get_slot(name)
+        with self.lock:
+            if np.isnan(self.weights[slot]):
+                self.weights[slot] = self.infos.get(name, {}).get('w', w)
+            self.weights[slot] = w * self.config.alpha + self.weights[slot] * (1 - self.config.alpha)
+            return float(self.weights[slot])
+
+    def get_client(self, address:str, thread:bool = False):
+        """
+        one client per address, so the evals reuse the pooled connections
+        thread: a client per executor thread, the sync calls of a client run on the loop of the thread that made it
+        """
+        key = (threading.get_ident(), address) if thread else address
+        client = self.clients.get(key)
+        if client == None:
+            ip, port = address.split(':')
+            client = c.module('client')(ip=ip, port=int(port), key=self.key)
+            with self.lock:
+                client = self.clients.setdefault(key, client)
+        return client
+
+    def score_module_sync(self, address:str):
+        # sync score functions run in the executor with the pooled client of that thread
+        return self.score_module(self.get_client(address, thread=True).virtual())
+
+    async def async_score_module(self, address:str):
+        if asyncio.iscoroutinefunction(self.score_module):
+            return await self.score_module(self.get_client(address).virtual())
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.score_module_sync, address)
+
+    async def async_eval_module(self, module:str):
         """
         The following evaluates a module sver
         """
-        # load the module stats (if it exists)
-
-        
         # load the module info and calculate the staleness of the module
         # if the module is stale, we can just return the module info
         info = self.get_module_info(module)
-        module = c.connect(info['address'], key=self.key)
         self.requests += 1
 
         seconds_since_called = c.time() - info.get('timestamp', 0)
@@ -285,31 +362,55 @@ class Vali(c.Module):
                         'timestamp': c.time(), 
                         'msg': f'Module is not stale, {int(seconds_since_called)} < {self.config.max_staleness}'}
         else:
-            module_info = module.info(timeout=self.config.timeout)
-            assert 'address' in info and 'name' in info
+            client = self.get_client(info['address'])
+            module_info = await client.async_forward(fn='info', timeout=self.config.timeout)
+            assert isinstance(module_info, dict) and not c.is_error(module_info), f'Invalid info {module_info}'
             # we want to make sure that the module info has a timestamp
             info.update(module_info)
+            info['address'] = client.address
             info['timestamp'] = c.time()
 
         try:
-
-            # we want to make sure that the module info has a timestamp
-            response = self.score_module(module)
+            response = await self.async_score_module(info['address'])
             response = self.check_response(response)
-            info.update(response)
             response['msg'] =  f'{c.emoji("checkmark")}{info["name"]} --> w:{response["w"]} {c.emoji("checkmark")} '
             self.successes += 1
         except Exception as e:
             e = c.detailed_error(e)
             response = { 'w': 0,'msg': f'{c.emoji("cross")} {info["name"]} {c.emoji("cross")}'}  
         
+        # the ema is updated before the merge, the merge overwrites the previous w with the raw score
+        w = self.update_weight(info['name'], response['w'])
+        info.update(response)
         info['latency'] = c.time() - info['timestamp']
-        info['w'] = response['w']  * self.config.alpha + info['w'] * (1 - self.config.alpha)
-        path = f'{self.storage_path}/{info["name"]}'
-        self.put_json(path, info)
-
+        info['w'] = w
+        # written in batches by the worker
+        with self.lock:
+            self.dirty_infos[info['name']] = info
 
         return {'w': info['w'], 'module': info['name'], 'address': info['address'], 'latency': info['latency']}
+
+    def eval_module(self, module:str):
+        result = c.gather(self.async_eval_module(module), timeout=self.config.timeout)
+        c.gather(self.async_flush_infos(), timeout=self.config.timeout)
+        return result
+
+    async def async_flush_infos(self):
+        """
+        writes the infos that changed since the last flush concurrently
+        """
+        with self.lock:
+            # copies, another worker can update an info while it is written
+            dirty_infos = {name: dict(info) for name, info in self.dirty_infos.items()}
+            self.dirty_infos = {}
+        if len(dirty_infos) == 0:
+            return {'success': True, 'written': 0}
+        jobs = [self.async_put_json(f'{self.storage_path}/{name}', info) for name, info in dirty_infos.items()]
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        errors = [r for r in results if isinstance(r, Exception)]
+        if len(errors) > 0:
+            c.print(f'Failed to write {len(errors)} module infos, {errors[0]}', color='red')
+        return {'success': len(errors) == 0, 'written': len(results) - len(errors)}
         
     @property
     def storage_path(self):
@@ -0,0 +1,247 @@
+import os
+import time
+import pickle
+import hashlib
+import asyncio
+import inspect
+import functools
+import itertools
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable
+
+# arguments of these types are part of the key by value, anything else (self, clients, ...) by a token of the object
+hashable_types = (str, int, float, bool, bytes, type(None))
+
+class Uncacheable(Exception):
+    """
+    an argument that has no stable key, the call is not cached
+    """
+
+# object -> token, unlike id(x) a token is never reused after the object is collected,
+# the process nonce keeps the tokens of the disk tier from colliding across restarts
+object_tokens = weakref.WeakKeyDictionary()
+token_counter = itertools.count()
+token_lock = threading.Lock()
+process_nonce = os.urandom(8).hex()
+
+def object_token(x: Any) -> str:
+    try:
+        with token_lock:
+            token = object_tokens.get(x)
+            if token == None:
+                token = object_tokens[x] = f'<{type(x).__qualname__}#{process_nonce}:{next(token_counter)}>'
+            return token
+    except TypeError:
+        # unhashable or not weak referenceable
+        raise Uncacheable(type(x).__qualname__)
+
+def normalize_arg(x: Any):
+    if isinstance(x, hashable_types):
+        return x
+    if isinstance(x, (list, tuple, set)):
+        items = [normalize_arg(v) for v in x]
+        return (type(x).__name__, tuple(sorted(items, key=repr) if isinstance(x, set) else items))
+    if isinstance(x, dict):
+        return ('dict', tuple(sorted([(str(k), normalize_arg(v)) for k, v in x.items()])))
+    return object_token(x)
+
+def hash_args(args: tuple, kwargs: dict) -> str:
+    """
+    a stable key for the arguments of a call
+    """
+    data = repr((normalize_arg(args), normalize_arg(kwargs))).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+class Memo:
+    """
+    Memoizes a function by its arguments
+    - in memory lru bounded by max_size with entries expiring after max_age seconds
+    - optional disk tier (pickle per key) that survives restarts
+    - concurrent misses of the same key run the function once (single flight)
+    - works for sync and async functions
+    """
+    def __init__(self,
+                 fn: Callable,
+                 max_size: int = 1024, # max entries in memory
+                 max_age: float = 60, # seconds an entry is valid (None never expires)
+                 path: str = None, # directory of the disk tier (None disables it)
+                 ):
+        self.fn = fn
+        self.max_size = max_size
+        self.max_age = max_age
+        self.path = path
+        self.is_async = inspect.iscoroutinefunction(fn)
+        try:
+            self.signature = inspect.signature(fn)
+        except (TypeError, ValueError):
+            # some builtins have no signature, their calls are keyed as given
+            self.signature = None
+        self.cache = OrderedDict() # key -> (timestamp, value)
+        self.lock = threading.Lock()
+        self.inflight = {} # key -> event (sync) or future (async) of the call computing it
+        self.stats = {'hits': 0, 'misses': 0, 'disk_hits': 0, 'evictions': 0, 'deduped': 0, 'uncached': 0}
+        if self.path != None:
+            os.makedirs(self.path, exist_ok=True)
+
+    def is_fresh(self, timestamp: float) -> bool:
+        return self.max_age == None or time.time() - timestamp < self.max_age
+
+    def get(self, key: str):
+        """
+        returns (found, value)
+        """
+        with self.lock:
+            if key in self.cache:
+                timestamp, value = self.cache[key]
+                if self.is_fresh(timestamp):
+                    self.cache.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return True, value
+                del self.cache[key]
+        if self.path != None:
+            path = os.path.join(self.path, key)
+            try:
+                if self.is_fresh(os.path.getmtime(path)):
+                    with open(path, 'rb') as f:
+                        value = pickle.load(f)
+                    self.set(key, value, disk=False)
+                    self.stats['disk_hits'] += 1
+                    return True, value
+            except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+                pass
+        self.stats['misses'] += 1
+        return False, None
+
+    def set(self, key: str, value: Any, disk: bool = True):
+        with self.lock:
+            self.cache[key] = (time.time(), value)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+                self.stats['evictions'] += 1
+        if disk and self.path != None:
+            # write then rename so readers never load a partial pickle
+            path = os.path.join(self.path, key)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(value, f)
+                os.replace(tmp_path, path)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                # not picklable, keep it in memory only
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return value
+
+    def call(self, key: str, *args, **kwargs):
+        found, value = self.get(key)
+        if found:
+            return value
+        with self.lock:
+            waiter = self.inflight.get(key)
+            if waiter == None:
+                waiter = self.inflight[key] = {'event': threading.Event()}
+                leader = True
+            else:
+                leader = False
+                self.stats['deduped'] += 1
+        if not leader:
+            waiter['event'].wait()
+            if 'error' in waiter:
+                raise waiter['error']
+            return waiter['result']
+        try:
+            waiter['result'] = self.set(key, self.fn(*args, **kwargs))
+            return waiter['result']
+        except BaseException as e:
+            waiter['error'] = e
+            raise e
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            waiter['event'].set()
+
+    async def async_call(self, key: str, *args, **kwargs):
+        found, value = self.get(key)
+        if found:
+            return value
+        loop = asyncio.get_running_loop()
+        inflight_key = (id(loop), key)
+        future = self.inflight.get(inflight_key)
+        if future != None:
+            self.stats['deduped'] += 1
+            return await asyncio.shield(future)
+        future = self.inflight[inflight_key] = loop.create_future()
+        try:
+            result = self.set(key, await self.fn(*args, **kwargs))
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            # mark it retrieved so the loop does not warn when nobody else was waiting
+            future.exception()
+            raise e
+        finally:
+            # a cancelled leader cancels the future, so the waiters do not hang on it
+            if not future.done():
+                future.cancel()
+            self.inflight.pop(inflight_key, None)
+
+    def get_key(self, args: tuple, kwargs: dict) -> str:
+        """
+        the key of the call by parameter name with the defaults filled in, so fn(1), fn(x=1) and fn(1, y=1) share a key
+        """
+        if self.signature != None:
+            try:
+                bound = self.signature.bind(*args, **kwargs)
+            except TypeError:
+                # a call that does not match the signature, keyed as given so fn raises the error
+                return hash_args(args, kwargs)
+            bound.apply_defaults()
+            return hash_args((), dict(bound.arguments))
+        return hash_args(args, kwargs)
+
+    def __call__(self, *args, **kwargs):
+        try:
+            key = self.get_key(args, kwargs)
+        except Uncacheable:
+            self.stats['uncached'] += 1
+            return self.fn(*args, **kwargs)
+        if self.is_async:
+            return self.async_call(key, *args, **kwargs)
+        return self.call(key, *args, **kwargs)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+        if self.path != None:
+            for f in os.listdir(self.path):
+                os.remove(os.path.join(self.path, f))
+
+    def info(self) -> dict:
+        total = self.stats['hits'] + self.stats['disk_hits'] + self.stats['misses']
+        hit_rate = (self.stats['hits'] + self.stats['disk_hits']) / total if total > 0 else 0
+        return {**self.stats, 'size': len(self.cache), 'hit_rate': hit_rate}
+
+
+def memoize(fn: Callable = None, max_size: int = 1024, max_age: float = 60, path: str = None):
+    """
+    decorator, use as @memoize or @memoize(max_age=10)
+    the memo is available as fn.memo (fn.memo.info() for the stats)
+    """
+    if fn == None:
+        return functools.partial(memoize, max_size=max_size, max_age=max_age, path=path)
+    memo = Memo(fn, max_size=max_size, max_age=max_age, path=path)
+    if memo.is_async:
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            return await memo(*args, **kwargs)
+    else:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return memo(*args, **kwargs)
+    wrapper.memo = memo
+    return wrapper